@@ -0,0 +1,67 @@
+import asyncio
+from blackjai_server.detection.backends import DetectorBackend
+from blackjai_server.detection.detect import detect_card_type_yolo_batch
+
+
+"""
+DetectionBatcher:
+Shares one detector between the tasks of several streams (e.g. tables). Each task awaits detect() with its newest
+decoded image, and the images requested while the detector is busy, or within max_wait seconds of the first request,
+run as one batched inference call on the core's inference executor. The model is loaded once for every stream, and
+since each task has at most one image waiting, a batch holds at most the latest frame of each stream.
+"""
+class DetectionBatcher:
+    def __init__(self, core, model: DetectorBackend, max_batch_size=8, max_wait=0.005, annotate=True):
+        if (max_batch_size < 1):
+            raise ValueError("DetectionBatcher max_batch_size must be at least 1")
+        self.core = core
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.annotate = annotate
+        self.num_batches = 0
+        self.num_images = 0
+        self._requests = []
+        self._flush_task = None
+
+    # Detects cards in the image. scale maps its coordinates to the full resolution frame, trace is the frame's
+    # FrameTrace or None, and annotate overrides the batcher's annotate for this image (e.g. a previewed frame).
+    # Returns (annotated_image, detections) like detect_card_type_yolo().
+    async def detect(self, image, scale=(1, 1), trace=None, annotate=None):
+        future = asyncio.get_running_loop().create_future()
+        self._requests.append((image, scale, trace, self.annotate if (annotate is None) else annotate, future))
+        if (self._flush_task is None):
+            self._flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self):
+        try:
+            # give the other streams a moment to add their frames to the first batch
+            if (len(self._requests) < self.max_batch_size and self.max_wait > 0):
+                await asyncio.sleep(self.max_wait)
+            while (len(self._requests) > 0):
+                batch, self._requests = self._requests[:self.max_batch_size], self._requests[self.max_batch_size:]
+                images = [image for image, scale, trace, annotate, future in batch]
+                scales = [scale for image, scale, trace, annotate, future in batch]
+                traces = [trace for image, scale, trace, annotate, future in batch]
+                annotates = [annotate for image, scale, trace, annotate, future in batch]
+                try:
+                    results = await self.core.run_inference(detect_card_type_yolo_batch, images, self.model, scales, annotates, traces)
+                except Exception as ex:
+                    for image, scale, trace, annotate, future in batch:
+                        if (not future.done()):
+                            future.set_exception(ex)
+                    continue
+                self.num_batches += 1
+                self.num_images += len(batch)
+                for (image, scale, trace, annotate, future), result in zip(batch, results):
+                    if (not future.done()):
+                        future.set_result(result)
+        finally:
+            self._flush_task = None
+
+    def get_mean_batch_size(self) -> float:
+        return self.num_images / self.num_batches if (self.num_batches > 0) else 0.0
+
+    def __str__(self):
+        return f"Detector: {self.num_images} images in {self.num_batches} batches ({self.get_mean_batch_size():.2f} per batch)"
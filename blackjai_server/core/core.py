@@ -0,0 +1,148 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Event loop driven server core. A FrameSource reads the stream and hands every frame to each task subscribed to it,
+so several modes (e.g. process, record and preview) can run on the same stream at once. Each subscription keeps only
+the newest frame its task has not taken yet, so a slow task never holds back the others.
+Blocking work runs in executors: one thread for inference, one for the engine (so updates stay in frame order)
+and a small pool for decoding and disk writes. The event loop itself only moves frames and results between tasks.
+"""
+
+
+"""
+FrameSubscription:
+A latest-wins slot of frames for one task. Frames replaced before the task took them are counted as dropped.
+"""
+class FrameSubscription:
+    def __init__(self, name: str):
+        self.name = name
+        self.num_received = 0
+        self.num_dropped = 0
+        self._item = None
+        self._event = asyncio.Event()
+
+    def offer(self, item):
+        if (self._item is not None):
+            self.num_dropped += 1
+        self._item = item
+        self.num_received += 1
+        self._event.set()
+
+    # Waits for and returns the newest frame as (msg, jpg_buffer, FrameMeta)
+    async def get(self):
+        await self._event.wait()
+        self._event.clear()
+        item, self._item = self._item, None
+        return item
+
+    def __str__(self):
+        return f"{self.name}: {self.num_received} frames, {self.num_dropped} dropped"
+
+
+"""
+FrameSource:
+Receives frames from a VideoStreamSubscriber on its own thread and offers each one to every subscription.
+A receive timeout ends the source with a TimeoutError, unless keep_waiting is set (e.g. for one of several tables,
+where a quiet camera should not stop the others). The wait for each frame is recorded as the receive stage of metrics.
+"""
+class FrameSource:
+    def __init__(self, receiver, timeout=4.0, keep_waiting=False, metrics=None):
+        self.receiver = receiver
+        self.timeout = timeout
+        self.keep_waiting = keep_waiting
+        self.metrics = metrics
+        self.subscriptions = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="receive")
+
+    def subscribe(self, name: str) -> FrameSubscription:
+        subscription = FrameSubscription(name)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = time.perf_counter()
+            try:
+                item = await loop.run_in_executor(self._executor, self.receiver.receive, self.timeout)
+            except TimeoutError as ex:
+                if (not self.keep_waiting):
+                    raise
+                print(ex)
+                continue
+            if (self.metrics is not None):
+                self.metrics.record_since("receive", start)
+            for subscription in self.subscriptions:
+                subscription.offer(item)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+"""
+ServerCore:
+Runs the receive tasks and the mode tasks on one event loop. A task is an async function taking its FrameSubscription
+(None for tasks added with subscribe=False). Tasks subscribe to the first source unless given another one added with
+add_source(), e.g. one source per table.
+The core returns once every foreground task has finished, or raises the first error of any task after cancelling
+the others. Background tasks (e.g. periodic stats) are cancelled when the foreground tasks are done.
+"""
+class ServerCore:
+    def __init__(self, source: FrameSource = None, io_workers=2):
+        self.sources = [source] if (source is not None) else []
+        self._tasks = []
+        self.inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.engine_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine")
+        self.io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="io")
+
+    def add_source(self, source: FrameSource) -> FrameSource:
+        self.sources.append(source)
+        return source
+
+    def add_task(self, name: str, func, background=False, subscribe=True, source: FrameSource = None):
+        if (subscribe and source is None):
+            source = self.sources[0]
+        self._tasks.append((name, func, background, source if subscribe else None))
+
+    async def run_inference(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.inference_executor, func, *args)
+
+    async def run_engine(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.engine_executor, func, *args)
+
+    async def run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, func, *args)
+
+    async def run(self):
+        foreground = []
+        background = [asyncio.create_task(source.run(), name="receive") for source in self.sources]
+        for name, func, is_background, source in self._tasks:
+            task = asyncio.create_task(func(source.subscribe(name) if (source is not None) else None), name=name)
+            (background if is_background else foreground).append(task)
+        error = None
+        pending = set(foreground + background)
+        try:
+            while (error is None and any(not task.done() for task in foreground)):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if (not task.cancelled() and task.exception() is not None):
+                        print("Error in task " + task.get_name())
+                        error = task.exception()
+                        break
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if (error is not None):
+            raise error
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+        for executor in (self.inference_executor, self.engine_executor, self.io_executor):
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def __str__(self):
+        return "Tasks: " + " | ".join(str(subscription) for source in self.sources for subscription in source.subscriptions)
@@ -0,0 +1,252 @@
+import os
+import ast
+import abc
+import sys
+import time
+import cv2 as cv
+import numpy as np
+
+"""
+Interchangeable card detector backends.
+Every backend loads a YOLO card model and returns the same output contract from predict():
+    (xyxy, confidence, class_id) as NumPy arrays of shape (N, 4), (N,) and (N,)
+with boxes in pixel coordinates of the given image, and exposes the class names as a dict of class id -> name.
+predict_batch() returns one such tuple per image and runs the images as one batch where the backend supports it.
+"""
+
+# Backend names selectable from conf.py
+ULTRALYTICS_BACKEND = "ultralytics"
+ONNX_BACKEND = "onnx"
+ONNX_INT8_BACKEND = "onnx_int8"
+BACKENDS = [ULTRALYTICS_BACKEND, ONNX_BACKEND, ONNX_INT8_BACKEND]
+
+MODELS_DIR = f"{os.getcwd()}/blackjai_server/ml_models"
+DEFAULT_MODEL_NAME = "best_m_31eps_all"
+DEFAULT_MODEL_PATHS = {
+    ULTRALYTICS_BACKEND: f"{MODELS_DIR}/{DEFAULT_MODEL_NAME}.pt",
+    ONNX_BACKEND: f"{MODELS_DIR}/{DEFAULT_MODEL_NAME}.onnx",
+    ONNX_INT8_BACKEND: f"{MODELS_DIR}/{DEFAULT_MODEL_NAME}.int8.onnx",
+}
+
+
+# Draws detections with their class names on images, without a model (e.g. for detections made by inference workers)
+class DetectionAnnotator:
+    def __init__(self, names: dict = None):
+        self.names = names if (names is not None) else {}
+
+    # draws the detections on the image in place and returns it
+    def annotate(self, image, xyxy, confidence, class_id):
+        for i in range(len(xyxy)):
+            x1, y1, x2, y2 = [int(v) for v in xyxy[i]]
+            label = str(self.names.get(int(class_id[i]), class_id[i])) + " " + str(round(float(confidence[i]), 2))
+            cv.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), 2)
+            cv.putText(image, label, (x1, y1 - 10), cv.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+        return image
+
+
+# Base class for the detector backends
+class DetectorBackend(DetectionAnnotator, abc.ABC):
+    name = None
+
+    def __init__(self, conf=0.5):
+        super().__init__()
+        self.conf = conf
+
+    # returns (xyxy, confidence, class_id) for the cards detected in the image
+    @abc.abstractmethod
+    def predict(self, image) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        pass
+
+    # returns predict() for each image, backends override this to run the images as one batch
+    def predict_batch(self, images: list) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        return [self.predict(image) for image in images]
+
+
+# The original Ultralytics path. Also loads Ultralytics exports such as *.torchscript files
+# and *_openvino_model directories, so TorchScript and OpenVINO run through this backend too.
+class UltralyticsBackend(DetectorBackend):
+    name = ULTRALYTICS_BACKEND
+
+    def __init__(self, model_path, conf=0.5):
+        super().__init__(conf)
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        self.names = self.model.names
+
+    def predict(self, image):
+        results = self.model.predict(image, conf=self.conf, verbose=False)
+        # names are only known for exported models once a prediction has run
+        self.names = results[0].names
+        # boxes.data rows are (x1, y1, x2, y2, confidence, class), converted to NumPy in one go
+        data = results[0].boxes.data.cpu().numpy()
+        return data[:, :4], data[:, 4], data[:, 5].astype(np.int32)
+
+    def predict_batch(self, images):
+        if (len(images) == 0):
+            return []
+        results = self.model.predict(list(images), conf=self.conf, verbose=False)
+        self.names = results[0].names
+        batch = []
+        for result in results:
+            data = result.boxes.data.cpu().numpy()
+            batch.append((data[:, :4], data[:, 4], data[:, 5].astype(np.int32)))
+        return batch
+
+
+# Runs a YOLO model exported to ONNX (see export_onnx()) with ONNX Runtime on the CPU.
+class OnnxRuntimeBackend(DetectorBackend):
+    name = ONNX_BACKEND
+    # letterbox padding value used by Ultralytics
+    PAD_VALUE = 114
+    # offset added per class id so a single NMS pass never suppresses boxes of different classes
+    NMS_CLASS_OFFSET = 8192
+
+    def __init__(self, model_path, conf=0.5, iou=0.45, num_threads=0):
+        super().__init__(conf)
+        try:
+            import onnxruntime as ort
+        except ImportError as ex:
+            raise ImportError("The onnx detector backends require the onnxruntime package") from ex
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if (num_threads > 0):
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.iou = iou
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_size = int(model_input.shape[2]) if isinstance(model_input.shape[2], int) else 640
+        # models exported with dynamic=True take any batch size, others only run one image at a time
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        # Ultralytics stores the class names in the model metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if ("names" in metadata):
+            self.names = ast.literal_eval(metadata["names"])
+        self._canvas = np.full((self.input_size, self.input_size, 3), self.PAD_VALUE, dtype=np.uint8)
+
+    # resizes the image into the square model input keeping its aspect ratio
+    def _letterbox(self, image):
+        height, width = image.shape[:2]
+        ratio = min(self.input_size / height, self.input_size / width)
+        new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+        pad_x = (self.input_size - new_width) // 2
+        pad_y = (self.input_size - new_height) // 2
+        self._canvas[:] = self.PAD_VALUE
+        self._canvas[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = cv.resize(image, (new_width, new_height), interpolation=cv.INTER_LINEAR)
+        blob = cv.dnn.blobFromImage(self._canvas, 1 / 255.0, swapRB=True)
+        return blob, ratio, pad_x, pad_y
+
+    def predict(self, image):
+        blob, ratio, pad_x, pad_y = self._letterbox(image)
+        # output shape (1, 4 + num_classes, num_anchors) with boxes as (cx, cy, w, h)
+        output = self.session.run(None, {self.input_name: blob})[0][0]
+        return self._postprocess(output, ratio, pad_x, pad_y)
+
+    def predict_batch(self, images):
+        if (not self.dynamic_batch or len(images) <= 1):
+            return [self.predict(image) for image in images]
+        letterboxed = [self._letterbox(image) for image in images]
+        outputs = self.session.run(None, {self.input_name: np.concatenate([blob for blob, ratio, pad_x, pad_y in letterboxed])})[0]
+        return [self._postprocess(outputs[i], ratio, pad_x, pad_y) for i, (blob, ratio, pad_x, pad_y) in enumerate(letterboxed)]
+
+    # filters, NMS and un-letterboxes the model output of one image, shape (4 + num_classes, num_anchors)
+    def _postprocess(self, output, ratio, pad_x, pad_y):
+        output = output.T
+        scores = output[:, 4:]
+        class_id = scores.argmax(axis=1)
+        confidence = scores[np.arange(len(scores)), class_id]
+        keep = confidence >= self.conf
+        output, class_id, confidence = output[keep], class_id[keep], confidence[keep]
+        if (len(output) == 0):
+            return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32)
+
+        xywh = output[:, :4].copy()
+        xywh[:, 0] -= xywh[:, 2] / 2
+        xywh[:, 1] -= xywh[:, 3] / 2
+        offset_xywh = xywh.copy()
+        offset_xywh[:, :2] += class_id[:, None] * self.NMS_CLASS_OFFSET
+        keep = np.array(cv.dnn.NMSBoxes(offset_xywh.tolist(), confidence.tolist(), self.conf, self.iou), dtype=np.int64).reshape(-1)
+
+        # undo the letterbox to get coordinates in the given image
+        xyxy = np.empty((len(keep), 4), dtype=np.float32)
+        xyxy[:, 0] = (xywh[keep, 0] - pad_x) / ratio
+        xyxy[:, 1] = (xywh[keep, 1] - pad_y) / ratio
+        xyxy[:, 2] = (xywh[keep, 0] + xywh[keep, 2] - pad_x) / ratio
+        xyxy[:, 3] = (xywh[keep, 1] + xywh[keep, 3] - pad_y) / ratio
+        return xyxy, confidence[keep].astype(np.float32), class_id[keep].astype(np.int32)
+
+
+# The ONNX Runtime backend on a dynamically quantized INT8 copy of the model.
+# model_path may be the quantized model (*.int8.onnx) or the float ONNX model, see resolve_model_path().
+class OnnxInt8Backend(OnnxRuntimeBackend):
+    name = ONNX_INT8_BACKEND
+    INT8_SUFFIX = ".int8.onnx"
+
+    def __init__(self, model_path, conf=0.5, iou=0.45, num_threads=0):
+        super().__init__(self.resolve_model_path(model_path), conf=conf, iou=iou, num_threads=num_threads)
+
+    # Returns the path of the quantized model for model_path. The float model is quantized (see quantize_onnx()) into
+    # <name>.int8.onnx next to it when that file is missing or older than the float model.
+    @classmethod
+    def resolve_model_path(cls, model_path) -> str:
+        if (model_path.endswith(cls.INT8_SUFFIX)):
+            int8_path = model_path
+            onnx_path = model_path[:-len(cls.INT8_SUFFIX)] + ".onnx"
+        elif (model_path.endswith(".onnx")):
+            onnx_path = model_path
+            int8_path = model_path[:-len(".onnx")] + cls.INT8_SUFFIX
+        else:
+            raise ValueError("The onnx_int8 backend needs an .onnx model, got " + str(model_path))
+        if (not os.path.exists(onnx_path)):
+            return int8_path
+        if ((not os.path.exists(int8_path)) or os.path.getmtime(int8_path) < os.path.getmtime(onnx_path)):
+            print("Quantizing " + onnx_path + " to " + int8_path)
+            quantize_onnx(onnx_path, int8_path)
+        return int8_path
+
+
+# Returns the detector backend with the given name. model_path = None uses the default model for the backend.
+def create_detector_backend(name=ULTRALYTICS_BACKEND, model_path=None, conf=0.5) -> DetectorBackend:
+    if (name not in BACKENDS):
+        raise ValueError("Unknown detector backend: " + str(name) + ". Choose one of " + str(BACKENDS))
+    if (model_path is None):
+        model_path = DEFAULT_MODEL_PATHS[name]
+    if (name == ULTRALYTICS_BACKEND):
+        return UltralyticsBackend(model_path, conf=conf)
+    elif (name == ONNX_BACKEND):
+        return OnnxRuntimeBackend(model_path, conf=conf)
+    return OnnxInt8Backend(model_path, conf=conf)
+
+
+# Exports the Ultralytics weights to ONNX for the onnx backend. Returns the path of the exported model.
+def export_onnx(weights_path=DEFAULT_MODEL_PATHS[ULTRALYTICS_BACKEND], imgsz=640):
+    from ultralytics import YOLO
+    return YOLO(weights_path).export(format="onnx", imgsz=imgsz)
+
+
+# Quantizes the ONNX model weights to INT8 for the onnx_int8 backend. Returns the path of the quantized model.
+def quantize_onnx(onnx_path=DEFAULT_MODEL_PATHS[ONNX_BACKEND], int8_path=DEFAULT_MODEL_PATHS[ONNX_INT8_BACKEND]):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+    return int8_path
+
+
+# Returns the average seconds per image of the backend on the image, predicting batch_size copies at once if above 1
+def benchmark_backend(backend: DetectorBackend, image, num_runs=50, num_warmup=5, batch_size=1) -> float:
+    images = [image] * batch_size
+    for i in range(num_warmup):
+        backend.predict_batch(images) if (batch_size > 1) else backend.predict(image)
+    start = time.perf_counter()
+    for i in range(num_runs):
+        backend.predict_batch(images) if (batch_size > 1) else backend.predict(image)
+    return (time.perf_counter() - start) / (num_runs * batch_size)
+
+
+if __name__ == "__main__":
+    # benchmark the backends on an image: python -m blackjai_server.detection.backends <image> [backend ...]
+    image = cv.imread(sys.argv[1])
+    for name in (sys.argv[2:] if len(sys.argv) > 2 else BACKENDS):
+        backend = create_detector_backend(name)
+        xyxy, confidence, class_id = backend.predict(image)
+        print(f"{name}: {1000 * benchmark_backend(backend, image):.1f} ms/frame, {len(xyxy)} detections, "
+              f"{1000 * benchmark_backend(backend, image, batch_size=4):.1f} ms/frame in batches of 4")
@@ -1,5 +1,6 @@
 import cv2 as cv
-from ultralytics import YOLO
+from blackjai_server.detection.backends import DetectorBackend
+from blackjai_server.detection.results import Detections
 
 
 # Function to detect card type and save the prediction to a buffer image
@@ -29,34 +30,36 @@ def detect_card_type_roboflow(image, model):
         # print()
     return image, json_data
 
-def detect_card_type_yolo(image, model):
+# Detect cards using a YOLO model run by any DetectorBackend (see backends.py)
+# scale maps box coordinates in the given image back to the full resolution frame (see FrameDecoder)
+# annotate=False skips drawing the boxes and returns None in place of the annotated image
+# trace: FrameTrace of the frame (see metrics/trace.py), marked when inference is done
+def detect_card_type_yolo(image, model: DetectorBackend, scale=(1, 1), annotate=True, trace=None) -> tuple[object, Detections]:
     # Get results from yolo prediction
-    results = model.predict(image, conf=0.5, verbose=False)
-    num_detections = len(results[0].boxes.xyxy)
+    xyxy, confidence, class_id = model.predict(image)
+    if (trace is not None):
+        trace.mark("inference")
+    detections = Detections.from_xyxy(xyxy, confidence, class_id, model.names, scale)
 
-    boxes = results[0].boxes
-    json_data = {}
-    if num_detections > 0:
-        json_data["predictions"] = []
-    for i in range(len(results[0].boxes.xyxy)):
-        curr_prediction = {}
-        curr_prediction["class"] = results[0].names[boxes.cls[i].item()]
+    # plot the bounding boxes and labels on a copy, the image may be a pooled decode buffer (see FrameDecoder)
+    annotated_image = model.annotate(image.copy(), xyxy, confidence, class_id) if annotate else None
 
-        x1 = int(boxes.xyxy[i][0].item())
-        y1 = int(boxes.xyxy[i][1].item())
-        x2 = int(boxes.xyxy[i][2].item())
-        y2 = int(boxes.xyxy[i][3].item())
+    return annotated_image, detections
 
-        curr_prediction["x"] = x1
-        curr_prediction["y"] = y1
-        curr_prediction["width"] = x2 - x1
-        curr_prediction["height"] = y2 - y1
 
-        curr_prediction["confidence"] = round(boxes.conf[i].item(), 3)
-
-        json_data["predictions"].append(curr_prediction)
-
-    # plot the bounding boxes and labels on the image
-    annotated_image = results[0].plot()
-
-    return annotated_image, json_data
+# Detect cards in several images with one batched call of the DetectorBackend (see predict_batch())
+# scales holds the coordinate scale of each image, and traces the FrameTrace (or None) of each image if given.
+# annotate is one flag for every image or a list with a flag per image.
+# Returns (annotated_image, detections) for each image.
+def detect_card_type_yolo_batch(images: list, model: DetectorBackend, scales: list, annotate=True, traces: list = None) -> list[tuple[object, Detections]]:
+    annotate = annotate if isinstance(annotate, list) else [annotate] * len(images)
+    predictions = model.predict_batch(images)
+    for trace in (traces if (traces is not None) else []):
+        if (trace is not None):
+            trace.mark("inference")
+    results = []
+    for image, scale, annotate_image, (xyxy, confidence, class_id) in zip(images, scales, annotate, predictions):
+        detections = Detections.from_xyxy(xyxy, confidence, class_id, model.names, scale)
+        annotated_image = model.annotate(image.copy(), xyxy, confidence, class_id) if annotate_image else None
+        results.append((annotated_image, detections))
+    return results
@@ -0,0 +1,73 @@
+import numpy as np
+
+# One record per detected card label. x, y are the top left corner of the box, matching the
+# "x" and "y" of the JSON prediction dicts.
+DETECTION_DTYPE = np.dtype([
+    ("class_id", np.int16),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("w", np.int32),
+    ("h", np.int32),
+    ("confidence", np.float32),
+])
+
+
+"""
+Detections:
+The result of a detection pass, backed by a single structured NumPy array (see DETECTION_DTYPE).
+names maps each class id to its card label (e.g. "AH").
+"""
+class Detections:
+    def __init__(self, data: np.ndarray, names):
+        self.data = data
+        self.names = names
+
+    # Builds the detections from detector backend output in one vectorized conversion.
+    # scale maps box coordinates back to the full resolution frame (see FrameDecoder).
+    @classmethod
+    def from_xyxy(cls, xyxy: np.ndarray, confidence: np.ndarray, class_id: np.ndarray, names, scale=(1, 1)):
+        data = np.empty(len(xyxy), dtype=DETECTION_DTYPE)
+        if (len(xyxy) > 0):
+            xyxy = np.asarray(xyxy, dtype=np.float64) * np.array([scale[0], scale[1], scale[0], scale[1]])
+            corners = xyxy.astype(np.int32)
+            data["class_id"] = class_id
+            data["x"] = corners[:, 0]
+            data["y"] = corners[:, 1]
+            data["w"] = corners[:, 2] - corners[:, 0]
+            data["h"] = corners[:, 3] - corners[:, 1]
+            data["confidence"] = np.round(confidence, 3)
+        return cls(data, names)
+
+    # Adapter for the JSON prediction dicts returned by the Roboflow path
+    @classmethod
+    def from_json(cls, json_data: dict):
+        predictions = json_data.get("predictions", [])
+        names = sorted(set(prediction["class"] for prediction in predictions))
+        class_ids = {name: i for i, name in enumerate(names)}
+        data = np.empty(len(predictions), dtype=DETECTION_DTYPE)
+        for i, prediction in enumerate(predictions):
+            data[i] = (class_ids[prediction["class"]], int(prediction["x"]), int(prediction["y"]),
+                       int(prediction["width"]), int(prediction["height"]), prediction["confidence"])
+        return cls(data, names)
+
+    # Returns the detections in the JSON prediction dict form
+    def to_json(self) -> dict:
+        json_data = {}
+        if (len(self.data) > 0):
+            json_data["predictions"] = [{"class": self.names[class_id], "x": x, "y": y, "width": w, "height": h,
+                                         "confidence": round(confidence, 3)}
+                                        for class_id, x, y, w, h, confidence in self.data.tolist()]
+        return json_data
+
+    # Returns the card label of each detection
+    def get_labels(self) -> list[str]:
+        return [self.names[class_id] for class_id in self.data["class_id"].tolist()]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        return str(self.to_json())
+
+    def __repr__(self):
+        return str(self.to_json())
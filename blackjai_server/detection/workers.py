@@ -0,0 +1,306 @@
+import asyncio
+import itertools
+import queue
+import threading
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from blackjai_server.detection.backends import DetectionAnnotator, create_detector_backend
+from blackjai_server.detection.results import Detections
+
+"""
+Process pool inference. Decoded frames are copied into a ring of shared memory slots, and a pool of worker processes,
+each holding its own detector backend, reads them straight out of the slots. Only the slot index goes to a worker and
+only the small detection arrays come back, so frames are never pickled, and torch / ONNX Runtime work runs outside the
+server process where it does not compete with the engine and egress for the GIL. The engine stays in the server process.
+"""
+
+
+"""
+SharedFrameRing:
+num_slots uint8 frames of up to slot_size bytes in one multiprocessing.shared_memory block.
+The process creating the ring owns it and unlinks it on close(). Other processes attach by name.
+"""
+class SharedFrameRing:
+    def __init__(self, num_slots: int, slot_size: int, name: str = None):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.owner = name is None
+        if (self.owner):
+            self.shm = shared_memory.SharedMemory(create=True, size=num_slots * slot_size)
+        else:
+            # spawned workers share the owner's resource tracker, so attaching does not register the block twice
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buffer = np.ndarray((num_slots, slot_size), dtype=np.uint8, buffer=self.shm.buf)
+
+    # Returns the frame of the given shape in the slot, without copying
+    def get_view(self, slot: int, shape: tuple) -> np.ndarray:
+        return self.buffer[slot, :int(np.prod(shape))].reshape(shape)
+
+    # Copies the frame into the slot
+    def write(self, slot: int, image: np.ndarray):
+        if (image.dtype != np.uint8 or image.nbytes > self.slot_size):
+            raise ValueError("SharedFrameRing frames must be uint8 and at most " + str(self.slot_size) + " bytes, got "
+                             + str(image.dtype) + " " + str(image.shape))
+        np.copyto(self.get_view(slot, image.shape), image)
+
+    def close(self):
+        self.buffer = None
+        self.shm.close()
+        if (self.owner):
+            self.shm.unlink()
+
+
+# Worker process: loads the backend once, then detects the frames named by its tasks until it gets None.
+# Messages put on results are ("ready", None, names), ("result", task_id, (xyxy, confidence, class_id)) or
+# ("error", task_id, traceback), with task_id None for an error loading the backend.
+def _inference_worker(create_backend, backend_name, model_path, conf, tasks, results):
+    try:
+        model = create_backend(backend_name, model_path, conf=conf)
+    except Exception:
+        results.put(("error", None, traceback.format_exc()))
+        return
+    results.put(("ready", None, model.names))
+    ring = None
+    while True:
+        task = tasks.get()
+        if (task is None):
+            break
+        ring_name, num_slots, slot_size, slot, shape, task_id = task
+        try:
+            if (ring is None or ring.name != ring_name):
+                if (ring is not None):
+                    ring.close()
+                ring = SharedFrameRing(num_slots, slot_size, name=ring_name)
+            results.put(("result", task_id, model.predict(ring.get_view(slot, shape))))
+        except Exception:
+            results.put(("error", task_id, traceback.format_exc()))
+    if (ring is not None):
+        ring.close()
+
+
+"""
+InferencePool:
+Runs num_workers inference worker processes (spawned, so no torch or ZMQ state is forked) sharing a SharedFrameRing
+of num_slots frames, two per worker by default. The ring is sized by the first frame and replaced by a larger one when
+a larger frame arrives; the old ring is closed once the frames in flight in it are done. Each frame goes to the live
+worker with the fewest frames in flight, on that worker's own task queue, so the pool knows which frames a worker
+holds: when the results thread sees a worker exit, its frames are handed to the other workers, and detect() raises
+once every worker has exited. detect() has the same contract as DetectionBatcher.detect(), so tasks can use either.
+create_backend is a picklable function with the signature of create_detector_backend().
+"""
+class InferencePool:
+    # seconds between checks of the worker processes
+    MONITOR_INTERVAL = 1.0
+
+    def __init__(self, num_workers: int, backend_name: str, model_path=None, conf=0.5, num_slots=0, annotate=True,
+                 create_backend=create_detector_backend):
+        if (num_workers < 1):
+            raise ValueError("InferencePool num_workers must be at least 1")
+        self.num_workers = num_workers
+        self.num_slots = num_slots if (num_slots > 0) else 2 * num_workers
+        self.annotate = annotate
+        self.ring = None
+        self.error = None
+        self.num_ready = 0
+        self.num_failed = 0
+        self.num_died = 0
+        self.num_resubmitted = 0
+        self.num_detected = 0
+        # only draws the boxes, with the class names sent by the workers
+        self.annotator = DetectionAnnotator()
+        context = mp.get_context("spawn")
+        self._task_queues = [context.Queue() for i in range(num_workers)]
+        self._results = context.Queue()
+        self._workers = [context.Process(target=_inference_worker, name=f"inference-{i}", daemon=True,
+                                         args=(create_backend, backend_name, model_path, conf, self._task_queues[i], self._results))
+                         for i in range(num_workers)]
+        self._task_ids = itertools.count()
+        # task_id -> (future, slot, task, ring, worker index) of the frames in flight, only used on the event loop
+        self._pending = {}
+        self._live_workers = set(range(num_workers))
+        # rings replaced by a larger one, closed once no frame in flight uses them
+        self._retired_rings = []
+        # workers seen exiting by the results thread
+        self._exited = set()
+        self._closing = False
+        self._free_slots = None
+        self._loop = None
+        self._reader = threading.Thread(target=self._read_results, name="inference-results", daemon=True)
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        self._reader.start()
+
+    # Detects cards in the image on a worker process. scale maps its coordinates to the full resolution frame, trace is
+    # the frame's FrameTrace or None, and annotate overrides the pool's annotate for this image (e.g. a previewed frame).
+    # Returns (annotated_image, detections) like detect_card_type_yolo().
+    async def detect(self, image, scale=(1, 1), trace=None, annotate=None):
+        if (self.error is not None):
+            raise self.error
+        if (self._free_slots is None):
+            self._loop = asyncio.get_running_loop()
+            self._free_slots = asyncio.Queue()
+            for slot in range(self.num_slots):
+                self._free_slots.put_nowait(slot)
+        slot = await self._free_slots.get()
+        if (self.ring is None or image.nbytes > self.ring.slot_size):
+            self._replace_ring(image.nbytes)
+        try:
+            self.ring.write(slot, image)
+        except Exception:
+            self._free_slots.put_nowait(slot)
+            raise
+        task_id = next(self._task_ids)
+        future = self._loop.create_future()
+        task = (self.ring.name, self.ring.num_slots, self.ring.slot_size, slot, image.shape, task_id)
+        self._submit(task_id, future, slot, task, self.ring)
+        if (self.error is not None):
+            self._fail_pending()
+        xyxy, confidence, class_id = await future
+        if (trace is not None):
+            trace.mark("inference")
+        detections = Detections.from_xyxy(xyxy, confidence, class_id, self.annotator.names, scale)
+        annotate = self.annotate if (annotate is None) else annotate
+        # the image may be a pooled decoder buffer that is reused for a later frame, so draw on a copy
+        annotated_image = self.annotator.annotate(image.copy(), xyxy, confidence, class_id) if annotate else None
+        return annotated_image, detections
+
+    # Queues the task on the live worker with the fewest frames in flight
+    def _submit(self, task_id, future, slot, task, ring):
+        if (len(self._live_workers) == 0):
+            self._pending[task_id] = (future, slot, task, ring, None)
+            return
+        num_in_flight = {index: 0 for index in self._live_workers}
+        for entry in self._pending.values():
+            if (entry[4] in num_in_flight):
+                num_in_flight[entry[4]] += 1
+        index = min(num_in_flight, key=num_in_flight.get)
+        self._pending[task_id] = (future, slot, task, ring, index)
+        self._task_queues[index].put(task)
+
+    # Replaces the ring by one with slots of slot_size bytes. Frames in flight keep the old ring until they are done.
+    def _replace_ring(self, slot_size: int):
+        if (self.ring is not None):
+            print("Inference pool: " + str(slot_size) + " byte frame is larger than the " + str(self.ring.slot_size)
+                  + " byte slots, allocating a larger ring")
+            self._retired_rings.append(self.ring)
+            self._close_retired_rings()
+        self.ring = SharedFrameRing(self.num_slots, slot_size)
+
+    def _close_retired_rings(self):
+        in_use = {id(entry[3]) for entry in self._pending.values()}
+        for ring in [ring for ring in self._retired_rings if id(ring) not in in_use]:
+            self._retired_rings.remove(ring)
+            ring.close()
+
+    # Reads the worker messages on a thread and hands them to the event loop, checking for workers that exited
+    def _read_results(self):
+        last_check = time.monotonic()
+        while True:
+            try:
+                message = self._results.get(timeout=self.MONITOR_INTERVAL)
+            except queue.Empty:
+                message = False
+            if (time.monotonic() - last_check >= self.MONITOR_INTERVAL):
+                self._check_workers()
+                last_check = time.monotonic()
+            if (message is None):
+                break
+            if (message is False):
+                continue
+            kind, task_id, value = message
+            if (kind == "ready"):
+                self.annotator.names = value
+                self.num_ready += 1
+            elif (task_id is None):
+                print("Error: inference worker failed to start\n" + value)
+                self.num_failed += 1
+                if (self.num_failed == self.num_workers):
+                    self.error = RuntimeError("All inference workers failed to start")
+                    self._call_soon(self._fail_pending)
+            else:
+                self._call_soon(self._on_result, kind, task_id, value)
+
+    # Looks for workers that exited while the pool is running and hands their frames to the event loop
+    def _check_workers(self):
+        if (self._closing):
+            return
+        for index, worker in enumerate(self._workers):
+            if (index in self._exited or worker.exitcode is None):
+                continue
+            self._exited.add(index)
+            if (worker.exitcode != 0):
+                self.num_died += 1
+                print("Error: inference worker " + worker.name + " died with exit code " + str(worker.exitcode))
+            self._call_soon(self._on_worker_exit, index)
+
+    # Runs the function on the event loop from the results thread
+    def _call_soon(self, func, *args):
+        if (self._loop is None):
+            return
+        try:
+            self._loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:
+            # the event loop has closed, nothing awaits the result anymore
+            pass
+
+    # Hands the frames of a worker that exited to the other workers (their slots still hold the frames),
+    # or fails every frame in flight if no worker is left
+    def _on_worker_exit(self, index):
+        self._live_workers.discard(index)
+        if (len(self._live_workers) == 0):
+            if (self.error is None):
+                self.error = RuntimeError("All inference workers exited")
+            self._fail_pending()
+            return
+        for task_id, (future, slot, task, ring, worker) in list(self._pending.items()):
+            if (worker == index):
+                self.num_resubmitted += 1
+                self._submit(task_id, future, slot, task, ring)
+
+    def _on_result(self, kind, task_id, value):
+        if (task_id not in self._pending):
+            return
+        future, slot, task, ring, worker = self._pending.pop(task_id)
+        # the worker is done with the slot
+        self._free_slots.put_nowait(slot)
+        if (len(self._retired_rings) > 0):
+            self._close_retired_rings()
+        if (future.done()):
+            return
+        if (kind == "error"):
+            future.set_exception(RuntimeError("Error in inference worker:\n" + value))
+        else:
+            self.num_detected += 1
+            future.set_result(value)
+
+    def _fail_pending(self):
+        for future, slot, task, ring, worker in self._pending.values():
+            if (not future.done()):
+                future.set_exception(self.error)
+
+    def close(self, timeout=2.0):
+        self._closing = True
+        for task_queue in self._task_queues:
+            task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=timeout)
+            if (worker.is_alive()):
+                worker.terminate()
+        self._results.put(None)
+        self._reader.join(timeout=timeout)
+        if (self.ring is not None):
+            self.ring.close()
+            self.ring = None
+        for ring in self._retired_rings:
+            ring.close()
+        self._retired_rings = []
+
+    def __str__(self):
+        return (f"Inference pool: {self.num_ready}/{self.num_workers} workers ready, {self.num_died} died, "
+                f"{self.num_detected} frames detected, {self.num_resubmitted} resubmitted, {len(self._pending)} in flight")
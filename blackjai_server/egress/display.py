@@ -0,0 +1,67 @@
+import threading
+import cv2 as cv
+
+
+"""
+DisplayWindows:
+Shows images in OpenCV windows from one dedicated thread, so imshow() and waitKey() (which can block, and which
+HighGUI wants on a single thread) never run on the event loop or a stage of the pipeline. show() only hands the
+image over: each window keeps just its newest image, replacing one the display thread has not shown yet.
+"""
+class DisplayWindows:
+    # longest wait for a new image, so close() is noticed
+    POLL_TIMEOUT = 0.5
+
+    def __init__(self):
+        self.num_shown = 0
+        self.num_replaced = 0
+        self._lock = threading.Lock()
+        self._images = {}
+        self._ready = threading.Event()
+        # set while every image handed over has been shown (and its waitKey() returned)
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="display", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    # Shows the image in the named window. delay is passed to waitKey(), 0 waits for a key press.
+    def show(self, name: str, image, delay=1):
+        with self._lock:
+            if (name in self._images):
+                self.num_replaced += 1
+            self._images[name] = (image, delay)
+            self._idle.clear()
+            self._ready.set()
+
+    # Waits until the images handed over have been shown, e.g. for a key press on a window shown with delay 0
+    def wait_idle(self, timeout=None) -> bool:
+        return self._idle.wait(timeout=timeout)
+
+    def _run(self):
+        while (not self._stop):
+            if (not self._ready.wait(timeout=self.POLL_TIMEOUT)):
+                continue
+            with self._lock:
+                images, self._images = self._images, {}
+                self._ready.clear()
+            for name, (image, delay) in images.items():
+                cv.imshow(name, image)
+                self.num_shown += 1
+            cv.waitKey(0 if any(delay == 0 for image, delay in images.values()) else 1)
+            with self._lock:
+                if (len(self._images) == 0):
+                    self._idle.set()
+        cv.destroyAllWindows()
+
+    def close(self, timeout=1.0):
+        self._stop = True
+        self._ready.set()
+        self._idle.set()
+        if (self._thread.is_alive()):
+            self._thread.join(timeout=timeout)
+
+    def __str__(self):
+        return f"Display: {self.num_shown} shown, {self.num_replaced} replaced"
@@ -0,0 +1,319 @@
+import abc
+import socket
+import threading
+import time
+import queue
+import traceback
+
+from blackjai_server.egress.wire import create_payload_encoder, JSON_FORMAT, MAX_DATAGRAM_SIZE
+from blackjai_server.pipeline.pipeline import BoundedQueue, LATEST_WINS
+
+"""
+Egress fan-out: sends every engine payload to any number of targets from a background thread.
+The processing thread only hands the payload over (publish() never blocks or encodes), and if the egress thread falls
+behind only the newest payload is kept. Payloads equal to the previous one are coalesced away, and each target has its
+own max rate: a payload arriving too soon after the last send is held and sent once the target's interval has passed,
+replaced by any newer payload in the meantime. As coalescing can hold back every payload while the table is idle, the
+last payload is sent again as a keyframe to any target that has not had one for keyframe_period seconds, so a client
+that lost a message or just joined catches up.
+"""
+
+
+"""
+EgressTarget:
+Base class for a destination of the payloads. Each target encodes with its own encoder, so binary deltas are relative
+to what that target was actually sent. max_rate is the most messages per second (0 is unlimited).
+"""
+class EgressTarget(abc.ABC):
+    def __init__(self, name: str, payload_format=JSON_FORMAT, max_rate=0, num_decks=1, keyframe_interval=30):
+        self.name = name
+        self.encoder = create_payload_encoder(payload_format, num_decks, keyframe_interval)
+        self.min_interval = 1 / max_rate if (max_rate > 0) else 0
+        self.num_sent = 0
+        self.num_limited = 0
+        self.pending = None
+        self.last_send = 0.0
+        # time the last keyframe was sent, 0 until the first one
+        self.last_keyframe = 0.0
+        # serialize and send latencies are recorded here when set (see EgressHub)
+        self.metrics = None
+
+    # Makes the next message a keyframe and sends the hub's last payload again when it comes around (see EgressHub)
+    def request_keyframe(self):
+        self.encoder.request_keyframe()
+        self.last_keyframe = 0.0
+
+    # Returns the time the pending payload may be sent at
+    def get_due_time(self) -> float:
+        return self.last_send + self.min_interval
+
+    # Holds the payload and sends it if the rate limit allows. Returns true if it was sent.
+    def offer(self, payload: dict, now: float) -> bool:
+        if (self.pending is not None):
+            self.num_limited += 1
+        self.pending = payload
+        return self.flush(now)
+
+    # Sends the pending payload if it is due
+    def flush(self, now: float) -> bool:
+        if (self.pending is None or now < self.get_due_time()):
+            return False
+        payload, self.pending = self.pending, None
+        num_keyframes = self.encoder.num_keyframes
+        start = time.perf_counter()
+        message = self.encode(payload)
+        if (message is None):
+            return False
+        if (self.metrics is None):
+            self.send(message)
+        else:
+            start = self.metrics.record_since("serialize", start)
+            self.send(message)
+            self.metrics.record_since("send", start)
+        if (self.encoder.num_keyframes != num_keyframes):
+            self.last_keyframe = now
+        self.last_send = now
+        self.num_sent += 1
+        return True
+
+    # Returns the message for the payload, or None if it cannot be sent
+    def encode(self, payload: dict) -> bytes:
+        return self.encoder.encode(payload)
+
+    @abc.abstractmethod
+    def send(self, message: bytes):
+        pass
+
+    # Handles what the clients sent since the last call, e.g. a new subscriber asking for the state. Called by the
+    # egress thread every time it wakes up.
+    def poll(self):
+        pass
+
+    # Opens the connection to the client again
+    def reconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return f"{self.name}: {self.num_sent} sent, {self.num_limited} rate limited"
+
+
+# Optional payload fields left out, in order, until a JSON payload fits in one datagram: (field, field inside it or None)
+OPTIONAL_FIELDS = [("ev", None), ("trace", None), ("count_systems", "deck_dict")]
+
+
+# Returns a copy of the payload without the field
+def _without_field(payload: dict, field: str, subfield: str = None) -> dict:
+    payload = {key: value for key, value in payload.items() if key != field or subfield is not None}
+    if (subfield is not None and isinstance(payload.get(field), dict)):
+        payload[field] = {key: value for key, value in payload[field].items() if key != subfield}
+    return payload
+
+
+# Sends each payload as one UDP datagram to host:port. A datagram larger than one MTU would be fragmented, and lost
+# whole if any fragment is lost, so JSON payloads drop their optional fields until they fit. Payloads that still do
+# not fit are not sent and are counted in num_oversized (and the "egress_oversized" counter of the metrics).
+class UdpTarget(EgressTarget):
+    def __init__(self, host: str, port: int, payload_format=JSON_FORMAT, max_rate=0, num_decks=1, keyframe_interval=30):
+        super().__init__(f"udp://{host}:{port}", payload_format, max_rate, num_decks, keyframe_interval)
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.num_trimmed = 0
+        self.num_oversized = 0
+
+    def encode(self, payload: dict) -> bytes:
+        message = self.encoder.encode(payload)
+        if (len(message) <= MAX_DATAGRAM_SIZE):
+            return message
+        if (self.encoder.name == JSON_FORMAT):
+            for field, subfield in OPTIONAL_FIELDS:
+                payload = _without_field(payload, field, subfield)
+                message = self.encoder.encode(payload)
+                if (len(message) <= MAX_DATAGRAM_SIZE):
+                    self.num_trimmed += 1
+                    return message
+        else:
+            # the client misses this delta, start again from a keyframe
+            self.encoder.request_keyframe()
+        self.num_oversized += 1
+        if (self.metrics is not None):
+            self.metrics.increment("egress_oversized")
+        if (self.num_oversized == 1):
+            print("Warning: " + str(len(message)) + " byte payload to " + self.name + " does not fit in one MTU, not sent")
+        return None
+
+    def send(self, message: bytes):
+        self.socket.sendto(message, self.address)
+
+    def reconnect(self):
+        self.socket.close()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def close(self):
+        self.socket.close()
+
+    def __str__(self):
+        return super().__str__() + f", {self.num_trimmed} trimmed, {self.num_oversized} too large"
+
+
+# Publishes each payload on a ZMQ XPUB socket bound to address (e.g. "tcp://*:5600") as a [topic, message] multipart
+# message. Any number of clients can subscribe to the topic. Messages to slow subscribers are dropped by ZMQ.
+# A PUB socket cannot tell when a client joins, so the XPUB socket's subscription messages are read instead and every
+# new subscription makes the next message a keyframe, which the hub sends right away with the last payload.
+class ZmqPubTarget(EgressTarget):
+    def __init__(self, address: str, payload_format=JSON_FORMAT, max_rate=0, num_decks=1, keyframe_interval=30, topic=b"blackjai"):
+        super().__init__(f"zmq+{address}", payload_format, max_rate, num_decks, keyframe_interval)
+        import zmq
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.XPUB)
+        self.socket.setsockopt(zmq.SNDHWM, 2)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # pass on every subscription, not only the first one to the topic
+        self.socket.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self.socket.bind(address)
+        self.topic = topic
+        self.num_subscribed = 0
+        self._noblock = zmq.NOBLOCK
+        self._again = zmq.Again
+
+    def send(self, message: bytes):
+        self.socket.send_multipart([self.topic, message], flags=self._noblock)
+
+    # Reads the subscription messages: 1 followed by the topic for a subscribe, 0 for an unsubscribe
+    def poll(self):
+        while True:
+            try:
+                event = self.socket.recv(flags=self._noblock)
+            except self._again:
+                return
+            if (len(event) > 0 and event[0] == 1 and self.topic.startswith(event[1:])):
+                self.num_subscribed += 1
+                self.request_keyframe()
+
+    def close(self):
+        self.socket.close()
+
+    def __str__(self):
+        return super().__str__() + f", {self.num_subscribed} subscribed"
+
+
+# Returns true if the payloads are equal apart from their frame traces, which differ for every frame
+def _same_state(payload: dict, last_payload: dict) -> bool:
+    if (last_payload is None or len(payload) != len(last_payload)):
+        return False
+    if ("trace" not in payload):
+        return payload == last_payload
+    return all(key == "trace" or last_payload.get(key) == value for key, value in payload.items())
+
+
+"""
+EgressHub:
+Runs the targets on a daemon thread. publish() is called from the processing thread for every payload.
+The targets record their serialize and send latencies in metrics, if given. A target that has not sent a keyframe
+for keyframe_period seconds (0 disables) is sent the last payload again as a keyframe.
+"""
+class EgressHub:
+    # longest wait for a new payload, so stop() is noticed
+    POLL_TIMEOUT = 0.5
+
+    def __init__(self, targets: list[EgressTarget], metrics=None, keyframe_period=1.0):
+        self.metrics = metrics
+        self.keyframe_period = keyframe_period
+        self.targets = []
+        for target in targets:
+            self.add_target(target)
+        self.num_published = 0
+        self.num_coalesced = 0
+        self.num_refreshed = 0
+        self.error = None
+        self._queue = BoundedQueue(maxsize=1, policy=LATEST_WINS)
+        self._last_payload = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="egress", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        self._thread.join(timeout=timeout)
+        for target in self.targets:
+            target.close()
+
+    # Adds a target, which is sent the last payload as a keyframe right away. Safe to call while the hub is running.
+    def add_target(self, target: EgressTarget):
+        target.metrics = self.metrics
+        target.request_keyframe()
+        # replaced rather than appended, so the egress thread keeps iterating over a consistent list
+        self.targets = self.targets + [target]
+
+    # Reconnects a target whose client went away (e.g. a new socket to a restarted phone app) and resends the state
+    def reconnect_target(self, target: EgressTarget):
+        target.reconnect()
+        target.request_keyframe()
+
+    # Hands the payload to the egress thread. Never blocks: a payload not yet picked up is replaced.
+    def publish(self, payload: dict):
+        if (payload is not None):
+            self._queue.put(payload)
+
+    # number of payloads replaced by a newer one before the egress thread picked them up
+    def get_num_dropped(self) -> int:
+        return self._queue.num_dropped
+
+    def _get_timeout(self, now: float) -> float:
+        timeout = self.POLL_TIMEOUT
+        for target in self.targets:
+            if (target.pending is not None):
+                timeout = min(timeout, max(target.get_due_time() - now, 0))
+            elif (self.keyframe_period > 0 and self._last_payload is not None):
+                timeout = min(timeout, max(target.last_keyframe + self.keyframe_period - now, 0))
+        return timeout
+
+    # Sends the last payload again as a keyframe to the targets that have not sent one for keyframe_period
+    def _refresh_keyframes(self, now: float):
+        if (self.keyframe_period <= 0 or self._last_payload is None):
+            return
+        for target in self.targets:
+            if (target.pending is None and now - target.last_keyframe >= self.keyframe_period):
+                target.request_keyframe()
+                # the frame trace belongs to the frame that was published, not to this resend
+                target.offer({key: value for key, value in self._last_payload.items() if key != "trace"}, now)
+                self.num_refreshed += 1
+
+    def _run(self):
+        while (not self._stop_event.is_set()):
+            try:
+                payload = self._queue.get(timeout=self._get_timeout(time.monotonic()))
+            except queue.Empty:
+                payload = None
+            try:
+                now = time.monotonic()
+                if (payload is not None):
+                    if (_same_state(payload, self._last_payload)):
+                        self.num_coalesced += 1
+                        payload = None
+                    else:
+                        self._last_payload = payload
+                        self.num_published += 1
+                for target in self.targets:
+                    target.poll()
+                    if (payload is not None):
+                        target.offer(payload, now)
+                    else:
+                        target.flush(now)
+                self._refresh_keyframes(now)
+            except Exception as ex:
+                # keep serving the other targets, report the error with the stats
+                self.error = ex
+                traceback.print_exc()
+
+    def __str__(self):
+        return (f"Egress: {self.num_published} published, {self.num_coalesced} coalesced, {self.get_num_dropped()} dropped, "
+                f"{self.num_refreshed} keyframes resent | "
+                + " | ".join(str(target) for target in self.targets))
+
+    def __repr__(self):
+        return self.__str__()
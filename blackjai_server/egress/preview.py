@@ -0,0 +1,49 @@
+import os
+import cv2 as cv
+
+
+"""
+PreviewSink:
+A low rate preview of the annotated feed for headless servers.
+Every Nth frame is written to <directory>/latest.jpg (or file_name) (replaced atomically so a local viewer
+can poll the file), and optionally kept as a numbered snapshot as well.
+every_n = 0 disables the preview.
+"""
+class PreviewSink:
+    FILE_NAME = "latest.jpg"
+
+    def __init__(self, every_n=0, directory=None, keep_snapshots=False, file_name=FILE_NAME):
+        if (every_n < 0):
+            raise ValueError("PreviewSink every_n must be 0 (disabled) or positive")
+        self.every_n = every_n
+        self.directory = directory if (directory is not None) else f"{os.getcwd()}/blackjai_server/data/previews"
+        self.keep_snapshots = keep_snapshots
+        self.file_name = file_name
+        self.num_frames = 0
+        self.num_written = 0
+        if (self.every_n > 0):
+            os.makedirs(self.directory, exist_ok=True)
+
+    def is_enabled(self) -> bool:
+        return self.every_n > 0
+
+    # Counts a frame and returns true if this frame should be previewed.
+    # Callers only need to render an annotated image for frames where this returns true.
+    def tick(self) -> bool:
+        if (self.every_n == 0):
+            return False
+        due = (self.num_frames % self.every_n) == 0
+        self.num_frames += 1
+        return due
+
+    # Writes the image as the latest preview
+    def write(self, image):
+        if (image is None):
+            return
+        path = os.path.join(self.directory, self.file_name)
+        tmp_path = path + ".tmp.jpg"
+        cv.imwrite(tmp_path, image)
+        os.replace(tmp_path, path)
+        if (self.keep_snapshots):
+            cv.imwrite(os.path.join(self.directory, f"{self.num_written:08d}.jpg"), image)
+        self.num_written += 1
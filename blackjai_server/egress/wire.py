@@ -0,0 +1,341 @@
+import json
+import struct
+import numpy as np
+
+from blackjai_server.engine.models import BasicStrategy, CARD_IDS, CARD_TYPES, COUNT_SYSTEMS
+from blackjai_server.engine.state import SHUFFLE_PHASE, DEAL_PHASE, TURN_PHASE
+
+"""
+Wire formats for the engine payload sent to the clients.
+json:   the payload as compact JSON (orjson if it is installed).
+binary: a compact encoding of the game state. Cards are byte IDs (index into CARD_TYPES) and the seen cards are a
+        52 bit bitmap per deck. A keyframe carries the whole state and is followed by delta messages that only carry
+        the sections that changed since the previous message. Composition EVs are only sent in the json format.
+
+Binary message layout (little endian):
+    header:   magic "BJ", format version u8, message type u8 (KEYFRAME or DELTA), message sequence u16,
+              state version u32, sections u8 (bitmask of the sections that follow, in bit order)
+    PHASE:    phase u8
+    SEEN:     keyframe: number of decks u8, 7 byte bitmap per deck (bit i of deck d: card i was seen more than d times)
+              delta: number of newly seen cards u8, card ID u8 each
+    COUNTS:   number of systems u8, running count * 2 as i16 per system (COUNT_SYSTEMS order)
+    HANDS:    number of seats u8 (dealer first, then the players), per seat: number of hands u8,
+              per hand: number of cards u8, card ID u8 each
+    ACTIONS:  number of players u8, per player: number of hands u8, action u8 per hand (index into WIRE_ACTIONS)
+    BET:      recommended bet u16
+    TRACE:    frame trace (only in messages of traced payloads): frame sequence u32, receive time f64 (seconds since
+              the epoch), then the decode, inference and engine times as u32 microseconds after the receive time
+              (0xFFFFFFFF if not marked). Not part of the state, so every message carries its own.
+"""
+
+JSON_FORMAT = "json"
+BINARY_FORMAT = "binary"
+PAYLOAD_FORMATS = [JSON_FORMAT, BINARY_FORMAT]
+
+# Largest datagram that fits in one Ethernet MTU without fragmenting (1500 - IP and UDP headers)
+MAX_DATAGRAM_SIZE = 1472
+
+MAGIC = b"BJ"
+WIRE_VERSION = 1
+KEYFRAME = 0
+DELTA = 1
+HEADER = struct.Struct("<2sBBHIB")
+COUNTS = struct.Struct("<B" + str(len(COUNT_SYSTEMS)) + "h")
+
+# Sections of a binary message
+PHASE_SECTION = 1
+SEEN_SECTION = 2
+COUNTS_SECTION = 4
+HANDS_SECTION = 8
+ACTIONS_SECTION = 16
+BET_SECTION = 32
+TRACE_SECTION = 64
+
+WIRE_PHASES = [SHUFFLE_PHASE, DEAL_PHASE, TURN_PHASE]
+WIRE_ACTIONS = [BasicStrategy.H_, BasicStrategy.S_, BasicStrategy.DH, BasicStrategy.DS, BasicStrategy.RH, BasicStrategy.P_,
+                BasicStrategy.PH, BasicStrategy.PD, BasicStrategy.RS, BasicStrategy.BJ, BasicStrategy.BS, BasicStrategy.ER]
+WIRE_ACTION_INDEX = {action: i for i, action in enumerate(WIRE_ACTIONS)}
+BITMAP_SIZE = 7
+TRACE = struct.Struct("<Id3I")
+TRACE_STAGES = ["decode", "inference", "engine"]
+NOT_MARKED = 0xFFFFFFFF
+
+
+def _encode_trace(trace: dict) -> bytes:
+    receive = trace["receive"]
+    offsets = [min(max(round(1e6 * (trace[stage] - receive)), 0), NOT_MARKED - 1) if (stage in trace) else NOT_MARKED
+               for stage in TRACE_STAGES]
+    return TRACE.pack(trace["seq"] & 0xFFFFFFFF, receive, *offsets)
+
+
+def _decode_trace(message: bytes, offset: int) -> dict:
+    seq, receive, *offsets = TRACE.unpack_from(message, offset)
+    trace = {"seq": seq, "receive": receive}
+    for stage, offset_us in zip(TRACE_STAGES, offsets):
+        if (offset_us != NOT_MARKED):
+            trace[stage] = round(receive + offset_us / 1e6, 6)
+    return trace
+
+
+"""
+JsonPayloadEncoder:
+Encodes payloads as compact JSON.
+"""
+class JsonPayloadEncoder:
+    name = JSON_FORMAT
+
+    def __init__(self):
+        # every JSON message carries the whole state
+        self.num_keyframes = 0
+        try:
+            import orjson
+            self._dumps = lambda payload: orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+        except ImportError:
+            encoder = json.JSONEncoder(separators=(",", ":"), check_circular=False)
+            self._dumps = lambda payload: encoder.encode(payload).encode("utf-8")
+
+    # Every message is a keyframe, nothing to force
+    def request_keyframe(self):
+        pass
+
+    def encode(self, payload: dict) -> bytes:
+        self.num_keyframes += 1
+        return self._dumps(payload)
+
+
+# Returns the seen cards of the deck_dict as one 52 bit bitmap per deck
+def _seen_bitmaps(deck_dict: dict[str, int], num_decks: int) -> bytes:
+    data = bytearray()
+    for deck in range(num_decks):
+        bits = 0
+        for card, times in deck_dict.items():
+            if (times > deck):
+                bits |= 1 << CARD_IDS[card]
+        data.extend(bits.to_bytes(BITMAP_SIZE, "little"))
+    return bytes(data)
+
+
+def _encode_hands(payload: dict) -> bytes:
+    seats = [payload["dealer"]] + payload["players"]
+    data = bytearray([len(seats)])
+    for seat in seats:
+        data.append(len(seat["hands"]))
+        for hand in seat["hands"]:
+            data.append(len(hand))
+            data.extend(CARD_IDS[card] for card in hand)
+    return bytes(data)
+
+
+def _encode_actions(actions: list[list[str]]) -> bytes:
+    data = bytearray([len(actions)])
+    for action_list in actions:
+        data.append(len(action_list))
+        data.extend(WIRE_ACTION_INDEX[action] for action in action_list)
+    return bytes(data)
+
+
+"""
+BinaryPayloadEncoder:
+Encodes payloads in the binary format. Sends a keyframe every keyframe_interval messages, and whenever a delta
+cannot describe the change (the shoe was reset), and deltas in between.
+"""
+class BinaryPayloadEncoder:
+    name = BINARY_FORMAT
+
+    def __init__(self, num_decks=1, keyframe_interval=30):
+        self.num_decks = num_decks
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.num_keyframes = 0
+        self._since_keyframe = keyframe_interval
+        # (deck_dict, sections) of the last message and the state version they were encoded from
+        self._last = None
+        self._last_version = None
+        self._last_extras = None
+
+    # Forces the next message to be a keyframe, e.g. when a new client subscribes
+    def request_keyframe(self):
+        self._since_keyframe = self.keyframe_interval
+
+    # Encodes the phase, counts and hands, which only change with the state version
+    def _encode_state(self, payload: dict) -> dict[int, bytes]:
+        count_systems = payload["count_systems"]
+        return {
+            PHASE_SECTION: bytes([WIRE_PHASES.index(payload["phase"])]),
+            COUNTS_SECTION: COUNTS.pack(len(COUNT_SYSTEMS), *[round(2 * count_systems.get("count_" + system, 0)) for system in COUNT_SYSTEMS]),
+            HANDS_SECTION: _encode_hands(payload),
+        }
+
+    def encode(self, payload: dict) -> bytes:
+        deck_dict = payload["count_systems"]["deck_dict"]
+        version = payload.get("version")
+        same_state = self._last is not None and version is not None and version == self._last_version
+        extras = (payload.get("actions"), payload.get("recommended_bet"))
+        if (same_state and extras == self._last_extras and self._since_keyframe < self.keyframe_interval):
+            # nothing changed, send an empty delta
+            self._since_keyframe += 1
+            self.seq += 1
+            if ("trace" in payload):
+                return HEADER.pack(MAGIC, WIRE_VERSION, DELTA, (self.seq - 1) & 0xFFFF, version & 0xFFFFFFFF, TRACE_SECTION) \
+                    + _encode_trace(payload["trace"])
+            return HEADER.pack(MAGIC, WIRE_VERSION, DELTA, (self.seq - 1) & 0xFFFF, version & 0xFFFFFFFF, 0)
+        self._last_extras = extras
+        if (same_state):
+            sections = {section: self._last[1][section] for section in (PHASE_SECTION, COUNTS_SECTION, HANDS_SECTION)}
+        else:
+            sections = self._encode_state(payload)
+        self._last_version = version
+        if ("actions" in payload):
+            sections[ACTIONS_SECTION] = _encode_actions(payload["actions"])
+        if ("recommended_bet" in payload):
+            sections[BET_SECTION] = struct.pack("<H", min(int(payload["recommended_bet"]), 0xFFFF))
+
+        last = self._last
+        new_cards = None
+        keyframe = (last is None or self._since_keyframe >= self.keyframe_interval or sections.keys() != last[1].keys())
+        if (not keyframe and not same_state):
+            # deltas cannot remove cards from the shoe or carry more than 255 new cards
+            last_deck_dict = last[0]
+            if (any(last_deck_dict[card] > deck_dict.get(card, 0) for card in last_deck_dict)):
+                keyframe = True
+            else:
+                new_cards = [CARD_IDS[card] for card, times in deck_dict.items() for i in range(times - last_deck_dict.get(card, 0))]
+                keyframe = len(new_cards) > 0xFF
+        self._last = (last[0] if same_state else deck_dict, sections)
+
+        if (keyframe):
+            message_type = KEYFRAME
+            body = dict(sections)
+            body[SEEN_SECTION] = bytes([self.num_decks]) + _seen_bitmaps(deck_dict, self.num_decks)
+            self._since_keyframe = 0
+            self.num_keyframes += 1
+        else:
+            message_type = DELTA
+            body = {section: data for section, data in sections.items() if data != last[1][section]}
+            if (new_cards):
+                body[SEEN_SECTION] = bytes([len(new_cards)] + new_cards)
+            self._since_keyframe += 1
+        if ("trace" in payload):
+            body[TRACE_SECTION] = _encode_trace(payload["trace"])
+
+        mask = 0
+        data = [HEADER.pack(MAGIC, WIRE_VERSION, message_type, self.seq & 0xFFFF, (version or 0) & 0xFFFFFFFF, 0)]
+        for section in sorted(body):
+            mask |= section
+            data.append(body[section])
+        data[0] = data[0][:-1] + bytes([mask])
+        self.seq += 1
+        return b"".join(data)
+
+
+"""
+BinaryPayloadDecoder:
+Rebuilds payload dictionaries from binary messages for clients and tests. decode() returns None for deltas received
+before a keyframe or after a lost message, until the next keyframe arrives.
+"""
+class BinaryPayloadDecoder:
+    def __init__(self):
+        self.num_decks = 1
+        self.seen = None
+        self.state = None
+        self._next_seq = None
+
+    def decode(self, message: bytes) -> dict:
+        magic, version, message_type, seq, state_version, mask = HEADER.unpack_from(message)
+        if (magic != MAGIC or version != WIRE_VERSION):
+            raise ValueError("Not a BlackJAI binary payload")
+        if (message_type == DELTA and (self.state is None or seq != self._next_seq)):
+            self.state = None
+            return None
+        self._next_seq = (seq + 1) & 0xFFFF
+        if (message_type == KEYFRAME):
+            self.state = {}
+            self.seen = np.zeros(len(CARD_TYPES), dtype=np.int64)
+        state = self.state
+        trace = None
+        offset = HEADER.size
+        for section in (PHASE_SECTION, SEEN_SECTION, COUNTS_SECTION, HANDS_SECTION, ACTIONS_SECTION, BET_SECTION, TRACE_SECTION):
+            if (not (mask & section)):
+                continue
+            if (section == PHASE_SECTION):
+                state["phase"] = WIRE_PHASES[message[offset]]
+                offset += 1
+            elif (section == SEEN_SECTION and message_type == KEYFRAME):
+                self.num_decks = message[offset]
+                size = self.num_decks * BITMAP_SIZE
+                bits = np.frombuffer(message, dtype=np.uint8, count=size, offset=offset + 1).reshape(self.num_decks, BITMAP_SIZE)
+                self.seen = np.unpackbits(bits, axis=1, bitorder="little")[:, :len(CARD_TYPES)].sum(axis=0).astype(np.int64)
+                offset += 1 + size
+            elif (section == SEEN_SECTION):
+                num_cards = message[offset]
+                np.add.at(self.seen, np.frombuffer(message, dtype=np.uint8, count=num_cards, offset=offset + 1), 1)
+                offset += 1 + num_cards
+            elif (section == COUNTS_SECTION):
+                num_systems = message[offset]
+                counts = np.frombuffer(message, dtype="<i2", count=num_systems, offset=offset + 1) / 2
+                state["counts"] = {COUNT_SYSTEMS[i]: float(counts[i]) for i in range(num_systems)}
+                offset += 1 + 2 * num_systems
+            elif (section == HANDS_SECTION):
+                seats, offset = self._decode_hands(message, offset)
+                state["dealer"] = seats[0]
+                state["players"] = seats[1:]
+            elif (section == ACTIONS_SECTION):
+                num_players = message[offset]
+                offset += 1
+                state["actions"] = []
+                for i in range(num_players):
+                    num_hands = message[offset]
+                    state["actions"].append([WIRE_ACTIONS[action] for action in message[offset + 1:offset + 1 + num_hands]])
+                    offset += 1 + num_hands
+            elif (section == BET_SECTION):
+                state["recommended_bet"] = struct.unpack_from("<H", message, offset)[0]
+                offset += 2
+            elif (section == TRACE_SECTION):
+                trace = _decode_trace(message, offset)
+                offset += TRACE.size
+        state["version"] = state_version
+        payload = self._to_payload()
+        if (trace is not None):
+            payload["trace"] = trace
+        return payload
+
+    def _decode_hands(self, message: bytes, offset: int) -> tuple[list[list[list[str]]], int]:
+        num_seats = message[offset]
+        offset += 1
+        seats = []
+        for i in range(num_seats):
+            num_hands = message[offset]
+            offset += 1
+            hands = []
+            for j in range(num_hands):
+                num_cards = message[offset]
+                hands.append([CARD_TYPES[card_id] for card_id in message[offset + 1:offset + 1 + num_cards]])
+                offset += 1 + num_cards
+            seats.append(hands)
+        return seats, offset
+
+    def _to_payload(self) -> dict:
+        state = self.state
+        count_systems = {"count_" + system: count for system, count in state.get("counts", {}).items()}
+        count_systems["deck_dict"] = {CARD_TYPES[card_id]: int(self.seen[card_id]) for card_id in np.flatnonzero(self.seen)}
+        payload = {
+            "phase": state.get("phase"),
+            "players": [{"hands": hands} for hands in state.get("players", [])],
+            "dealer": {"hands": state.get("dealer", [])},
+            "count_systems": count_systems,
+            "version": state["version"],
+        }
+        if ("actions" in state):
+            payload["actions"] = state["actions"]
+        if ("recommended_bet" in state):
+            payload["recommended_bet"] = state["recommended_bet"]
+        return payload
+
+
+# Returns the payload encoder for the wire format
+def create_payload_encoder(name=JSON_FORMAT, num_decks=1, keyframe_interval=30):
+    if (name == JSON_FORMAT):
+        return JsonPayloadEncoder()
+    elif (name == BINARY_FORMAT):
+        return BinaryPayloadEncoder(num_decks, keyframe_interval)
+    raise ValueError("Unknown payload format: " + str(name) + ". Choose one of " + str(PAYLOAD_FORMATS))
@@ -0,0 +1,127 @@
+import numpy as np
+
+from blackjai_server.engine.models import Card, CardInfo
+
+"""
+Vectorized grouping of card locations used by the engine
+"""
+
+
+# Returns the root of node i, compressing the path on the way up
+def _find(parent: list[int], i: int) -> int:
+    root = i
+    while (parent[root] != root):
+        root = parent[root]
+    while (parent[i] != root):
+        parent[i], i = root, parent[i]
+    return root
+
+
+# Labels the connected components of a graph with num_nodes nodes and the given edges (union-find).
+# Labels are numbered 0..k-1 in order of each component's first node.
+def connected_components(num_nodes: int, edges_i, edges_j) -> np.ndarray:
+    parent = list(range(num_nodes))
+    for i, j in zip(edges_i, edges_j):
+        root_i = _find(parent, int(i))
+        root_j = _find(parent, int(j))
+        if (root_i != root_j):
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    roots = [_find(parent, i) for i in range(num_nodes)]
+    _, labels = np.unique(np.array(roots, dtype=np.int64), return_inverse=True)
+    return labels.reshape(-1)
+
+
+# Groups points that are closer than thresh to each other, directly or through a chain of points.
+# If groups is given, only points of the same group are linked. Returns a component label per point.
+def cluster_points(x, y, thresh, groups=None) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    dist_sq = (x[:, None] - x[None, :])**2 + (y[:, None] - y[None, :])**2
+    linked = dist_sq < thresh * thresh
+    if (groups is not None):
+        groups = np.asarray(groups)
+        linked &= groups[:, None] == groups[None, :]
+    edges_i, edges_j = np.nonzero(np.triu(linked, 1))
+    return connected_components(len(x), edges_i, edges_j)
+
+
+# Merges detections of the same class closer than thresh_same_card into one detection per physical card,
+# located at the confidence weighted centroid. Returns (class_id, x, y, confidence, weight) arrays with one
+# entry per physical card, where confidence is the mean and weight the sum of the merged confidences.
+def merge_duplicate_detections(class_id, x, y, confidence, thresh_same_card):
+    class_id = np.asarray(class_id)
+    confidence = np.asarray(confidence, dtype=np.float64)
+    if (len(class_id) == 0):
+        empty = np.zeros(0)
+        return class_id, empty, empty, empty, empty
+    labels = cluster_points(x, y, thresh_same_card, groups=class_id)
+    num_cards = int(labels.max()) + 1
+    weight = np.bincount(labels, weights=confidence, minlength=num_cards)
+    count = np.bincount(labels, minlength=num_cards)
+    # cards whose detections all have zero confidence fall back to the plain centroid
+    point_weight = np.where(weight[labels] > 0, confidence, 1.0)
+    total_weight = np.where(weight > 0, weight, count)
+    merged_x = np.bincount(labels, weights=point_weight * np.asarray(x, dtype=np.float64), minlength=num_cards) / total_weight
+    merged_y = np.bincount(labels, weights=point_weight * np.asarray(y, dtype=np.float64), minlength=num_cards) / total_weight
+    # class of each card is the class of its first detection
+    first = np.unique(labels, return_index=True)[1]
+    return class_id[first], merged_x, merged_y, weight / count, weight
+
+
+"""
+CardClusterer:
+Groups the stable card locations into hands. Cards closer than thresh_card_cluster to any card of a hand,
+directly or through a chain of cards, belong to that hand (single linkage connected components), so the
+result does not depend on the order of the cards. Each card of a hand is located at the hand's centroid.
+The last result is memoized on the set of card types and reused while no card has moved more than move_tolerance
+pixels (in x or y) from the positions it was computed from, so detection jitter does not defeat the memo. Hands
+then keep the centroids of the memoized positions. Keep move_tolerance well below thresh_card_cluster.
+"""
+class CardClusterer:
+    # use a KD-tree for the neighbour search once there are this many cards on the table
+    KD_TREE_MIN_CARDS = 64
+
+    def __init__(self, thresh_card_cluster=400, move_tolerance=25):
+        self.thresh_card_cluster = thresh_card_cluster
+        self.move_tolerance = move_tolerance
+        self.num_hits = 0
+        self.num_misses = 0
+        self._cache_key = None
+        self._cache_locs = None
+        self._cache_hands = None
+
+    # Returns a 2D list of CardInfo where each row is a player's or dealer's hand.
+    # The CardInfo objects are shared between calls with the same card positions and must not be modified.
+    def cluster(self, card_loc_dict: dict[str, tuple[int, int]]) -> list[list[CardInfo]]:
+        key = tuple(card_loc_dict.keys())
+        locs = np.array(list(card_loc_dict.values()), dtype=np.float64).reshape(-1, 2)
+        if (key != self._cache_key or np.any(np.abs(locs - self._cache_locs) > self.move_tolerance)):
+            self.num_misses += 1
+            self._cache_hands = self._cluster(card_loc_dict)
+            self._cache_key = key
+            self._cache_locs = locs
+        else:
+            self.num_hits += 1
+        return [list(hand) for hand in self._cache_hands]
+
+    def _cluster(self, card_loc_dict: dict[str, tuple[int, int]]) -> list[list[CardInfo]]:
+        card_types = list(card_loc_dict.keys())
+        if (len(card_types) == 0):
+            return []
+        locs = np.array([card_loc_dict[card_type] for card_type in card_types], dtype=np.float64)
+        if (len(card_types) >= self.KD_TREE_MIN_CARDS):
+            from scipy.spatial import cKDTree
+            pairs = cKDTree(locs).query_pairs(np.nextafter(self.thresh_card_cluster, 0), output_type="ndarray")
+            labels = connected_components(len(card_types), pairs[:, 0], pairs[:, 1])
+        else:
+            labels = cluster_points(locs[:, 0], locs[:, 1], self.thresh_card_cluster)
+
+        num_hands = int(labels.max()) + 1
+        count = np.bincount(labels, minlength=num_hands)
+        centroid_x = np.bincount(labels, weights=locs[:, 0], minlength=num_hands) / count
+        centroid_y = np.bincount(labels, weights=locs[:, 1], minlength=num_hands) / count
+        hands = [[] for i in range(num_hands)]
+        for i, label in enumerate(labels.tolist()):
+            hand_loc = (int(centroid_x[label]), int(centroid_y[label]))
+            hands[label].append(CardInfo(hand_loc, Card(card_types[i]), 1))
+        return hands
@@ -1,37 +1,65 @@
-import sys
 import math
+import numpy as np
 
 from blackjai_server.engine.state import BlackJAIState, SHUFFLE_PHASE, DEAL_PHASE, TURN_PHASE
-from blackjai_server.engine.models import Card, CardInfo, BasicStrategy
+from blackjai_server.engine.models import Card, CardInfo, CARD_TYPES, CARD_IDS
+from blackjai_server.engine.clustering import CardClusterer, merge_duplicate_detections
+from blackjai_server.engine.layout import TableLayout, DEALER_SEAT
+from blackjai_server.engine.strategy import CompiledStrategy, RuleSet
+from blackjai_server.engine.ev import EVEngine, shoe_composition
+from blackjai_server.detection.results import Detections
 
 DEBUG = False
 
 
 class BlackJAIEngine:
-    def __init__(self, frame_size: tuple[int, int], num_players=2, buffer_size=20, thresh_same_card=300, thresh_card_moving=200, thresh_card_cluster=400):
+    def __init__(self, frame_size: tuple[int, int], num_players=2, buffer_size=20, thresh_same_card=300, thresh_card_moving=200, thresh_card_cluster=400,
+                 clusterer=None, layout: TableLayout = None, num_decks=1, penetration=1.0, rules: RuleSet = None,
+                 deviations=True, strategy_cache_dir=None, composition_ev=False, ev_cache_size=4096,
+                 bankroll_plan=None):
         self.frame_size = frame_size
+        # seat zones of the table, the number of players follows the layout if one is given
+        self.layout = layout if (layout is not None) else TableLayout.default(frame_size, num_players)
+        num_players = self.layout.num_players
         self.num_players = num_players
-        self.state = BlackJAIState(num_players)
+        self.state = BlackJAIState(num_players, num_decks=num_decks, penetration=penetration)
         self.buffer_size = buffer_size
         # threshold for card location difference to determine if 2 card labels are the same
         self.thresh_same_card = thresh_same_card
         # threshold for card location difference to determine if 1 card is moving
         self.thresh_card_moving = thresh_card_moving
         self.thresh_card_cluster = thresh_card_cluster
+        # groups stable cards into hands, any object with a cluster(card_loc_dict) method can be used
+        self.clusterer = clusterer if (clusterer is not None) else CardClusterer(thresh_card_cluster)
+        # Card of each class id of the detector's class names (None for labels that are not cards), built once per names
+        self._class_names = None
+        self._class_cards = []
+        self._class_is_card = np.zeros(0, dtype=bool)
+        self._ignored_labels = set()
         self.frame_card_info_queues = CardInfoQueues(buffer_size)
-        self.strategy = BasicStrategy()
+        # strategy table compiled once for the table rules, with Hi-Lo index deviations if enabled
+        self.rules = rules if (rules is not None) else RuleSet(num_decks=num_decks)
+        self.strategy = CompiledStrategy(self.rules, deviations=deviations, cache_dir=strategy_cache_dir)
+        # composition dependent expected values of each action, added to the payload if enabled
+        self.ev_engine = EVEngine(self.rules, cache_size=ev_cache_size) if composition_ev else None
+        # BankrollPlan with the bet per true count, adds the recommended bet to the payload if given
+        self.bankroll_plan = bankroll_plan
         self.engine_payload = {}
 
-    def update(self, json_data):
-        self.engine_payload = self.state.serialize()
-        self._update_card_info_queues(json_data)
+    # detections: Detections from detect_card_type_yolo, or the JSON prediction dict from the Roboflow path
+    # trace: FrameTrace of the frame the detections came from, marked and added to the payload as "trace" if given
+    def update(self, detections, trace=None):
+        if (isinstance(detections, dict)):
+            detections = Detections.from_json(detections)
+        self.engine_payload = self._get_state_payload()
+        self._update_card_info_queues(detections)
         # handle state changes
         if (self.state.get_phase() == SHUFFLE_PHASE):
             if (not self.frame_card_info_queues.is_empty()):
                 self.state.set_phase(DEAL_PHASE)
                 print("Shuffle phase complete. Deal phase started.")
         elif (self.state.get_phase() == DEAL_PHASE):
-            if (self.state.get_count_systems().get_deck_dict_num_cards() >= (52 - 4 * (self.num_players + 1))):
+            if (self.state.get_count_systems().is_shuffle_due(self.num_players + 1)):
                 # reset state to shuffle phase, reset counts, and clear card info queues
                 self.state.reset_state()
                 self.state.reset_count_systems()
@@ -49,14 +77,10 @@ class BlackJAIEngine:
                         hand = hands[i]
                         if (len(hand) == 2):
                             # Assign hand to player based on location of cluster
-                            quadrant = self._get_card_loc_quadrant(hand[0])
-                            if (quadrant == 4):
+                            seat = self._get_card_loc_seat(hand[0])
+                            if (seat >= 0):
                                 hand_to_add = [hand[i].get_card() for i in range(len(hand))]
-                                self.state.add_hand_to_player(0, hand_to_add)
-                                self.state.update_count_hand(hand_to_add)
-                            elif (quadrant == 3):
-                                hand_to_add = [hand[i].get_card() for i in range(len(hand))]
-                                self.state.add_hand_to_player(1, hand_to_add)
+                                self.state.add_hand_to_player(seat, hand_to_add)
                                 self.state.update_count_hand(hand_to_add)
                         elif (len(hand) == 1):
                             self.state.add_hand_to_dealer([hand[0].get_card()])
@@ -66,10 +90,10 @@ class BlackJAIEngine:
                             print("Error: hand has more than 2 cards. In BlackJAIEngine.update()")
                     if (not err):
                         self.state.set_phase(TURN_PHASE)
-                        self.engine_payload = self.state.serialize()
+                        self.engine_payload = self._get_state_payload()
                         print("Deal phase complete. Turn phase started.")
                     else:
-                        print("Error: Deal phase not complete due to invalid cards in hand. Rearrange cards to correct quadrants. In BlackJAIEngine.update()")
+                        print("Error: Deal phase not complete due to invalid cards in hand. Rearrange cards to correct seats. In BlackJAIEngine.update()")
         elif (self.state.get_phase() == TURN_PHASE):
             if (self.frame_card_info_queues.is_empty()):
                 # reset state to deal phase
@@ -82,19 +106,17 @@ class BlackJAIEngine:
                 avg_card_locs = self.frame_card_info_queues.get_avg_locs(self.thresh_card_moving)
                 if (len(avg_card_locs) >= (self.num_players * 2 + 1)):
                     # segment cards into number of players + dealer piles
-                    # if a quadrant has 2 piles of cards, then the player has 2 hands and has split
+                    # if a seat has 2 piles of cards, then the player has 2 hands and has split
                     hands = self._cluster_cards(avg_card_locs)
                     for i in range(len(hands)):
                         # hand: list[CardInfo]
                         hand = hands[i]
-                        quadrant = self._get_card_loc_quadrant(hand[0])
-                        if (quadrant == 4):
-                            self._check_player_cards_and_add(0, hand)
-                        elif (quadrant == 3):
-                            self._check_player_cards_and_add(1, hand)
-                        elif (quadrant == 1 or quadrant == 2):
+                        seat = self._get_card_loc_seat(hand[0])
+                        if (seat >= 0):
+                            self._check_player_cards_and_add(seat, hand)
+                        elif (seat == DEALER_SEAT):
                             self._check_dealer_cards_and_add(hand)
-                self.engine_payload = self.state.serialize()
+                self.engine_payload = self._get_state_payload()
                 if len(self.state.dealer.get_hands()[0]) == 1:
                     self.apply_strategy()
         else:
@@ -105,6 +127,15 @@ class BlackJAIEngine:
         # print("2: ", self.state.get_player(1).get_hands()) if DEBUG else None
         # print("D: ", self.state.get_dealer().get_hands(), "\n") if DEBUG else None
 
+        # added after the phase handling, which may replace the payload
+        if (self.bankroll_plan is not None):
+            true_count = self.state.get_count_systems().get_true_count(self.bankroll_plan.count_system)
+            self.engine_payload["recommended_bet"] = self.bankroll_plan.get_bet(true_count)
+
+        if (trace is not None):
+            trace.mark("engine")
+            self.engine_payload["trace"] = trace.serialize()
+
         # make json out of state and respective counts/strategies and return it
         print(self.engine_payload, "\n") if DEBUG else None
         return self.engine_payload
@@ -113,10 +144,21 @@ class BlackJAIEngine:
     def apply_strategy(self):
         players = self.state.get_players()
         dealer_card = self.state.get_dealer().get_hand(0)[0]
+        true_count = self.state.get_count_systems().get_true_count_hi_lo()
         self.engine_payload["actions"] = []
         for player in players:
-            action_list = self.strategy.get_action(player, dealer_card)
+            action_list = self.strategy.get_action(player, dealer_card, true_count)
             self.engine_payload["actions"].append(action_list)
+        if (self.ev_engine is not None):
+            composition = shoe_composition(self.state.get_count_systems())
+            self.engine_payload["ev"] = []
+            for player in players:
+                hand_evs = [self.ev_engine.hand_evs(hand, dealer_card, composition) for hand in player.get_hands() if len(hand) >= 2]
+                self.engine_payload["ev"].append([{action: round(ev, 4) for action, ev in evs.items()} for evs in hand_evs])
+
+    # Returns a copy of the cached state snapshot that the engine can add its own keys to
+    def _get_state_payload(self) -> dict:
+        return dict(self.state.serialize())
 
     # If len(hand) == 1, and player hand contains card, player has split.
     # Keep same card in hand and remove other card from player hand.
@@ -174,99 +216,67 @@ class BlackJAIEngine:
             self.state.add_card_to_dealer(card)
             self.state.update_count_card(card)
 
-    # Given a CardInfo object, returns the quadrant of the card based on its location.
-    # Quadrants are numbered 1-4 starting from the top left and going clockwise.
-    def _get_card_loc_quadrant(self, card_info: CardInfo):
-        x = card_info.get_location()[0]
-        y = card_info.get_location()[1]
-        if (x < self.frame_size[0] / 2):
-            if (y < self.frame_size[1] / 2):
-                return 1
-            else:
-                return 3
-        else:
-            if (y < self.frame_size[1] / 2):
-                return 2
-            else:
-                return 4
+    # Given a CardInfo object, returns the seat of the card based on its location and the table layout:
+    # a player index, DEALER_SEAT, or NO_SEAT if the card is outside every seat zone.
+    def _get_card_loc_seat(self, card_info: CardInfo) -> int:
+        return self.layout.get_seat(card_info.get_location())
 
     # Clusters the cards into piles for each player and the dealer.
     # Returns a 2D list of CardInfo where each row is a player's or dealer's hand.
     def _cluster_cards(self, card_loc_dict: dict[str, tuple[int, int]]) -> list[list[CardInfo]]:
-        hands = []
-        for key in card_loc_dict.keys():
-            card_info_to_add = None
-            added = False
-            card_location = card_loc_dict[key]
-            # check if card is close enough to any of the hands
-            for hand in hands:
-                # average all card's locations in hand, then add card to hand
-                sum_loc_x = 0
-                sum_loc_y = 0
-                num_cards = 0
-                # check if card is close enough to any of the cards in the hand
-                for card_info in hand:
-                    sum_loc_x += card_info.get_location()[0]
-                    sum_loc_y += card_info.get_location()[1]
-                    num_cards += 1
-                    same_card = card_info.get_card().get_value_suit() == key
-                    if ((self._get_loc_diff(card_info.get_location(), card_location) < self.thresh_card_cluster) and (not same_card) and (card_info_to_add is None)):
-                        sum_loc_x += card_location[0]
-                        sum_loc_y += card_location[1]
-                        num_cards += 1
-                        card_info_to_add = CardInfo(card_location, Card(key), 1)
-                # set all card locations in hand to the average location
-                if (num_cards > len(hand)):
-                    avg_loc = (int(sum_loc_x / num_cards), int(sum_loc_y / num_cards))
-                    for card_info in hand:
-                        card_info.set_location(avg_loc)
-                    if (card_info_to_add is not None):
-                        card_info_to_add.set_location(avg_loc)
-                        hand.append(card_info_to_add)
-                        added = True
-            # if card not close enough or did not enter for loop, add card to new hand
-            if (not added):
-                hands.append([CardInfo(card_location, Card(key), 1)])
-        return hands
+        return self.clusterer.cluster(card_loc_dict)
 
     # returns the location difference between 2 locations
     def _get_loc_diff(self, loc1: tuple[int, int], loc2: tuple[int, int]):
         return int(math.sqrt((loc1[0] - loc2[0])**2 + (loc1[1] - loc2[1])**2))
 
-    def _update_card_info_queues(self, json_data):
+    # Maps the class ids of the detector's class names to cards. Labels that are not cards (e.g. "Joker" or a
+    # different naming scheme) map to None and their detections are ignored. The names are compared by value, since
+    # detections from the Roboflow path (see Detections.from_json()) bring a new list of names with every frame.
+    def _map_class_cards(self, names):
+        if (names == self._class_names):
+            return
+        class_ids = list(names.keys()) if isinstance(names, dict) else list(range(len(names)))
+        self._class_cards = [None] * ((max(class_ids) + 1) if (len(class_ids) > 0) else 0)
+        for class_id in class_ids:
+            if (names[class_id] in CARD_IDS):
+                self._class_cards[class_id] = Card(names[class_id])
+            elif (names[class_id] not in self._ignored_labels):
+                self._ignored_labels.add(names[class_id])
+                print("Warning: ignoring detector class " + str(names[class_id]) + ", it is not a card")
+        self._class_is_card = np.array([card is not None for card in self._class_cards], dtype=bool)
+        # a copy, so a detector changing its names in place is noticed
+        self._class_names = dict(names) if isinstance(names, dict) else list(names)
+
+    def _update_card_info_queues(self, detections: Detections):
         card_dict = {}
-        if "predictions" in json_data:
-            for prediction in json_data["predictions"]:
-                # get the bounding box of the prediction
-                x1 = int(prediction["x"])
-                y1 = int(prediction["y"])
-                x2 = int(x1 + prediction["width"])
-                y2 = int(y1 + prediction["height"])
-
-                # get prediction info
-                card_type = prediction["class"]
-                confidence = prediction["confidence"]
-                cur_card_info = CardInfo((x1, y1), Card(card_type), confidence)
-                # add card info as list to card_dict
-                if (card_type not in card_dict):
-                    card_dict[card_type] = [cur_card_info]
-                else:
-                    # find same cards labeled multiple times in card_dict
-                    # average their coordinates and confidence to get 1 card label per card type (key) in card_dict
-                    if (len(card_dict[card_type]) >= 1):
-                        for i in range(len(card_dict[card_type])):
-                            card_info = card_dict[card_type][i]
-                            diff = card_info.get_loc_diff(cur_card_info)
-                            if (diff < self.thresh_same_card):
-                                card_dict[card_type][i] = card_info.avg_card_infos(cur_card_info)
-                    else:
-                        card_dict[card_type].append(cur_card_info)
+        if (len(detections) > 0):
+            self._map_class_cards(detections.names)
+            data = detections.data
+            class_ids = data["class_id"].astype(np.int64)
+            in_range = (class_ids >= 0) & (class_ids < len(self._class_is_card))
+            known = np.zeros(len(data), dtype=bool)
+            known[in_range] = self._class_is_card[class_ids[in_range]]
+            if (not known.all()):
+                data = data[known]
+            # merge labels of the same card (e.g. both corner indices) into one confidence weighted centroid
+            class_id, x, y, confidence, weight = merge_duplicate_detections(data["class_id"], data["x"], data["y"],
+                                                                            data["confidence"], self.thresh_same_card)
+            # the queues hold one card info per card type, so keep the strongest card of each type
+            for i in np.argsort(-weight, kind="stable").tolist():
+                card = self._class_cards[int(class_id[i])]
+                if (card.value_suit not in card_dict):
+                    card_dict[card.value_suit] = [CardInfo((int(x[i]), int(y[i])), card, float(confidence[i]))]
 
         # add card_dict to frame_card_info_queues
         self.frame_card_info_queues.add(card_dict)
 
 
-# A dictionary class with keys as playing cards and values as a queue of CardInfo objects
+# A ring buffer of the latest CardInfo per card type, one row per card type in CARD_TYPES order.
+# Locations, confidences and a presence mask are kept in (52, buffer_size) arrays with a shared write cursor.
+# Running sums of x, y and x^2 + y^2 and the number of card infos per card type are updated in O(1) as card
+# infos enter and leave the buffer, and only the active card types (any card info in the buffer) are visited,
+# so the per frame cost does not grow with the deck size or buffer length.
 class CardInfoQueues:
     # threshold for number of card infos in the queue for a card type
     THRESH_NUM_CARD_INFOS = 2
@@ -275,91 +285,75 @@ class CardInfoQueues:
         self.buffer_size = buffer_size
         # buffer must be 80% full to get final average location and put in players hand after
         self.thresh_num_card_infos_full = max(self.THRESH_NUM_CARD_INFOS, buffer_size - int((0.8 * buffer_size)))
-        self.dict = {
-            # 2
-            "2C": [],
-            "2D": [],
-            "2H": [],
-            "2S": [],
-            # 3
-            "3C": [],
-            "3D": [],
-            "3H": [],
-            "3S": [],
-            # 4
-            "4C": [],
-            "4D": [],
-            "4H": [],
-            "4S": [],
-            # 5
-            "5C": [],
-            "5D": [],
-            "5H": [],
-            "5S": [],
-            # 6
-            "6C": [],
-            "6D": [],
-            "6H": [],
-            "6S": [],
-            # 7
-            "7C": [],
-            "7D": [],
-            "7H": [],
-            "7S": [],
-            # 8
-            "8C": [],
-            "8D": [],
-            "8H": [],
-            "8S": [],
-            # 9
-            "9C": [],
-            "9D": [],
-            "9H": [],
-            "9S": [],
-            # 10
-            "10C": [],
-            "10D": [],
-            "10H": [],
-            "10S": [],
-            # J
-            "JC": [],
-            "JD": [],
-            "JH": [],
-            "JS": [],
-            # Q
-            "QC": [],
-            "QD": [],
-            "QH": [],
-            "QS": [],
-            # K
-            "KC": [],
-            "KD": [],
-            "KH": [],
-            "KS": [],
-            # A
-            "AC": [],
-            "AD": [],
-            "AH": [],
-            "AS": [],
-        }
+        self.card_types = CARD_TYPES
+        self.card_index = {card_type: i for i, card_type in enumerate(CARD_TYPES)}
+        self.x = np.zeros((len(CARD_TYPES), buffer_size), dtype=np.int64)
+        self.y = np.zeros((len(CARD_TYPES), buffer_size), dtype=np.int64)
+        self.confidence = np.zeros((len(CARD_TYPES), buffer_size), dtype=np.float64)
+        self.present = np.zeros((len(CARD_TYPES), buffer_size), dtype=bool)
+        # column the next frame is written to, and number of frames in the buffer
+        self.cursor = 0
+        self.num_frames = 0
+        # running statistics per card type
+        self.num_card_infos = [0] * len(CARD_TYPES)
+        self.sum_x = [0] * len(CARD_TYPES)
+        self.sum_y = [0] * len(CARD_TYPES)
+        self.sum_sq = [0] * len(CARD_TYPES)
+        # rows of the card types with any card info in the buffer
+        self.active = set()
+
+    def _insert(self, row: int, col: int, x: int, y: int, confidence):
+        self.x[row, col] = x
+        self.y[row, col] = y
+        self.confidence[row, col] = confidence
+        self.present[row, col] = True
+        self.num_card_infos[row] += 1
+        self.sum_x[row] += x
+        self.sum_y[row] += y
+        self.sum_sq[row] += x * x + y * y
+        self.active.add(row)
+
+    def _evict(self, row: int, col: int):
+        x = int(self.x[row, col])
+        y = int(self.y[row, col])
+        self.present[row, col] = False
+        self.num_card_infos[row] -= 1
+        self.sum_x[row] -= x
+        self.sum_y[row] -= y
+        self.sum_sq[row] -= x * x + y * y
+        if (self.num_card_infos[row] == 0):
+            self.active.discard(row)
 
     # Adds the given card infos to the queue otherwise adds None to all keys
     def add(self, card_info: dict[str, list[CardInfo]]):
-        # shift all queues to the left
-        for key in self.dict:
-            if (len(self.dict[key]) >= self.buffer_size):
-                self.dict[key].pop(0)
-            # after popping (if queue full), add to queue
-            if (key not in card_info):
-                self.dict[key].append(None)
-            else:
-                if (len(card_info[key]) > 1):
-                    print("Error: more than 1 card info in card_info dict. In CardInfoQueues.add()")
-                elif (len(card_info[key]) == 1):
-                    self.dict[key].append(card_info[key][0])
+        col = self.cursor
+        # evict the oldest frame once the buffer is full
+        if (self.num_frames == self.buffer_size):
+            for row in [row for row in self.active if self.present[row, col]]:
+                self._evict(row, col)
+        for key in card_info:
+            row = self.card_index.get(key)
+            if (row is None):
+                continue
+            if (len(card_info[key]) > 1):
+                print("Error: more than 1 card info in card_info dict. In CardInfoQueues.add()")
+            elif (len(card_info[key]) == 1):
+                loc = card_info[key][0].get_location()
+                self._insert(row, col, int(loc[0]), int(loc[1]), card_info[key][0].get_confidence())
+        self.cursor = (self.cursor + 1) % self.buffer_size
+        self.num_frames = min(self.num_frames + 1, self.buffer_size)
+
+    # returns the buffer columns from oldest to newest
+    def _order(self) -> np.ndarray:
+        if (self.num_frames < self.buffer_size):
+            return np.arange(self.num_frames)
+        return (self.cursor + np.arange(self.buffer_size)) % self.buffer_size
 
     def get(self, card_type: str) -> list[CardInfo]:
-        return self.dict[card_type]
+        row = self.card_index[card_type]
+        card = Card(card_type)
+        return [CardInfo((int(self.x[row, col]), int(self.y[row, col])), card, float(self.confidence[row, col]))
+                if self.present[row, col] else None for col in self._order()]
 
     # returns true if the card is moving
     def is_card_moving(self, card_type: str, thresh_card_moving) -> bool:
@@ -370,93 +364,97 @@ class CardInfoQueues:
 
     # returns the maximum x and y component difference in the queue for the given card type
     def get_max_loc_diff(self, card_type: str):
-        # initialize to max int and 0
-        x_max = 0
-        x_min = sys.maxsize
-        y_max = 0
-        y_min = sys.maxsize
-        num_cards = 0
-
-        # find max and min x and y
-        for card_info in self.dict[card_type]:
-            if (card_info is not None):
-                num_cards += 1
-                loc = card_info.get_location()
-                # x
-                if (loc[0] > x_max):
-                    x_max = loc[0]
-                elif (loc[0] < x_min):
-                    x_min = loc[0]
-                # y
-                if (loc[1] > y_max):
-                    y_max = loc[1]
-                elif (loc[1] < y_min):
-                    y_min = loc[1]
-        return (x_max - x_min, y_max - y_min) if (num_cards >= self.THRESH_NUM_CARD_INFOS) else None
+        row = self.card_index[card_type]
+        if (self.num_card_infos[row] < self.THRESH_NUM_CARD_INFOS):
+            return None
+        present = self.present[row]
+        x = self.x[row][present]
+        y = self.y[row][present]
+        return (int(x.max() - x.min()), int(y.max() - y.min()))
+
+    # returns the mean squared distance of the card type's card infos from their average location
+    def get_loc_variance(self, card_type: str) -> float:
+        return self._loc_variance(self.card_index[card_type])
+
+    def _loc_variance(self, row: int) -> float:
+        num_cards = self.num_card_infos[row]
+        if (num_cards == 0):
+            return 0.0
+        avg_x = self.sum_x[row] / num_cards
+        avg_y = self.sum_y[row] / num_cards
+        return max(0.0, self.sum_sq[row] / num_cards - avg_x * avg_x - avg_y * avg_y)
+
+    # Returns true if the card type is not moving. A card is moving if any card info is further than
+    # thresh_card_moving from the average of the card infos before it. Every card info lies within
+    # sqrt((n - 1) * variance) of the overall average, and so does every partial average, so when twice
+    # that bound is within the threshold the card cannot be moving and the buffer is never scanned.
+    def _is_still(self, row: int, thresh_card_moving) -> bool:
+        num_cards = self.num_card_infos[row]
+        if (4 * (num_cards - 1) * self._loc_variance(row) <= thresh_card_moving * thresh_card_moving):
+            return True
+        return not self._is_moving_scan(row, thresh_card_moving)
+
+    # Checks the movement rule on every card info in the buffer from oldest to newest
+    def _is_moving_scan(self, row: int, thresh_card_moving) -> bool:
+        order = self._order()
+        present = self.present[row, order]
+        x = self.x[row, order][present]
+        y = self.y[row, order][present]
+        num_before = np.arange(len(x))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            avg_x = (np.cumsum(x) - x) / num_before
+            avg_y = (np.cumsum(y) - y) / num_before
+            diff = np.floor(np.sqrt((x - avg_x)**2 + (y - avg_y)**2))
+        return bool(np.any(diff[1:] > thresh_card_moving))
 
     # Returns the average location of the card type if there are enough card infos in the queue
     # AND if the card is not moving. Otherwise returns None.
     def get_avg_loc(self, card_type: str, thresh_card_moving):
-        sum_loc_x = 0
-        sum_loc_y = 0
-        num_cards = 0
-
-        for card_info in self.dict[card_type]:
-            if (card_info is not None):
-                loc = card_info.get_location()
-                # check if card is moving
-                if (num_cards >= 1):
-                    avg_loc_x = sum_loc_x / num_cards
-                    avg_loc_y = sum_loc_y / num_cards
-                    diff = int(math.sqrt((loc[0] - avg_loc_x)**2 + (loc[1] - avg_loc_y)**2))
-                    if (diff > thresh_card_moving):
-                        # card is moving, return None
-                        return None
-                num_cards += 1
-                sum_loc_x += loc[0]
-                sum_loc_y += loc[1]
-        # return average location if there are enough card infos, otherwise return None
-        if (num_cards >= self.thresh_num_card_infos_full):
-            return (int(sum_loc_x / num_cards), int(sum_loc_y / num_cards))
+        row = self.card_index[card_type]
+        num_cards = self.num_card_infos[row]
+        if ((num_cards >= self.thresh_num_card_infos_full) and self._is_still(row, thresh_card_moving)):
+            return (int(self.sum_x[row] / num_cards), int(self.sum_y[row] / num_cards))
         return None
 
     # returns a dictionary of the average locations for non moving cards
     def get_avg_locs(self, thresh_card_moving):
         avg_locs = {}
-        for card_type in self.dict:
-            loc = self.get_avg_loc(card_type, thresh_card_moving)
+        for row in sorted(self.active):
+            loc = self.get_avg_loc(self.card_types[row], thresh_card_moving)
             if (loc is not None):
-                avg_locs[card_type] = loc
+                avg_locs[self.card_types[row]] = loc
         return avg_locs
 
     # if the entire queue contain only None or length == 0, then the key is empty
     # also mark as empty if THRESH_NUM_CARD_INFOS or less card infos in queue
     def is_key_empty(self, card_type: str) -> bool:
-        if (all(card_info is None for card_info in self.dict[card_type]) or (len(self.dict[card_type]) == 0)):
-            return True
-        card_info_count = 0
-        for card_info in self.dict[card_type]:
-            if (card_info is not None):
-                card_info_count += 1
-                if (card_info_count >= self.THRESH_NUM_CARD_INFOS):
-                    return False
-        return True
+        return self.num_card_infos[self.card_index[card_type]] < self.THRESH_NUM_CARD_INFOS
 
     # returns true if all keys are empty
     # AKA: all queues contain only None or empty or have less than THRESH_NUM_CARD_INFOS card infos
     def is_empty(self) -> bool:
-        return all(self.is_key_empty(card_type) for card_type in self.dict)
+        return all(self.num_card_infos[row] < self.THRESH_NUM_CARD_INFOS for row in self.active)
+
+    # returns the card types with any card info in the queue
+    def get_active_card_types(self) -> list[str]:
+        return [self.card_types[row] for row in sorted(self.active)]
 
     # clears all queues
     def clear(self):
-        for key in self.dict:
-            self.dict[key].clear()
+        self.present[:] = False
+        self.cursor = 0
+        self.num_frames = 0
+        self.num_card_infos = [0] * len(self.card_types)
+        self.sum_x = [0] * len(self.card_types)
+        self.sum_y = [0] * len(self.card_types)
+        self.sum_sq = [0] * len(self.card_types)
+        self.active = set()
 
     def __str__(self):
-        return str(self.dict)
+        return str({card_type: self.get(card_type) for card_type in self.card_types})
 
     def __repr__(self):
-        return str(self.dict)
+        return self.__str__()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,257 @@
+from collections import OrderedDict
+import numpy as np
+
+from blackjai_server.engine.models import Card, CountingSystems, CARD_RANKS
+from blackjai_server.engine.strategy import RuleSet
+
+"""
+Composition dependent expected values for the exact cards remaining in the shoe.
+The shoe composition is a vector of 10 card counts: values 2-9, ten valued cards, aces.
+Dealer outcomes are computed from the remaining composition (with the dealer peeking for blackjack),
+and player draws remove cards from the composition as they are drawn. The dealer distribution is computed once from
+the composition before the player's draws and is not conditioned on the cards the player takes, so hit, double and
+split expected values are approximate (standing is exact). Splits are played without resplitting.
+Results are memoized in bounded LRU caches keyed by the compact byte encoding of the composition.
+"""
+
+NUM_VALUES = 10
+TEN_INDEX = 8
+ACE_INDEX = 9
+# blackjack value of each composition index
+INDEX_VALUES = (2, 3, 4, 5, 6, 7, 8, 9, 10, 11)
+# composition index of each card rank (2 to A)
+RANK_INDEX = (0, 1, 2, 3, 4, 5, 6, 7, 8, 8, 8, 8, 9)
+# number of cards of each composition index in one deck
+DECK_COMPOSITION = (4, 4, 4, 4, 4, 4, 4, 4, 16, 4)
+
+# Dealer outcomes: final totals 17-21 and bust
+DEALER_TOTALS = np.arange(17, 22)
+BUST = 5
+
+# Actions
+STAND = "stand"
+HIT = "hit"
+DOUBLE = "double"
+SPLIT = "split"
+SURRENDER = "surrender"
+
+
+# Returns the composition index of the card
+def card_index(card: Card) -> int:
+    return RANK_INDEX[card.rank]
+
+
+# Returns the composition of the cards not yet seen by the counting systems
+def shoe_composition(count_systems: CountingSystems) -> np.ndarray:
+    composition = np.array(DECK_COMPOSITION, dtype=np.int64) * count_systems.num_decks
+    seen = np.bincount([RANK_INDEX[rank] for rank in CARD_RANKS], weights=count_systems.seen, minlength=NUM_VALUES)
+    return composition - seen.astype(np.int64)
+
+
+# Returns (total, soft) after adding the card with the composition index to a hand
+def _add_card(total: int, soft: bool, index: int) -> tuple[int, bool]:
+    if (index == ACE_INDEX):
+        if (total + 11 <= 21):
+            return total + 11, True
+        return total + 1, soft
+    total += INDEX_VALUES[index]
+    if (total > 21 and soft):
+        return total - 10, False
+    return total, soft
+
+
+"""
+BoundedCache:
+A least recently used cache holding at most maxsize entries.
+"""
+class BoundedCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if (entry is None):
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if (len(self._entries) > self.maxsize):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+"""
+EVEngine:
+Computes the dealer's final total distribution per up card and the expected value of standing, hitting,
+doubling, splitting and surrendering a hand for the exact remaining shoe composition.
+Expected values are per unit of the original bet, given the dealer does not have blackjack.
+Hit, double and split values are approximate: the dealer distribution does not remove the player's drawn cards.
+Split hands are played without resplitting, so the split value ignores resplits.
+"""
+class EVEngine:
+    def __init__(self, rules: RuleSet = None, cache_size=4096):
+        self.rules = rules if (rules is not None) else RuleSet()
+        self.dealer_cache = BoundedCache(cache_size)
+        self.hand_cache = BoundedCache(cache_size)
+
+    # Returns the probabilities of the dealer finishing on 17, 18, 19, 20, 21 and busting,
+    # given the up card and that the dealer does not have blackjack
+    def dealer_distribution(self, upcard_index: int, composition) -> np.ndarray:
+        composition = np.asarray(composition, dtype=np.int64)
+        key = (upcard_index, composition.tobytes())
+        dist = self.dealer_cache.get(key)
+        if (dist is None):
+            total, soft = _add_card(0, False, upcard_index)
+            # the dealer peeks, so the hole card cannot complete a blackjack
+            excluded = TEN_INDEX if (upcard_index == ACE_INDEX) else (ACE_INDEX if (upcard_index == TEN_INDEX) else None)
+            dist = self._dealer(total, soft, composition.copy(), {}, excluded)
+            self.dealer_cache.put(key, dist)
+        return dist
+
+    def _dealer_stands(self, total: int, soft: bool) -> bool:
+        return (total >= 18) or (total == 17 and not (soft and self.rules.dealer_hits_soft_17))
+
+    def _dealer(self, total: int, soft: bool, composition: np.ndarray, memo: dict, excluded=None) -> np.ndarray:
+        dist = np.zeros(BUST + 1)
+        if (self._dealer_stands(total, soft)):
+            dist[total - 17] = 1.0
+            return dist
+        key = (total, soft, composition.tobytes())
+        if (excluded is None and key in memo):
+            return memo[key]
+        num_cards = composition.sum() - (composition[excluded] if (excluded is not None) else 0)
+        if (num_cards <= 0):
+            # no cards left, treat as the shoe being reshuffled
+            return self._dealer(total, soft, np.array(DECK_COMPOSITION, dtype=np.int64) * self.rules.num_decks, memo, excluded)
+        for index in np.flatnonzero(composition):
+            if (index == excluded):
+                continue
+            p = composition[index] / num_cards
+            new_total, new_soft = _add_card(total, soft, index)
+            if (new_total > 21):
+                dist[BUST] += p
+            else:
+                composition[index] -= 1
+                dist += p * self._dealer(new_total, new_soft, composition, memo)
+                composition[index] += 1
+        if (excluded is None):
+            memo[key] = dist
+        return dist
+
+    # Returns the expected value of standing on the total against the dealer distribution
+    def _stand_ev(self, total: int, dealer_dist: np.ndarray) -> float:
+        if (total > 21):
+            return -1.0
+        win = dealer_dist[BUST] + dealer_dist[:BUST][DEALER_TOTALS < total].sum()
+        lose = dealer_dist[:BUST][DEALER_TOTALS > total].sum()
+        return float(win - lose)
+
+    # Returns the expected value of playing the hand optimally by standing or hitting
+    def _play_ev(self, total: int, soft: bool, composition: np.ndarray, dealer_dist: np.ndarray, memo: dict) -> float:
+        stand = self._stand_ev(total, dealer_dist)
+        if (total >= 21):
+            return stand
+        return max(stand, self._hit_ev(total, soft, composition, dealer_dist, memo))
+
+    def _hit_ev(self, total: int, soft: bool, composition: np.ndarray, dealer_dist: np.ndarray, memo: dict) -> float:
+        key = (total, soft, composition.tobytes())
+        if (key in memo):
+            return memo[key]
+        num_cards = composition.sum()
+        ev = 0.0
+        for index in np.flatnonzero(composition):
+            p = composition[index] / num_cards
+            new_total, new_soft = _add_card(total, soft, index)
+            if (new_total > 21):
+                ev -= p
+            else:
+                composition[index] -= 1
+                ev += p * self._play_ev(new_total, new_soft, composition, dealer_dist, memo)
+                composition[index] += 1
+        ev = float(ev)
+        memo[key] = ev
+        return ev
+
+    def _double_ev(self, total: int, soft: bool, composition: np.ndarray, dealer_dist: np.ndarray) -> float:
+        num_cards = composition.sum()
+        ev = 0.0
+        for index in np.flatnonzero(composition):
+            new_total, new_soft = _add_card(total, soft, index)
+            ev += composition[index] / num_cards * self._stand_ev(new_total, dealer_dist)
+        return float(2 * ev)
+
+    # Expected value of splitting the pair, for both hands together. Resplits are ignored: a pair drawn to a split hand
+    # is played as its total, and the second hand is assumed to play like the first
+    def _split_ev(self, index: int, composition: np.ndarray, dealer_dist: np.ndarray) -> float:
+        total, soft = _add_card(0, False, index)
+        num_cards = composition.sum()
+        ev = 0.0
+        memo = {}
+        for draw in np.flatnonzero(composition):
+            p = composition[draw] / num_cards
+            new_total, new_soft = _add_card(total, soft, draw)
+            composition[draw] -= 1
+            if (index == ACE_INDEX):
+                # split aces get one card each
+                hand_ev = self._stand_ev(new_total, dealer_dist)
+            else:
+                hand_ev = self._play_ev(new_total, new_soft, composition, dealer_dist, memo)
+                if (self.rules.double_after_split):
+                    hand_ev = max(hand_ev, self._double_ev(new_total, new_soft, composition, dealer_dist))
+            composition[draw] += 1
+            ev += p * hand_ev
+        return float(2 * ev)
+
+    # Returns a dictionary of action -> expected value for the hand against the dealer up card.
+    # composition is the remaining shoe, not including the hand's cards and the up card.
+    def hand_evs(self, hand: list[Card], dealer_card: Card, composition) -> dict[str, float]:
+        composition = np.asarray(composition, dtype=np.int64)
+        indices = [card_index(card) for card in hand]
+        upcard_index = card_index(dealer_card)
+        key = (tuple(sorted(indices)), upcard_index, composition.tobytes())
+        evs = self.hand_cache.get(key)
+        if (evs is not None):
+            return evs
+
+        total, soft = 0, False
+        for index in indices:
+            total, soft = _add_card(total, soft, index)
+        dealer_dist = self.dealer_distribution(upcard_index, composition)
+        composition = composition.copy()
+        if (len(hand) == 2 and total == 21):
+            evs = {STAND: 1.5}
+        else:
+            evs = {STAND: self._stand_ev(total, dealer_dist)}
+            if (total < 21):
+                evs[HIT] = self._hit_ev(total, soft, composition, dealer_dist, {})
+            if (len(hand) == 2):
+                evs[DOUBLE] = self._double_ev(total, soft, composition, dealer_dist)
+                if (indices[0] == indices[1]):
+                    evs[SPLIT] = self._split_ev(indices[0], composition, dealer_dist)
+                if (self.rules.surrender):
+                    evs[SURRENDER] = -0.5
+        self.hand_cache.put(key, evs)
+        return evs
+
+    # Returns (best action, expected value) for the hand
+    def get_best_action(self, hand: list[Card], dealer_card: Card, composition) -> tuple[str, float]:
+        evs = self.hand_evs(hand, dealer_card, composition)
+        action = max(evs, key=evs.get)
+        return action, evs[action]
+
+    def clear(self):
+        self.dealer_cache.clear()
+        self.hand_cache.clear()
@@ -0,0 +1,76 @@
+import json
+import cv2 as cv
+import numpy as np
+
+# Seat values in the lookup raster besides the player indices 0..num_players-1
+NO_SEAT = -1
+DEALER_SEAT = -2
+
+
+"""
+TableLayout:
+The seat zones of a table. Each player seat and the dealer is a polygon in frame coordinates.
+The zones are compiled once into a lookup raster downscaled by resolution, so finding the seat
+of a card location is a single array index. Where zones overlap, the later zone wins
+(dealer first, then seats in the order given).
+"""
+class TableLayout:
+    def __init__(self, frame_size: tuple[int, int], seats: list[list[tuple[int, int]]], dealer: list[tuple[int, int]], resolution=4):
+        if (resolution < 1):
+            raise ValueError("TableLayout resolution must be at least 1")
+        self.frame_size = tuple(frame_size)
+        self.seats = seats
+        self.dealer = dealer
+        self.resolution = resolution
+        self.num_players = len(seats)
+        width = -(-self.frame_size[0] // resolution)
+        height = -(-self.frame_size[1] // resolution)
+        self.raster = np.full((height, width), NO_SEAT, dtype=np.int16)
+        self._fill(dealer, DEALER_SEAT)
+        for seat in range(len(seats)):
+            self._fill(seats[seat], seat)
+
+    def _fill(self, polygon: list[tuple[int, int]], seat: int):
+        points = np.floor(np.array(polygon, dtype=np.float64) / self.resolution).astype(np.int32)
+        cv.fillPoly(self.raster, [points], seat)
+
+    # Returns the seat (player index, DEALER_SEAT or NO_SEAT) at the location
+    def get_seat(self, location: tuple[int, int]) -> int:
+        row = min(max(int(location[1]) // self.resolution, 0), self.raster.shape[0] - 1)
+        col = min(max(int(location[0]) // self.resolution, 0), self.raster.shape[1] - 1)
+        return int(self.raster[row, col])
+
+    # The default layout: the dealer takes the top half of the frame and the player seats split the
+    # bottom half into columns, with player 0 on the right. With 2 players this is the original quadrant
+    # layout (bottom right player 0, bottom left player 1, top dealer).
+    @classmethod
+    def default(cls, frame_size: tuple[int, int], num_players=2, resolution=4):
+        width, height = frame_size
+        half = height / 2
+        dealer = [(0, 0), (width, 0), (width, half), (0, half)]
+        seats = []
+        for seat in range(num_players):
+            right = width * (num_players - seat) / num_players
+            left = width * (num_players - seat - 1) / num_players
+            seats.append([(left, half), (right, half), (right, height), (left, height)])
+        # fill seats from left to right so a shared edge belongs to the seat on its right
+        layout = cls(frame_size, [], dealer, resolution)
+        for seat in reversed(range(num_players)):
+            layout._fill(seats[seat], seat)
+        layout.seats = seats
+        layout.num_players = num_players
+        return layout
+
+    # Loads a layout from a JSON file of the form:
+    # {"frame_size": [w, h], "resolution": 4, "dealer": [[x, y], ...], "seats": [[[x, y], ...], ...]}
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as file:
+            config = json.load(file)
+        return cls(config["frame_size"], config["seats"], config["dealer"], config.get("resolution", 4))
+
+    def __str__(self):
+        return "TableLayout(" + str(self.num_players) + " seats, frame " + str(self.frame_size) + ")"
+
+    def __repr__(self):
+        return self.__str__()
@@ -1,52 +1,95 @@
 import math
+import numpy as np
 
 """
 Contains all the model used in the game of blackjack and for the BlackJAI system
 """
 
-# A card class that holds the value and suit of a card
+# All 52 card types in deck order (2 to A, suits C D H S in each value)
+# A card's integer ID (0-51) is its index in CARD_TYPES: rank index * 4 + suit index
+CARD_VALUES = ["2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K", "A"]
+CARD_SUITS = ["C", "D", "H", "S"]
+CARD_TYPES = [value + suit for value in CARD_VALUES for suit in CARD_SUITS]
+CARD_IDS = {card_type: i for i, card_type in enumerate(CARD_TYPES)}
+
+# Lookup tables indexed by rank index (0-12, 2 to A)
+RANK_BLACKJACK_VALUES = (2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10, 11)
+RANK_HI_LO_WEIGHTS = (1, 1, 1, 1, 1, 0, 0, 0, -1, -1, -1, -1, -1)
+
+# Lookup tables indexed by card ID
+CARD_RANKS = tuple(card_id // len(CARD_SUITS) for card_id in range(len(CARD_TYPES)))
+CARD_BLACKJACK_VALUES = tuple(RANK_BLACKJACK_VALUES[rank] for rank in CARD_RANKS)
+CARD_HI_LO_WEIGHTS = tuple(RANK_HI_LO_WEIGHTS[rank] for rank in CARD_RANKS)
+
+
+# A card class that holds the value and suit of a card.
+# Cards are interned, immutable singletons: Card("AH") always returns the same object,
+# so cards can be compared with "is" or by their integer ID.
 class Card:
-    def __init__(self, value_suit: str):
-        str_len = len(value_suit)
-        if (str_len < 2):
+    __slots__ = ("id", "rank", "value", "suit", "blackjack_value", "value_suit")
+    _interned = {}
+
+    def __new__(cls, value_suit: str):
+        card = cls._interned.get(value_suit)
+        if (card is not None):
+            return card
+        if (len(value_suit) < 2):
             raise Exception("Card value and suit must be at least 2 characters long")
-        self.value = str(value_suit[0])
-        self.suit = str(value_suit[1:str_len])
-        # Check if the card is a 10
-        if (str_len > 2):
-            self.value = str(value_suit[0:2])
-            self.suit = str(value_suit[str_len-1])
-
-    def get_value(self):
-        if (self.value in ["J", "Q", "K"]):
-            return 10
-        elif (self.value == "A"):
-            return 11
-        else:
-            return int(self.value)
+        if (value_suit not in CARD_IDS):
+            raise Exception("Unknown card: " + str(value_suit))
+        card = object.__new__(cls)
+        card_id = CARD_IDS[value_suit]
+        object.__setattr__(card, "id", card_id)
+        object.__setattr__(card, "rank", CARD_RANKS[card_id])
+        object.__setattr__(card, "value", value_suit[:-1])
+        object.__setattr__(card, "suit", value_suit[-1])
+        object.__setattr__(card, "blackjack_value", CARD_BLACKJACK_VALUES[card_id])
+        object.__setattr__(card, "value_suit", value_suit)
+        cls._interned[value_suit] = card
+        return card
+
+    # returns the card with the given integer ID (0-51)
+    @staticmethod
+    def from_id(card_id: int):
+        return CARDS[card_id]
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Card objects are immutable")
+
+    def __reduce__(self):
+        return (Card, (self.value_suit,))
+
+    def get_id(self) -> int:
+        return self.id
+
+    def get_rank(self) -> int:
+        return self.rank
+
+    def get_value(self) -> int:
+        return self.blackjack_value
 
     def get_suit(self):
         return self.suit
 
     def get_value_suit(self):
-        return self.value + self.suit
-
-    def set_value(self, value: str):
-        self.value = value
-
-    def set_suit(self, suit: str):
-        self.suit = suit
+        return self.value_suit
 
     def __str__(self):
-        return self.get_value_suit()
+        return self.value_suit
 
     def __repr__(self) -> str:
-        return self.get_value_suit()
+        return self.value_suit
+
+
+# The 52 interned cards indexed by card ID
+CARDS = tuple(Card(card_type) for card_type in CARD_TYPES)
 
 
 # A class for the queue object. Contains a tuple of: (card location, card, confidence level)
 # Frames will output multiple of these objects
 class CardInfo:
+    __slots__ = ("location", "card", "confidence")
+
     def __init__(self, location: tuple[int, int], card: Card, confidence):
         self.location = location
         self.card = card
@@ -76,7 +119,7 @@ class CardInfo:
 
     # returns the average location and confidence between this card and another card (must be the same card)
     def avg_card_infos(self, card_info):
-        if (self.card.get_value_suit() != card_info.card.get_value_suit()):
+        if (self.card is not card_info.card):
             raise Exception("CardInfo objects must be the same card")
         return CardInfo((int((self.location[0] + card_info.location[0]) / 2),
                          int((self.location[1] + card_info.location[1]) / 2)),
@@ -90,10 +133,12 @@ class CardInfo:
 
 
 # A player class that holds the player's hand which contains a set of cards, the player's minimum bet
+# version is incremented by every method that changes the hands
 class Player:
     def __init__(self, minimum_bet=1):
         self.hands = []
         self.minimum_bet = minimum_bet
+        self.version = 0
 
     def get_num_hands(self):
         return len(self.hands)
@@ -115,7 +160,7 @@ class Player:
             hand = self.hands[i]
             for j in range(len(hand)):
                 c = hand[j]
-                if (c.get_value_suit() == card.get_value_suit()):
+                if (c is card):
                     return (i, j)
         return None
 
@@ -124,7 +169,7 @@ class Player:
         hand_match = False
         for hand in self.hands:
             for card in hand:
-                if ((len(hand) != len(other_hand)) or not all(card.get_value_suit() == other_card.get_card().get_value_suit() for other_card in other_hand)):
+                if ((len(hand) != len(other_hand)) or not all(card is other_card.get_card() for other_card in other_hand)):
                     hand_match = False
                     break
                 else:
@@ -134,6 +179,7 @@ class Player:
         return hand_match
 
     def add_hand(self, hand: list[Card]):
+        self.version += 1
         if (len(self.hands) == 0):
             self.hands = [hand]
         else:
@@ -142,6 +188,7 @@ class Player:
     def add_card_to_hand(self, hand_index: int, card: Card):
         if (hand_index >= len(self.hands)):
             raise Exception("Hand index out of range")
+        self.version += 1
         self.hands[hand_index].append(card)
 
     def split_cards_in_hand(self, hand_index: int):
@@ -151,12 +198,14 @@ class Player:
             raise Exception("Hand does not contain 2 cards")
         if (self.hands[hand_index][0].get_value() != self.hands[hand_index][1].get_value()):
             raise Exception("Cards in hand are not the same value")
+        self.version += 1
         card = self.hands[hand_index].pop()
         self.add_hand([card])
 
     def remove_hand(self, hand_index: int):
         if (hand_index >= len(self.hands)):
             raise Exception("Hand index out of range")
+        self.version += 1
         self.hands.pop(hand_index)
 
     def remove_card_from_hand(self, hand_index: int, card_index: int):
@@ -164,9 +213,11 @@ class Player:
             raise Exception("Hand index out of range")
         if (card_index >= len(self.hands[hand_index])):
             raise Exception("Card index out of range")
+        self.version += 1
         self.hands[hand_index].pop(card_index)
 
     def reset_hands(self):
+        self.version += 1
         self.hands = []
 
     def __str__(self):
@@ -327,56 +378,135 @@ class BasicStrategy:
         return actions_list
 
 
-# The model for the counting systems (Hi-Lo, Omega II, Wong Halves, Zen Count) for the game of blackjack
+# Card counting systems as weights over the 13 ranks (2 to A). Adding a system is adding a row here.
+COUNT_SYSTEM_RANK_WEIGHTS = {
+    #              2,   3,   4,   5,   6,   7,   8,    9,  10,  J,  Q,  K,  A
+    "hi_lo":       (1,   1,   1,   1,   1,   0,   0,    0,  -1, -1, -1, -1, -1),
+    "omega_ii":    (1,   1,   2,   2,   2,   1,   0,   -1,  -2, -2, -2, -2, 0),
+    "wong_halves": (0.5, 1,   1,   1.5, 1,   0.5, 0, -0.5,  -1, -1, -1, -1, -1),
+    "zen_count":   (1,   1,   2,   2,   2,   1,   0,    0,  -2, -2, -2, -2, -1),
+    "ko":          (1,   1,   1,   1,   1,   1,   0,    0,  -1, -1, -1, -1, -1),
+    "hi_opt_ii":   (1,   1,   2,   2,   1,   1,   0,    0,  -2, -2, -2, -2, 0),
+    "red_seven":   (1,   1,   1,   1,   1,   0,   0,    0,  -1, -1, -1, -1, -1),
+}
+# Weights of single cards that differ from their rank's weight
+COUNT_SYSTEM_CARD_WEIGHTS = {
+    "red_seven": {"7D": 1, "7H": 1},
+}
+# Initial running count of unbalanced systems for the number of decks in the shoe
+COUNT_SYSTEM_INITIAL_COUNTS = {
+    "ko": lambda num_decks: -4 * (num_decks - 1),
+    "red_seven": lambda num_decks: -2 * num_decks,
+}
+COUNT_SYSTEMS = list(COUNT_SYSTEM_RANK_WEIGHTS.keys())
+
+
+# Returns the (num_systems, 52) matrix of card weights of the given count systems
+def build_count_weights(systems: list[str]) -> np.ndarray:
+    weights = np.array([[COUNT_SYSTEM_RANK_WEIGHTS[system][rank] for rank in CARD_RANKS] for system in systems], dtype=np.float64)
+    for i, system in enumerate(systems):
+        for card_type, weight in COUNT_SYSTEM_CARD_WEIGHTS.get(system, {}).items():
+            weights[i, CARD_IDS[card_type]] = weight
+    return weights
+
+
+# The model for the counting systems (Hi-Lo, Omega II, Wong Halves, Zen Count, KO, Hi-Opt II, Red Seven)
+# for the game of blackjack. Seeing a card updates every system with a single vector add, and the number
+# of cards seen is maintained as cards are seen so decks remaining and true counts are O(1).
+# Supports multi-deck shoes with a cut card placed after the penetration fraction of the shoe.
+# version is incremented whenever the counts or the shoe change.
 class CountingSystems:
-    def __init__(self, num_decks=1):
+    def __init__(self, num_decks=1, penetration=1.0, systems: list[str] = None):
+        self.version = 0
+        self.systems = list(systems) if (systems is not None) else list(COUNT_SYSTEMS)
+        self.system_index = {system: i for i, system in enumerate(self.systems)}
+        self.weights = build_count_weights(self.systems)
+        # systems whose weights are all whole numbers report integer counts
+        self.integral = [bool(np.all(self.weights[i] == np.round(self.weights[i]))) for i in range(len(self.systems))]
         self.num_decks = num_decks
-        self.deck_dict = {}
-        self.count_hi_lo = 0
-        self.count_omega_ii = 0
-        self.count_wong_halves = 0
-        self.count_zen_count = 0
+        self.penetration = penetration
+        self.reset_running_counts()
+
+    def get_running_count(self, system: str):
+        count = self.running_counts[self.system_index[system]]
+        return int(count) if self.integral[self.system_index[system]] else float(count)
 
-    def get_true_count_hi_lo(self, num_decks_remaining) -> float:
-        return self.count_hi_lo / num_decks_remaining
+    # returns the running count divided by the number of decks remaining (computed from the cards seen if not given)
+    def get_true_count(self, system: str, num_decks_remaining=None) -> float:
+        if (num_decks_remaining is None):
+            num_decks_remaining = self.get_num_decks_remaining()
+        return self.get_running_count(system) / num_decks_remaining
 
-    def get_true_count_omega_ii(self, num_decks_remaining) -> float:
-        return self.count_omega_ii / num_decks_remaining
+    def get_bet_multiplier(self, system: str, num_decks_remaining=None) -> float:
+        return max(1, self.get_true_count(system, num_decks_remaining))
 
-    def get_true_count_wong_halves(self, num_decks_remaining) -> float:
-        return self.count_wong_halves / num_decks_remaining
+    @property
+    def count_hi_lo(self):
+        return self.get_running_count("hi_lo")
 
-    def get_true_count_zen_count(self, num_decks_remaining) -> float:
-        return self.count_zen_count / num_decks_remaining
+    @property
+    def count_omega_ii(self):
+        return self.get_running_count("omega_ii")
 
-    def get_bet_multiplier_hi_lo(self, num_decks_remaining) -> float:
-        true_count = self.get_true_count_hi_lo(num_decks_remaining)
-        return max(1, true_count)
+    @property
+    def count_wong_halves(self):
+        return self.get_running_count("wong_halves")
 
-    def get_bet_multiplier_omega_ii(self, num_decks_remaining) -> float:
-        true_count = self.get_true_count_omega_ii(num_decks_remaining)
-        return max(1, true_count)
+    @property
+    def count_zen_count(self):
+        return self.get_running_count("zen_count")
 
-    def get_bet_multiplier_wong_halves(self, num_decks_remaining) -> float:
-        true_count = self.get_true_count_wong_halves(num_decks_remaining)
-        return max(1, true_count)
+    def get_true_count_hi_lo(self, num_decks_remaining=None) -> float:
+        return self.get_true_count("hi_lo", num_decks_remaining)
 
-    def get_bet_multiplier_zen_count(self, num_decks_remaining) -> float:
-        true_count = self.get_true_count_zen_count(num_decks_remaining)
-        return max(1, true_count)
+    def get_true_count_omega_ii(self, num_decks_remaining=None) -> float:
+        return self.get_true_count("omega_ii", num_decks_remaining)
 
+    def get_true_count_wong_halves(self, num_decks_remaining=None) -> float:
+        return self.get_true_count("wong_halves", num_decks_remaining)
+
+    def get_true_count_zen_count(self, num_decks_remaining=None) -> float:
+        return self.get_true_count("zen_count", num_decks_remaining)
+
+    def get_bet_multiplier_hi_lo(self, num_decks_remaining=None) -> float:
+        return self.get_bet_multiplier("hi_lo", num_decks_remaining)
+
+    def get_bet_multiplier_omega_ii(self, num_decks_remaining=None) -> float:
+        return self.get_bet_multiplier("omega_ii", num_decks_remaining)
+
+    def get_bet_multiplier_wong_halves(self, num_decks_remaining=None) -> float:
+        return self.get_bet_multiplier("wong_halves", num_decks_remaining)
+
+    def get_bet_multiplier_zen_count(self, num_decks_remaining=None) -> float:
+        return self.get_bet_multiplier("zen_count", num_decks_remaining)
+
+    # returns a dictionary of the number of times each seen card has been seen
     def get_deck_dict(self) -> dict:
-        return self.deck_dict
+        return {CARD_TYPES[card_id]: int(self.seen[card_id]) for card_id in np.flatnonzero(self.seen)}
 
-    # returns the number of cards in the deck dictionary
+    # returns the number of cards seen
     def get_deck_dict_num_cards(self) -> int:
-        num_cards = 0
-        for key in self.deck_dict:
-            num_cards += self.deck_dict[key]
-        return num_cards
+        return self.num_seen
+
+    def get_num_cards_remaining(self) -> int:
+        return len(CARD_TYPES) * self.num_decks - self.num_seen
+
+    # returns the number of decks left in the shoe, never less than 1 card to keep true counts finite
+    def get_num_decks_remaining(self) -> float:
+        return max(self.get_num_cards_remaining(), 1) / len(CARD_TYPES)
+
+    # returns true once the cut card is reached or another round of num_hands hands could run out of cards
+    def is_shuffle_due(self, num_hands: int) -> bool:
+        cut_card = self.penetration * len(CARD_TYPES) * self.num_decks
+        return (self.num_seen >= cut_card) or (self.get_num_cards_remaining() <= 4 * num_hands)
 
     def set_num_decks(self, num_decks: int):
         self.num_decks = num_decks
+        self.reset_running_counts()
+
+    def set_penetration(self, penetration: float):
+        self.version += 1
+        self.penetration = penetration
 
     # update all running counts for the card(s) in the hand if they have not been seen before
     # or if there are less than the number of decks
@@ -386,77 +516,32 @@ class CountingSystems:
 
     # update all running counts if the card has not been seen before or if there are less than the number of decks
     def update_running_counts_card(self, card: Card):
-        # add card to deck dictionary if it doesn't exist
-        update_count = False
-        if (card.get_value_suit() not in self.deck_dict):
-            self.deck_dict[card.get_value_suit()] = 1
-            update_count = True
-        elif (self.deck_dict[card.get_value_suit()] < self.num_decks):
-            self.deck_dict[card.get_value_suit()] += 1
-            update_count = True
-        if (update_count):
-            card_val = card.get_value()
-            # Hi-Lo
-            if (card_val <= 6):
-                self.count_hi_lo += 1
-            elif (card_val >= 10):
-                self.count_hi_lo -= 1
-
-            # Omega II
-            if (card_val == 2 or card_val == 3 or card_val == 7):
-                self.count_omega_ii += 1
-            elif (card_val >= 4 and card_val <= 6):
-                self.count_omega_ii += 2
-            elif (card_val == 9):
-                self.count_omega_ii -= 1
-            elif (card_val == 10):
-                self.count_omega_ii -= 2
-
-            # Wong Halves
-            if (card_val == 2 or card_val == 7):
-                self.count_wong_halves += 0.5
-            elif (card_val == 3 or card_val == 4 or card_val == 6):
-                self.count_wong_halves += 1
-            elif (card_val == 5):
-                self.count_wong_halves += 1.5
-            elif (card_val == 9):
-                self.count_wong_halves -= 0.5
-            elif (card_val == 10 or card_val == 11):
-                self.count_wong_halves -= 1
-
-            # Zen Count
-            if (card_val == 2 or card_val == 3 or card_val == 7):
-                self.count_zen_count += 1
-            elif (card_val >= 4 and card_val <= 6):
-                self.count_zen_count += 2
-            elif (card_val == 10):
-                self.count_zen_count -= 2
-            elif (card_val == 11):
-                self.count_zen_count -= 1
+        if (self.seen[card.id] < self.num_decks):
+            self.seen[card.id] += 1
+            self.num_seen += 1
+            self.running_counts += self.weights[:, card.id]
+            self.version += 1
 
     def reset_running_counts(self):
-        self.count_hi_lo = 0
-        self.count_omega_ii = 0
-        self.count_wong_halves = 0
-        self.count_zen_count = 0
-        self.deck_dict = {}
+        self.version += 1
+        self.running_counts = np.array([COUNT_SYSTEM_INITIAL_COUNTS[system](self.num_decks) if system in COUNT_SYSTEM_INITIAL_COUNTS else 0
+                                        for system in self.systems], dtype=np.float64)
+        self.seen = np.zeros(len(CARD_TYPES), dtype=np.int64)
+        self.num_seen = 0
 
     def __str__(self) -> str:
-        return "Hi-Lo: " + str(self.count_hi_lo) + "\nOmega II: " + str(self.count_omega_ii) + \
-               "\nWong Halves: " + str(self.count_wong_halves) + "\nZen Count: " + str(self.count_zen_count)
+        return "\n".join(system + ": " + str(self.get_running_count(system)) for system in self.systems)
 
     # serialize the running counts
     def serialize(self) -> dict:
-        max_num_cards = 52 * self.num_decks
-        num_decks_remaining = round((max_num_cards - self.get_deck_dict_num_cards()) / max_num_cards, 3)
-        # could send more accurate count taking into account the number of decks remaining
-        return {
-            "count_hi_lo": self.count_hi_lo,
-            "count_omega_ii": self.count_omega_ii,
-            "count_wong_halves": self.count_wong_halves,
-            "count_zen_count": self.count_zen_count,
-            "deck_dict": self.deck_dict
-        }
+        num_decks_remaining = self.get_num_decks_remaining()
+        counts = {}
+        for system in self.systems:
+            counts["count_" + system] = self.get_running_count(system)
+        counts["true_counts"] = {system: round(self.get_true_count(system, num_decks_remaining), 3) for system in self.systems}
+        counts["num_decks_remaining"] = round(num_decks_remaining, 3)
+        counts["deck_dict"] = self.get_deck_dict()
+        return counts
 
 
 def test1(bs: BasicStrategy):
@@ -10,13 +10,17 @@ TURN_PHASE = "turn"
 
 
 class BlackJAIState:
-    def __init__(self, num_players=2):
+    def __init__(self, num_players=2, num_decks=1, penetration=1.0):
         self.phase = "shuffle"
         self.players = []
         for i in range(num_players):
             self.players.append(Player(minimum_bet=5))
         self.dealer = Player(minimum_bet=0)
-        self.count_systems = CountingSystems(num_decks=1)
+        self.count_systems = CountingSystems(num_decks=num_decks, penetration=penetration)
+        # changes to the state itself, the players and count systems keep their own versions
+        self.version = 0
+        self.serialized = None
+        self.serialized_version = -1
 
     def get_phase(self) -> str:
         return self.phase
@@ -36,6 +40,17 @@ class BlackJAIState:
     def get_count_systems(self) -> CountingSystems:
         return self.count_systems
 
+    # Returns a number that increases whenever the phase, a hand or the counts change
+    def get_version(self) -> int:
+        version = self.version + self.dealer.version + self.count_systems.version
+        for player in self.players:
+            version += player.version
+        return version
+
+    # Returns true if the state changed since get_version() returned version
+    def changed_since(self, version: int) -> bool:
+        return self.get_version() != version
+
     def update_count_hand(self, hand: list[Card]):
         self.count_systems.update_running_counts_hand(hand)
 
@@ -46,9 +61,13 @@ class BlackJAIState:
         self.count_systems.reset_running_counts()
 
     def set_phase(self, phase):
+        if (phase != self.phase):
+            self.version += 1
         self.phase = phase
 
     def set_player(self, player_index: int, player: Player):
+        # keep the version increasing when the new player has a lower version than the old one
+        self.version += self.players[player_index].version + 1
         self.players[player_index] = player
 
     # Adds a hand (list of cards) to a player
@@ -72,15 +91,21 @@ class BlackJAIState:
             player.reset_hands()
 
     def reset_state(self):
-        self.phase = "shuffle"
+        self.set_phase(SHUFFLE_PHASE)
         self.reset_player_hands()
         self.dealer.reset_hands()
 
-    # Serializes the state into a dictionary
+    # Serializes the state into a dictionary. The dictionary is cached and returned again until the state changes,
+    # so it must not be modified.
     def serialize(self) -> dict:
-        return {
-            "phase": self.phase,
-            "players": [player.serialize() for player in self.players],
-            "dealer": self.dealer.serialize(),
-            "count_systems": self.count_systems.serialize(),
-        }
+        version = self.get_version()
+        if (version != self.serialized_version):
+            self.serialized = {
+                "phase": self.phase,
+                "players": [player.serialize() for player in self.players],
+                "dealer": self.dealer.serialize(),
+                "count_systems": self.count_systems.serialize(),
+                "version": version,
+            }
+            self.serialized_version = version
+        return self.serialized
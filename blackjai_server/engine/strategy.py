@@ -0,0 +1,317 @@
+import os
+import numpy as np
+
+from blackjai_server.engine.models import BasicStrategy, Card, Player
+
+"""
+Strategy compiler: builds a flat action lookup table for a rule set from the basic strategy tables,
+including count based index deviations, so getting the action for a hand is a few array lookups.
+"""
+
+# Action codes stored in the compiled table (index into ACTION_CODES)
+ACTION_CODES = [BasicStrategy.H_, BasicStrategy.S_, BasicStrategy.DH, BasicStrategy.DS, BasicStrategy.RH,
+                BasicStrategy.P_, BasicStrategy.PH, BasicStrategy.PD, BasicStrategy.RS]
+ACTION_INDEX = {action: i for i, action in enumerate(ACTION_CODES)}
+
+# Hand classes (first table axis)
+HARD = 0
+SOFT = 1
+PAIR = 2
+
+# Second table axis: hand total for hard and soft hands, card value (2-11) of the pair for pairs
+MAX_TOTAL = 21
+# Third table axis: dealer up card value 2-11 (index = value - 2)
+NUM_UPCARDS = 10
+# Fourth table axis: true count bucket, the floor of the true count clipped to [TC_MIN, TC_MAX]
+TC_MIN = -6
+TC_MAX = 6
+NUM_TC_BUCKETS = TC_MAX - TC_MIN + 1
+
+# Bump when the compiler or the deviation tables change to invalidate cached tables
+STRATEGY_VERSION = 2
+
+ACE = 11
+TEN = 10
+
+# Hi-Lo index plays (Illustrious 18, without insurance):
+# (hand class, total or pair value, dealer up card value, index, ">=" or "<", action when the true count matches)
+ILLUSTRIOUS_18 = [
+    (HARD, 16, TEN, 0, ">=", BasicStrategy.S_),
+    (HARD, 15, TEN, 4, ">=", BasicStrategy.S_),
+    (PAIR, TEN, 5, 5, ">=", BasicStrategy.P_),
+    (PAIR, TEN, 6, 4, ">=", BasicStrategy.P_),
+    (HARD, 10, TEN, 4, ">=", BasicStrategy.DH),
+    (HARD, 12, 3, 2, ">=", BasicStrategy.S_),
+    (HARD, 12, 2, 3, ">=", BasicStrategy.S_),
+    (HARD, 11, ACE, 1, ">=", BasicStrategy.DH),
+    (HARD, 9, 2, 1, ">=", BasicStrategy.DH),
+    (HARD, 10, ACE, 4, ">=", BasicStrategy.DH),
+    (HARD, 9, 7, 3, ">=", BasicStrategy.DH),
+    (HARD, 16, 9, 5, ">=", BasicStrategy.S_),
+    (HARD, 13, 2, -1, "<", BasicStrategy.H_),
+    (HARD, 12, 4, 0, "<", BasicStrategy.H_),
+    (HARD, 12, 5, -2, "<", BasicStrategy.H_),
+    (HARD, 12, 6, -1, "<", BasicStrategy.H_),
+    (HARD, 13, 3, -2, "<", BasicStrategy.H_),
+]
+
+# Hi-Lo soft doubling index plays: (hand class, total, dealer up card value, index, ">=" or "<", action)
+SOFT_DEVIATIONS = [
+    (SOFT, 19, 6, 1, ">=", BasicStrategy.DS),
+    (SOFT, 19, 6, 0, "<", BasicStrategy.S_),
+    (SOFT, 19, 5, 1, ">=", BasicStrategy.DS),
+    (SOFT, 19, 4, 3, ">=", BasicStrategy.DS),
+    (SOFT, 17, 2, 1, ">=", BasicStrategy.DH),
+]
+
+# Hi-Lo surrender index plays (Fab 4): (hand total, dealer up card value, index), surrender at or above the index
+FAB_4 = [
+    (14, TEN, 3),
+    (15, TEN, 0),
+    (15, 9, 2),
+    (15, ACE, 1),
+]
+
+# The basic strategy tables are for a single deck where the dealer hits soft 17.
+# Rule dependent changes to them: (applies to the rules, hand class, total or pair value, dealer up card value, action).
+# Two or more decks follow the published multi-deck charts, with the 16 vs 9 surrender from four decks up.
+RULE_CHANGES = [
+    (lambda rules: rules.num_decks >= 2, HARD, 8, 5, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, HARD, 8, 6, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, HARD, 9, 2, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, HARD, 9, 7, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, HARD, 15, TEN, BasicStrategy.RH),
+    (lambda rules: rules.num_decks >= 4, HARD, 16, 9, BasicStrategy.RH),
+    (lambda rules: rules.num_decks >= 2, SOFT, 13, 4, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, SOFT, 14, 4, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, SOFT, 17, 2, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, PAIR, 3, 8, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, PAIR, 4, 4, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, PAIR, 4, 5, BasicStrategy.PH),
+    (lambda rules: rules.num_decks >= 2, PAIR, 4, 6, BasicStrategy.PH),
+    (lambda rules: rules.num_decks >= 2, PAIR, 6, 2, BasicStrategy.PH),
+    (lambda rules: rules.num_decks >= 2, PAIR, 6, 7, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, PAIR, 7, 8, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2, PAIR, 7, TEN, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2 and not rules.dealer_hits_soft_17, HARD, 11, ACE, BasicStrategy.H_),
+    (lambda rules: rules.num_decks >= 2 and rules.dealer_hits_soft_17, HARD, 15, ACE, BasicStrategy.RH),
+    (lambda rules: rules.num_decks >= 2 and rules.dealer_hits_soft_17, HARD, 17, ACE, BasicStrategy.RS),
+    (lambda rules: rules.num_decks >= 2 and rules.dealer_hits_soft_17, SOFT, 18, 2, BasicStrategy.DS),
+    (lambda rules: rules.dealer_hits_soft_17, SOFT, 18, ACE, BasicStrategy.H_),
+    (lambda rules: not rules.dealer_hits_soft_17, SOFT, 19, 6, BasicStrategy.S_),
+]
+
+# Split actions, a pair with any other action is played as the hard total of its two cards
+SPLIT_ACTIONS = (BasicStrategy.P_, BasicStrategy.PH, BasicStrategy.PD)
+
+
+"""
+RuleSet:
+The table rules the strategy is compiled for.
+"""
+class RuleSet:
+    def __init__(self, num_decks=1, dealer_hits_soft_17=True, double_after_split=True, surrender=True):
+        self.num_decks = num_decks
+        self.dealer_hits_soft_17 = dealer_hits_soft_17
+        self.double_after_split = double_after_split
+        self.surrender = surrender
+
+    # a short string identifying the rule set, used as the cache key
+    def get_key(self) -> str:
+        return (str(self.num_decks) + "d_" + ("h17" if self.dealer_hits_soft_17 else "s17") + "_" +
+                ("das" if self.double_after_split else "ndas") + "_" + ("ls" if self.surrender else "nls"))
+
+    def __str__(self):
+        return self.get_key()
+
+    def __repr__(self):
+        return self.get_key()
+
+
+# Returns the action with surrender removed if the rules do not allow it, and split-if-DAS resolved
+def _resolve_rules(action: str, rules: RuleSet) -> str:
+    if (not rules.surrender):
+        if (action == BasicStrategy.RH):
+            return BasicStrategy.H_
+        if (action == BasicStrategy.RS):
+            return BasicStrategy.S_
+    if (not rules.double_after_split):
+        if (action == BasicStrategy.PH):
+            return BasicStrategy.H_
+        if (action == BasicStrategy.PD):
+            return BasicStrategy.DH
+    return action
+
+
+# Returns the new hit/stand action keeping a surrender preference of the current action
+def _replace_action(current: str, action: str) -> str:
+    if (current in (BasicStrategy.RH, BasicStrategy.RS) and action in (BasicStrategy.H_, BasicStrategy.S_)):
+        return BasicStrategy.RH if (action == BasicStrategy.H_) else BasicStrategy.RS
+    return action
+
+
+# Returns the table rows a deviation applies to: the hand itself and, for an even hard total, the pair making it
+def _deviation_rows(hand_class: int, total: int) -> list[tuple[int, int]]:
+    rows = [(hand_class, total)]
+    if (hand_class == HARD and total % 2 == 0 and 2 <= total // 2 <= TEN):
+        rows.append((PAIR, total // 2))
+    return rows
+
+
+# Builds the (3, 22, 10, NUM_TC_BUCKETS) table of action indices for the rule set
+def _build_table(rules: RuleSet, deviations=True) -> np.ndarray:
+    bs = BasicStrategy
+    actions = [[[bs.H_] * NUM_UPCARDS for total in range(MAX_TOTAL + 1)] for hand_class in range(3)]
+    for total in range(MAX_TOTAL + 1):
+        actions[HARD][total] = list(bs.BASIC_STRATEGY_HARD[min(max(total - 7, 0), 10)])
+    for total in range(13, MAX_TOTAL + 1):
+        actions[SOFT][total] = list(bs.BASIC_STRATEGY_SOFT[total - 13])
+    for value in range(2, ACE + 1):
+        actions[PAIR][value] = list(bs.BASIC_STRATEGY_PAIRS[value - 2])
+    for applies, hand_class, total, upcard, action in RULE_CHANGES:
+        if (applies(rules)):
+            actions[hand_class][total][upcard - 2] = action
+
+    table = np.zeros((3, MAX_TOTAL + 1, NUM_UPCARDS, NUM_TC_BUCKETS), dtype=np.int8)
+    for hand_class in range(3):
+        for total in range(MAX_TOTAL + 1):
+            for upcard in range(NUM_UPCARDS):
+                table[hand_class, total, upcard, :] = ACTION_INDEX[actions[hand_class][total][upcard]]
+
+    if (deviations):
+        tc = np.arange(TC_MIN, TC_MAX + 1)
+        for hand_class, total, upcard, index, direction, action in ILLUSTRIOUS_18 + SOFT_DEVIATIONS:
+            buckets = (tc >= index) if (direction == ">=") else (tc < index)
+            for row_class, row in _deviation_rows(hand_class, total):
+                for bucket in np.flatnonzero(buckets):
+                    current = ACTION_CODES[table[row_class, row, upcard - 2, bucket]]
+                    # a pair that is split keeps splitting, 5,5 is played as a hard 10
+                    if (row_class != hand_class and _resolve_rules(current, rules) in SPLIT_ACTIONS):
+                        continue
+                    table[row_class, row, upcard - 2, bucket] = ACTION_INDEX[_replace_action(current, action)]
+        for total, upcard, index in FAB_4:
+            for row_class, row in _deviation_rows(HARD, total):
+                for bucket in np.flatnonzero(tc >= index):
+                    current = ACTION_CODES[table[row_class, row, upcard - 2, bucket]]
+                    if (row_class != HARD and _resolve_rules(current, rules) in SPLIT_ACTIONS):
+                        continue
+                    surrender = bs.RS if (current in (bs.S_, bs.RS)) else bs.RH
+                    table[row_class, row, upcard - 2, bucket] = ACTION_INDEX[surrender]
+
+    # resolve rule dependent actions last so deviations cannot reintroduce them
+    resolved = np.array([ACTION_INDEX[_resolve_rules(action, rules)] for action in ACTION_CODES], dtype=np.int8)
+    return resolved[table]
+
+
+# Returns the compiled table for the rule set, loading it from cache_dir if it was compiled before
+def compile_strategy(rules: RuleSet, deviations=True, cache_dir: str = None) -> np.ndarray:
+    path = None
+    if (cache_dir is not None):
+        path = os.path.join(cache_dir, f"strategy_v{STRATEGY_VERSION}_{rules.get_key()}_{'dev' if deviations else 'basic'}.npy")
+        if (os.path.exists(path)):
+            return np.load(path)
+    table = _build_table(rules, deviations)
+    if (path is not None):
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(path, table)
+    return table
+
+
+"""
+CompiledStrategy:
+Drop in replacement for BasicStrategy.get_action() backed by a compiled lookup table.
+The action of each hand is found by (hand class, total, dealer up card, true count bucket).
+"""
+class CompiledStrategy:
+    def __init__(self, rules: RuleSet = None, deviations=True, cache_dir: str = None):
+        self.rules = rules if (rules is not None) else RuleSet()
+        self.deviations = deviations
+        self.table = compile_strategy(self.rules, deviations, cache_dir)
+
+    # returns (total, is_soft) of the cards
+    def sum_cards(self, cards: list[Card]) -> tuple[int, bool]:
+        total = 0
+        num_aces = 0
+        for card in cards:
+            total += card.blackjack_value
+            num_aces += card.blackjack_value == ACE
+        while (total > MAX_TOTAL and num_aces > 0):
+            total -= 10
+            num_aces -= 1
+        return (total, num_aces > 0)
+
+    # returns the action for one hand
+    def get_hand_action(self, hand: list[Card], dealer_card: Card, true_count=0) -> str:
+        num_cards = len(hand)
+        if (num_cards < 2):
+            # only one card, always hit
+            return BasicStrategy.H_
+        total, is_soft = self.sum_cards(hand)
+        if (total > MAX_TOTAL):
+            return BasicStrategy.ER if is_soft else BasicStrategy.BS
+        if (total == MAX_TOTAL and num_cards == 2):
+            return BasicStrategy.BJ
+        bucket = min(max(int(np.floor(true_count)), TC_MIN), TC_MAX) - TC_MIN if self.deviations else -TC_MIN
+        if (num_cards == 2 and hand[0].blackjack_value == hand[1].blackjack_value):
+            return ACTION_CODES[self.table[PAIR, hand[0].blackjack_value, dealer_card.blackjack_value - 2, bucket]]
+        hand_class = SOFT if is_soft else HARD
+        return ACTION_CODES[self.table[hand_class, total, dealer_card.blackjack_value - 2, bucket]]
+
+    # returns a list of actions to take for each hand
+    def get_action(self, player: Player, dealer_card: Card, true_count=0) -> list[str]:
+        return [self.get_hand_action(hand, dealer_card, true_count) for hand in player.get_hands()]
+
+
+# Well known cells of the published basic strategy charts per variant, checked by running this module:
+# (rule set, hand class, total or pair value, dealer up card value, true count, action)
+CHART_CHECKS = [
+    (RuleSet(1, True, True, True), HARD, 11, ACE, 0, BasicStrategy.DH),
+    (RuleSet(1, True, True, True), HARD, 9, 2, 0, BasicStrategy.DH),
+    (RuleSet(1, True, True, True), SOFT, 18, ACE, 0, BasicStrategy.H_),
+    (RuleSet(1, True, True, True), SOFT, 19, 6, 0, BasicStrategy.DS),
+    (RuleSet(1, True, True, True), PAIR, 5, 9, 0, BasicStrategy.DH),
+    (RuleSet(1, False, True, True), SOFT, 18, ACE, 0, BasicStrategy.S_),
+    (RuleSet(6, False, True, True), HARD, 11, ACE, 0, BasicStrategy.H_),
+    (RuleSet(6, False, True, True), HARD, 9, 2, 0, BasicStrategy.H_),
+    (RuleSet(6, False, True, True), HARD, 15, TEN, 0, BasicStrategy.RH),
+    (RuleSet(6, False, True, True), HARD, 16, 9, 0, BasicStrategy.RH),
+    (RuleSet(6, False, True, True), SOFT, 17, 2, 0, BasicStrategy.H_),
+    (RuleSet(6, False, True, True), SOFT, 18, 2, 0, BasicStrategy.S_),
+    (RuleSet(6, False, True, True), SOFT, 19, 6, 0, BasicStrategy.S_),
+    (RuleSet(6, False, True, True), PAIR, 3, 8, 0, BasicStrategy.H_),
+    (RuleSet(6, False, True, True), PAIR, 6, 7, 0, BasicStrategy.H_),
+    (RuleSet(6, False, True, True), PAIR, 7, TEN, 0, BasicStrategy.H_),
+    (RuleSet(6, True, True, True), HARD, 11, ACE, 0, BasicStrategy.DH),
+    (RuleSet(6, True, True, True), HARD, 15, ACE, 0, BasicStrategy.RH),
+    (RuleSet(6, True, True, True), HARD, 17, ACE, 0, BasicStrategy.RS),
+    (RuleSet(6, True, True, True), SOFT, 18, 2, 0, BasicStrategy.DS),
+    (RuleSet(6, True, True, True), SOFT, 18, ACE, 0, BasicStrategy.H_),
+    (RuleSet(6, True, True, True), SOFT, 19, 6, 0, BasicStrategy.DS),
+    (RuleSet(6, True, True, True), PAIR, 2, 2, 0, BasicStrategy.PH),
+    (RuleSet(6, True, False, False), PAIR, 2, 2, 0, BasicStrategy.H_),
+    (RuleSet(6, True, False, False), PAIR, 4, 5, 0, BasicStrategy.H_),
+    (RuleSet(6, True, False, False), PAIR, 6, 2, 0, BasicStrategy.H_),
+    (RuleSet(6, True, False, False), HARD, 16, TEN, -1, BasicStrategy.H_),
+    # index plays
+    (RuleSet(6, True, True, True), HARD, 16, TEN, 0, BasicStrategy.RS),
+    (RuleSet(6, True, True, True), PAIR, 5, TEN, 4, BasicStrategy.DH),
+    (RuleSet(6, True, True, True), PAIR, 5, TEN, 3, BasicStrategy.H_),
+    (RuleSet(6, True, True, True), PAIR, 8, TEN, 5, BasicStrategy.P_),
+    (RuleSet(6, False, True, True), SOFT, 19, 4, 3, BasicStrategy.DS),
+    (RuleSet(6, False, True, True), SOFT, 19, 6, 1, BasicStrategy.DS),
+]
+
+
+if __name__ == "__main__":
+    num_failed = 0
+    strategies = {}
+    for rules, hand_class, total, upcard, true_count, expected in CHART_CHECKS:
+        if (rules.get_key() not in strategies):
+            strategies[rules.get_key()] = CompiledStrategy(rules)
+        table = strategies[rules.get_key()].table
+        action = ACTION_CODES[table[hand_class, total, upcard - 2, min(max(true_count, TC_MIN), TC_MAX) - TC_MIN]]
+        if (action != expected):
+            num_failed += 1
+            print(f"{rules} {['hard', 'soft', 'pair'][hand_class]} {total} vs {upcard} at true count {true_count}: "
+                  f"{action}, chart says {expected}")
+    print(f"{len(CHART_CHECKS) - num_failed}/{len(CHART_CHECKS)} chart cells match")
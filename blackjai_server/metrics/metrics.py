@@ -0,0 +1,185 @@
+import json
+import math
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+Low overhead server metrics: per stage latency histograms and counters.
+Recording a latency is a log, an index and an increment under a lock, so the stages can record every frame.
+Stages recorded by the server, in seconds per frame:
+    receive   - waiting for the next frame from the publisher
+    decode    - JPEG decode (and resize) for the detector
+    inference - card detection, until the detections are back when the detector is shared or runs in a worker process
+    engine    - BlackJAIEngine.update, including the state serialization into the payload
+    serialize - encoding the payload for an egress target
+    send      - handing the encoded payload to the target's socket
+"""
+
+# Stage names in the order they are reported
+STAGES = ["receive", "decode", "inference", "engine", "serialize", "send"]
+
+
+"""
+LatencyHistogram:
+Counts latencies in log spaced buckets from MIN_SECONDS growing by GROWTH per bucket (about 10 us to 16 s),
+so percentiles are accurate to within one bucket (10%). Latencies outside the range fall in the first or last bucket.
+"""
+class LatencyHistogram:
+    MIN_SECONDS = 1e-5
+    GROWTH = 1.1
+    NUM_BUCKETS = 150
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self._log_growth = math.log(self.GROWTH)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        if (seconds > self.MIN_SECONDS):
+            index = min(int(math.log(seconds / self.MIN_SECONDS) / self._log_growth), self.NUM_BUCKETS - 1)
+        else:
+            index = 0
+        with self._lock:
+            self.counts[index] += 1
+
+    # Returns the upper edge in seconds of the bucket holding the p-th percentile (0 - 100) of the counts
+    def get_percentile(self, p: float, counts: list[int] = None) -> float:
+        counts = counts if (counts is not None) else self.counts
+        rank = math.ceil(sum(counts) * p / 100)
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if (cumulative >= max(rank, 1)):
+                return self.MIN_SECONDS * self.GROWTH ** (index + 1)
+        return 0.0
+
+    # Returns the count and the p50 / p95 / p99 in milliseconds. counts defaults to every latency recorded,
+    # pass the difference of two get_counts() for the latencies of an interval.
+    def get_stats(self, counts: list[int] = None) -> dict:
+        counts = counts if (counts is not None) else self.get_counts()
+        num = sum(counts)
+        if (num == 0):
+            return {"count": 0}
+        return {
+            "count": num,
+            "p50": round(1000 * self.get_percentile(50, counts), 3),
+            "p95": round(1000 * self.get_percentile(95, counts), 3),
+            "p99": round(1000 * self.get_percentile(99, counts), 3),
+        }
+
+    def get_counts(self) -> list[int]:
+        with self._lock:
+            return list(self.counts)
+
+
+"""
+Metrics:
+The latency histograms and counters of one stream (e.g. one table). Histograms and counters are created on first use.
+get_interval_line() formats the latencies and counter increments since its previous call for the periodic log line,
+snapshot() returns everything since the start for the pull endpoint.
+"""
+class Metrics:
+    def __init__(self, name="server"):
+        self.name = name
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._last_counts = {}
+        self._last_counters = {}
+
+    def get_histogram(self, stage: str) -> LatencyHistogram:
+        histogram = self.histograms.get(stage)
+        if (histogram is None):
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    # Records the latency of a stage in seconds
+    def record(self, stage: str, seconds: float):
+        self.get_histogram(stage).record(seconds)
+
+    # Records the time since start (a time.perf_counter() value) for the stage and returns the current time,
+    # so consecutive stages can be timed with one clock read each
+    def record_since(self, stage: str, start: float) -> float:
+        now = time.perf_counter()
+        self.get_histogram(stage).record(now - start)
+        return now
+
+    def increment(self, counter: str, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    # Sets a counter kept elsewhere, e.g. the frames received by the VideoStreamSubscriber
+    def set_counter(self, counter: str, value: int):
+        with self._lock:
+            self.counters[counter] = value
+
+    def _get_stage_names(self) -> list[str]:
+        return [stage for stage in STAGES if stage in self.histograms] + sorted(stage for stage in self.histograms if stage not in STAGES)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "name": self.name,
+            "latency_ms": {stage: self.histograms[stage].get_stats() for stage in self._get_stage_names()},
+            "counters": counters,
+        }
+
+    def get_interval_line(self) -> str:
+        stages = []
+        for stage in self._get_stage_names():
+            counts = self.histograms[stage].get_counts()
+            last = self._last_counts.get(stage, [0] * len(counts))
+            stats = self.histograms[stage].get_stats([count - last_count for count, last_count in zip(counts, last)])
+            self._last_counts[stage] = counts
+            if (stats["count"] > 0):
+                stages.append(f"{stage} {stats['p50']}/{stats['p95']}/{stats['p99']}")
+        with self._lock:
+            counters = dict(self.counters)
+        increments = [f"{counter} +{value - self._last_counters.get(counter, 0)}" for counter, value in sorted(counters.items())]
+        self._last_counters = counters
+        return (f"Metrics {self.name} (p50/p95/p99 ms): " + (", ".join(stages) if stages else "no frames")
+                + " | " + ", ".join(increments))
+
+    def __str__(self):
+        return self.get_interval_line()
+
+
+"""
+MetricsServer:
+A local pull endpoint serving snapshot() of each Metrics as JSON on http://<host>:<port>/metrics from a daemon thread.
+"""
+class MetricsServer:
+    def __init__(self, metrics: list[Metrics], port: int, host="127.0.0.1"):
+        self.metrics = metrics
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if (self.path.rstrip("/") not in ("", "/metrics")):
+                    self.send_error(404)
+                    return
+                body = json.dumps([metrics.snapshot() for metrics in owner.metrics]).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # keep the request log out of the server output
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print("Serving metrics on http://" + str(self.httpd.server_address[0]) + ":" + str(self.httpd.server_address[1]) + "/metrics")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
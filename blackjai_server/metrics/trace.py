@@ -0,0 +1,77 @@
+import time
+
+# Stages timestamped by a FrameTrace, in pipeline order
+TRACE_STAGES = ["receive", "decode", "inference", "engine"]
+
+
+"""
+FrameTrace:
+Follows one frame from the receiver to the engine payload. Holds the frame's sequence number and the wall clock time
+(time.time(), seconds since the epoch) at which each stage finished with it: receive is the arrival time from the
+VideoStreamSubscriber, decode, inference and engine are marked by the stages. The engine adds serialize() to the
+payload as "trace", so a client with a synchronized clock can split its glass to recommendation latency by stage.
+"""
+class FrameTrace:
+    def __init__(self, seq: int, recv_time: float):
+        self.seq = seq
+        self.timestamps = {"receive": recv_time}
+
+    # Marks the stage as done with the frame now
+    def mark(self, stage: str):
+        self.timestamps[stage] = time.time()
+
+    # Returns the seconds from receiving the frame to the end of the stage, or None if the stage is not marked
+    def get_elapsed(self, stage: str) -> float:
+        if (stage not in self.timestamps):
+            return None
+        return self.timestamps[stage] - self.timestamps["receive"]
+
+    def serialize(self) -> dict:
+        trace = {"seq": self.seq}
+        for stage, timestamp in self.timestamps.items():
+            trace[stage] = round(timestamp, 6)
+        return trace
+
+    def __str__(self):
+        stages = [stage + " +" + str(round(1000 * self.get_elapsed(stage), 2)) + " ms" for stage in self.timestamps if stage != "receive"]
+        return "(seq " + str(self.seq) + (" " + ", ".join(stages) if stages else "") + ")"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# Returns the milliseconds from the previous mark to each stage of a payload trace, so each stage includes the time the
+# frame waited for it, ending with "egress": from the engine until arrival (wall clock seconds), which covers the egress
+# queue, serialization and the network. Stages not marked are skipped.
+def get_stage_latencies(trace: dict, arrival: float) -> dict:
+    latencies = {}
+    last = trace["receive"]
+    for stage in TRACE_STAGES[1:]:
+        if (stage in trace):
+            latencies[stage] = round(1000 * (trace[stage] - last), 2)
+            last = trace[stage]
+    latencies["egress"] = round(1000 * (arrival - last), 2)
+    latencies["total"] = round(1000 * (arrival - trace["receive"]), 2)
+    return latencies
+
+
+if __name__ == "__main__":
+    # stand-in for the phone printing the latency of each traced payload it receives:
+    # python -m blackjai_server.metrics.trace [port] [json|binary]
+    import sys
+    import json
+    import socket
+    from blackjai_server.egress.wire import BinaryPayloadDecoder, BINARY_FORMAT
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    binary = len(sys.argv) > 2 and sys.argv[2] == BINARY_FORMAT
+    decoder = BinaryPayloadDecoder()
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("0.0.0.0", port))
+    print("Listening for payloads on port " + str(port))
+    while True:
+        message = receiver.recv(65536)
+        arrival = time.time()
+        payload = decoder.decode(message) if binary else json.loads(message)
+        if (payload is not None and "trace" in payload):
+            print("frame " + str(payload["trace"]["seq"]) + " ms:", get_stage_latencies(payload["trace"], arrival))
@@ -0,0 +1,201 @@
+import queue
+import threading
+import traceback
+from collections import deque
+
+# Overflow policies for a full BoundedQueue
+# drop_oldest - evict the oldest queued item to make room for the new one
+# latest_wins - evict every queued item so only the newest one is kept
+# block       - wait until the consumer makes room
+DROP_OLDEST = "drop_oldest"
+LATEST_WINS = "latest_wins"
+BLOCK = "block"
+OVERFLOW_POLICIES = [DROP_OLDEST, LATEST_WINS, BLOCK]
+
+
+"""
+BoundedQueue:
+A thread safe, fixed capacity queue linking two pipeline stages.
+Keeps count of items put and items dropped by the overflow policy.
+on_drop, if given, is called with every dropped item (outside the lock), e.g. to give back a pooled buffer.
+"""
+class BoundedQueue:
+    def __init__(self, maxsize=2, policy=DROP_OLDEST, on_drop=None):
+        if (maxsize < 1):
+            raise ValueError("BoundedQueue maxsize must be at least 1")
+        if (policy not in OVERFLOW_POLICIES):
+            raise ValueError("Unknown overflow policy: " + str(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.num_put = 0
+        self.num_dropped = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    # Puts an item in the queue, applying the overflow policy if the queue is full.
+    # Returns the number of items dropped to make room.
+    def put(self, item, timeout=None) -> int:
+        dropped = []
+        with self._cond:
+            if (self.policy == LATEST_WINS):
+                dropped = list(self._items)
+                self._items.clear()
+            elif (len(self._items) >= self.maxsize):
+                if (self.policy == DROP_OLDEST):
+                    dropped = [self._items.popleft()]
+                elif (not self._cond.wait_for(lambda: len(self._items) < self.maxsize, timeout=timeout)):
+                    raise queue.Full()
+            self._items.append(item)
+            self.num_put += 1
+            self.num_dropped += len(dropped)
+            self._cond.notify_all()
+        if (self.on_drop is not None):
+            for dropped_item in dropped:
+                self.on_drop(dropped_item)
+        return len(dropped)
+
+    # Removes and returns the oldest item. Raises queue.Empty if nothing arrives before the timeout.
+    def get(self, timeout=None):
+        with self._cond:
+            if (not self._cond.wait_for(lambda: len(self._items) > 0, timeout=timeout)):
+                raise queue.Empty()
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    # Removes and returns the oldest item, or None if the queue is empty
+    def get_nowait(self):
+        try:
+            return self.get(timeout=0)
+        except queue.Empty:
+            return None
+
+    def clear(self):
+        with self._cond:
+            dropped = list(self._items)
+            self._items.clear()
+            self._cond.notify_all()
+        if (self.on_drop is not None):
+            for dropped_item in dropped:
+                self.on_drop(dropped_item)
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._items)
+
+    def __len__(self):
+        return self.qsize()
+
+
+"""
+PipelineStage:
+A worker thread that takes items from its input queue, applies its function, and
+puts the result on its output queue. Returning None from the function drops the item.
+"""
+class PipelineStage:
+    # how long a worker waits on its input queue before re-checking the stop flag
+    POLL_TIMEOUT = 0.5
+
+    def __init__(self, name: str, func, in_queue: BoundedQueue, out_queue: BoundedQueue = None):
+        self.name = name
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.num_processed = 0
+        self.error = None
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, args=(), name=f"blackjai-{name}")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+
+    def join(self, timeout=None):
+        self._thread.join(timeout=timeout)
+
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop:
+            try:
+                item = self.in_queue.get(timeout=self.POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+            try:
+                result = self.func(item)
+            except Exception as ex:
+                print(f"Error in pipeline stage '{self.name}':", ex)
+                traceback.print_exc()
+                self.error = ex
+                self._stop = True
+                break
+            self.num_processed += 1
+            if (result is not None and self.out_queue is not None):
+                self.out_queue.put(result)
+
+
+"""
+BlackJAIPipeline:
+Runs each stage (e.g. decode, inference, engine, egress) in its own worker thread,
+linked by bounded queues. Throughput is set by the slowest stage alone, and the overflow
+policy keeps stale frames from piling up in front of it.
+A stage is (name, func) or (name, func, on_drop), where on_drop is called with each item dropped in front of it.
+"""
+class BlackJAIPipeline:
+    def __init__(self, stages: list[tuple], queue_size=2, policy=DROP_OLDEST, output_size=1):
+        if (len(stages) == 0):
+            raise ValueError("BlackJAIPipeline needs at least one stage")
+        self.queues = [BoundedQueue(queue_size, policy, stages[i][2] if (len(stages[i]) > 2) else None)
+                       for i in range(len(stages))]
+        # results of the last stage, latest wins so a slow consumer only ever sees the newest
+        self.output = BoundedQueue(output_size, LATEST_WINS)
+        self.stages = []
+        for i in range(len(stages)):
+            name, func = stages[i][:2]
+            out_queue = self.queues[i + 1] if (i + 1 < len(stages)) else self.output
+            self.stages.append(PipelineStage(name, func, self.queues[i], out_queue))
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join(timeout=PipelineStage.POLL_TIMEOUT * 2)
+
+    # Submits an item to the first stage. Returns the number of items dropped to make room.
+    def put(self, item) -> int:
+        self.check()
+        return self.queues[0].put(item)
+
+    # Returns the newest result of the last stage, or None if there is none
+    def get_output(self):
+        return self.output.get_nowait()
+
+    # Raises the first error raised inside a stage worker, if any
+    def check(self):
+        for stage in self.stages:
+            if (stage.error is not None):
+                raise RuntimeError(f"Pipeline stage '{stage.name}' failed") from stage.error
+
+    # Returns the number of items waiting in front of each stage
+    def get_queue_depths(self) -> dict[str, int]:
+        return {stage.name: stage.in_queue.qsize() for stage in self.stages}
+
+    # Returns the number of items dropped in front of each stage
+    def get_drop_counts(self) -> dict[str, int]:
+        return {stage.name: stage.in_queue.num_dropped for stage in self.stages}
+
+    # Returns the number of items each stage has finished processing
+    def get_processed_counts(self) -> dict[str, int]:
+        return {stage.name: stage.num_processed for stage in self.stages}
+
+    def __str__(self):
+        return "Queue depths: " + str(self.get_queue_depths()) + " Dropped: " + str(self.get_drop_counts())
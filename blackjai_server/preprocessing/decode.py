@@ -0,0 +1,111 @@
+import threading
+import cv2 as cv
+import numpy as np
+
+# imdecode flags that let the JPEG decoder produce a reduced resolution image directly,
+# which is much cheaper than decoding at full resolution and resizing afterwards
+DECODE_FLAGS = {
+    1: cv.IMREAD_COLOR,
+    2: cv.IMREAD_REDUCED_COLOR_2,
+    4: cv.IMREAD_REDUCED_COLOR_4,
+    8: cv.IMREAD_REDUCED_COLOR_8,
+}
+
+
+"""
+FrameBufferPool:
+Preallocated frame buffers with tracked ownership. acquire() hands out a buffer nobody holds and release() gives it
+back once the frame is no longer used (e.g. after detection). A buffer is never handed out while it is held: if every
+buffer is held, the pool grows by one buffer (counted in num_grown) instead of overwriting a frame still in flight.
+Thread safe, as frames are decoded and released on different threads.
+"""
+class FrameBufferPool:
+    def __init__(self, shape: tuple, pool_size=8, dtype=np.uint8):
+        if (pool_size < 1):
+            raise ValueError("FrameBufferPool pool_size must be at least 1")
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.buffers = [np.empty(self.shape, dtype=dtype) for i in range(pool_size)]
+        self.num_grown = 0
+        self._free = list(self.buffers)
+        self._held = {}
+        self._lock = threading.Lock()
+
+    def acquire(self) -> np.ndarray:
+        with self._lock:
+            if (len(self._free) > 0):
+                buffer = self._free.pop()
+            else:
+                buffer = np.empty(self.shape, dtype=self.dtype)
+                self.buffers.append(buffer)
+                self.num_grown += 1
+                if (self.num_grown == 1):
+                    print("Warning: all " + str(len(self.buffers) - 1) + " pooled frame buffers are in flight, growing the pool")
+            self._held[id(buffer)] = buffer
+        return buffer
+
+    # Returns the buffer to the pool. Returns false if it is not a held buffer of this pool.
+    def release(self, buffer: np.ndarray) -> bool:
+        with self._lock:
+            if (self._held.pop(id(buffer), None) is None):
+                return False
+            self._free.append(buffer)
+            return True
+
+    # number of buffers handed out and not released yet
+    def get_num_held(self) -> int:
+        with self._lock:
+            return len(self._held)
+
+    def __len__(self):
+        return len(self.buffers)
+
+
+"""
+FrameDecoder:
+Decodes JPEG frames received from the publisher without the extra np.array copy.
+scale (1, 2, 4 or 8) decodes straight to 1/scale resolution. If target_size (width, height)
+is given, the decoded image is resized into a pooled buffer of that size, e.g. to match the
+detector's input size, which the caller hands back with release() once the frame is used.
+cv.imdecode() cannot decode into a caller owned buffer, so only the resized frame is pooled.
+get_coord_scale() returns the factors that map coordinates in the decoded image back to the
+full resolution frame.
+"""
+class FrameDecoder:
+    def __init__(self, scale=1, target_size: tuple[int, int] = None, pool_size=8):
+        if (scale not in DECODE_FLAGS):
+            raise ValueError("FrameDecoder scale must be one of " + str(list(DECODE_FLAGS.keys())))
+        self.scale = scale
+        self.flags = DECODE_FLAGS[scale]
+        self.target_size = tuple(target_size) if (target_size is not None) else None
+        self.pool_size = pool_size
+        self.pool = None
+        self.coord_scale = (float(scale), float(scale))
+
+    def decode(self, frame) -> np.ndarray:
+        image = cv.imdecode(np.frombuffer(frame, dtype=np.uint8), self.flags)
+        if (image is None):
+            raise ValueError("Error: could not decode frame. In FrameDecoder.decode()")
+        height, width = image.shape[:2]
+        if ((self.target_size is None) or (self.target_size == (width, height))):
+            self.coord_scale = (float(self.scale), float(self.scale))
+            return image
+
+        # resize into a pooled buffer instead of allocating a new frame
+        shape = (self.target_size[1], self.target_size[0]) + image.shape[2:]
+        if ((self.pool is None) or (self.pool.shape != shape)):
+            self.pool = FrameBufferPool(shape, self.pool_size, image.dtype)
+        resized = self.pool.acquire()
+        cv.resize(image, self.target_size, dst=resized, interpolation=cv.INTER_AREA)
+        self.coord_scale = (self.scale * width / self.target_size[0], self.scale * height / self.target_size[1])
+        return resized
+
+    # Gives a decoded image back to the pool. Images that are not pooled buffers are ignored.
+    def release(self, image):
+        pool = self.pool
+        if (pool is not None and image is not None):
+            pool.release(image)
+
+    # Returns the (x, y) factors mapping coordinates of the last decoded image to the full resolution frame
+    def get_coord_scale(self) -> tuple[float, float]:
+        return self.coord_scale
@@ -1,20 +1,38 @@
-import sys
 import os
+import asyncio
+import functools
 import traceback
-import socket
 import cv2 as cv
 import imagezmq
 import threading
 import numpy as np
-from roboflow import Roboflow
-from time import sleep
 import datetime
-from conf import BLACKJAI_CONNECT_IP, BLACKJAI_CONNECT_PORT
-from PIL import Image
-from ultralytics import YOLO
-from blackjai_server.detection.detect import detect_card_type_roboflow, detect_card_type_yolo
+import time
+from conf import PIPELINE_QUEUE_SIZE, PIPELINE_OVERFLOW_POLICY, STATS_LOG_INTERVAL, METRICS_PORT, TRACE_FRAMES
+from conf import TABLES, TABLE_BATCH_WAIT, PAYLOAD_FORMAT
+from conf import PAYLOAD_KEYFRAME_INTERVAL, PAYLOAD_KEYFRAME_PERIOD, EGRESS_UDP_TARGETS, EGRESS_ZMQ_ADDRESS, EGRESS_ZMQ_FORMAT, EGRESS_ZMQ_MAX_RATE
+from conf import DECODE_SCALE, DECODE_TARGET_SIZE, DECODE_POOL_SIZE, PREVIEW_EVERY_N, PREVIEW_DIR, RECORD_SECONDS, RECORD_FPS
+from conf import DETECTOR_BACKEND, DETECTOR_MODEL_PATH, DETECTOR_CONFIDENCE, INFERENCE_WORKERS, INFERENCE_SLOTS
+from conf import NUM_PLAYERS, TABLE_LAYOUT_PATH, NUM_DECKS, PENETRATION
+from conf import DEALER_HITS_SOFT_17, DOUBLE_AFTER_SPLIT, SURRENDER, STRATEGY_DEVIATIONS, STRATEGY_CACHE_DIR
+from conf import COMPOSITION_EV, EV_CACHE_SIZE
+from conf import BANKROLL, MIN_BET, MAX_BET, KELLY_FRACTION, BET_RAMP, BANKROLL_SIMULATION_SHOES, BANKROLL_CACHE_DIR
+from blackjai_server.core.batch import DetectionBatcher
+from blackjai_server.core.core import FrameSource, ServerCore
+from blackjai_server.detection.backends import create_detector_backend
+from blackjai_server.detection.detect import detect_card_type_yolo
+from blackjai_server.detection.workers import InferencePool
+from blackjai_server.egress.display import DisplayWindows
+from blackjai_server.egress.preview import PreviewSink
+from blackjai_server.egress.fanout import EgressHub, UdpTarget, ZmqPubTarget
 from blackjai_server.engine.engine import BlackJAIEngine
-from blackjai_server.preprocessing.preprocess import greyscale, apply_contrast, apply_threshold, convert_to_rgb, apply_dilate
+from blackjai_server.metrics.metrics import Metrics, MetricsServer
+from blackjai_server.metrics.trace import FrameTrace
+from blackjai_server.engine.layout import TableLayout
+from blackjai_server.engine.strategy import RuleSet
+from blackjai_server.simulation.bankroll import BankrollPlan, simulation_penetration
+from blackjai_server.pipeline.pipeline import BlackJAIPipeline
+from blackjai_server.preprocessing.decode import FrameDecoder
 
 
 """
@@ -22,115 +40,485 @@ BlackJAIServer:
 This class is used to start the server and receive images from the publisher.
 """
 class BlackJAIServer:
-    def __init__(self, hostname="127.0.0.1", port=5555, view_mode="view"):
+    # preview mode writes every Nth raw frame when the annotated preview (PREVIEW_EVERY_N) is disabled
+    RAW_PREVIEW_EVERY_N = 30
+
+    def __init__(self, hostname="127.0.0.1", port=5555, view_mode="view", headless=False):
         self.hostname = hostname
         self.port = port
         self.view_mode = view_mode
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # headless servers never render annotated images or open windows, except for the low rate preview
+        self.headless = headless
+        # OpenCV windows are drawn on their own thread, off the event loop and the pipeline
+        self.display = DisplayWindows() if not headless else None
+        # Payloads are sent to every egress target from a background thread
+        targets = [UdpTarget(ip, port, payload_format, max_rate, NUM_DECKS, PAYLOAD_KEYFRAME_INTERVAL)
+                   for ip, port, payload_format, max_rate in EGRESS_UDP_TARGETS]
+        if EGRESS_ZMQ_ADDRESS is not None:
+            targets.append(ZmqPubTarget(EGRESS_ZMQ_ADDRESS, EGRESS_ZMQ_FORMAT, EGRESS_ZMQ_MAX_RATE, NUM_DECKS, PAYLOAD_KEYFRAME_INTERVAL))
+        # Per stage latencies and frame counters, logged with the stats and served on METRICS_PORT
+        self.metrics = Metrics()
+        self.egress = EgressHub(targets, metrics=self.metrics, keyframe_period=PAYLOAD_KEYFRAME_PERIOD)
+        self.preview = PreviewSink(every_n=PREVIEW_EVERY_N, directory=PREVIEW_DIR)
+        self.bankroll_plan = None
+
+        # Decoder for frames passed to the detector, optionally at a reduced resolution
+        self.decoder = FrameDecoder(scale=DECODE_SCALE, target_size=DECODE_TARGET_SIZE, pool_size=DECODE_POOL_SIZE)
 
-        # Load in YOLO model
-        self.yolo_model = YOLO(f"{os.getcwd()}/blackjai_server/ml_models/best_m_31eps_all.pt")
+        # Load in YOLO model with the configured detector backend. With inference workers the model is only
+        # loaded in this process if a mode detects in process (see _detect()).
+        self.yolo_model = create_detector_backend(DETECTOR_BACKEND, DETECTOR_MODEL_PATH, conf=DETECTOR_CONFIDENCE) \
+            if INFERENCE_WORKERS == 0 else None
+        # Pool of inference worker processes used by process and tables modes when INFERENCE_WORKERS > 0
+        self.inference_pool = None
 
+    # view_mode is one mode or several comma separated modes run on the same stream (e.g. "process,record,preview").
+    # pipeline and tables modes run on their own.
     def start(self):
+        modes = [mode.strip() for mode in self.view_mode.split(",")]
+        for mode in modes:
+            if mode not in self.MODE_TASKS and mode not in ("pipeline", "tables"):
+                raise ValueError("Unknown view mode: " + mode + ". Choose from " + str(list(self.MODE_TASKS) + ["pipeline", "tables"]))
+        if self.display is not None:
+            self.display.start()
+        if modes == ["tables"]:
+            self._run_tables()
+            self._close_display()
+            return
         receiver = VideoStreamSubscriber(self.hostname, self.port)
-        engine = BlackJAIEngine(frame_size=(1920, 1080), buffer_size=50)
-
+        self.egress.start()
+        core = None
+        metrics_server = None
         try:
-            if self.view_mode == "view":
-                while True:
-                    # Receive image from publisher
-                    msg, frame = receiver.receive(timeout=2)
-
-                    # Display image
-                    image = cv.imdecode(np.frombuffer(frame, dtype='uint8'), -1)
-                    cv.imshow(f"BlackJAI Server Feed - Mode: {self.view_mode}", image)
-                    cv.waitKey(1)
-            elif self.view_mode == "detect":
-                while True:
-                    # Receive image from publisher and convert to numpy array
-                    msg, frame = receiver.receive(timeout=4)
-                    image = np.array(cv.imdecode(np.frombuffer(frame, dtype='uint8'), -1))
-
-                    # Detect image
-                    # image, json_data = detect_card_type_roboflow(image, self.rf_model)
-
-                    # Detect image using YOLO
-                    image, json_data = detect_card_type_yolo(image, self.yolo_model)
-
-                    # Display image
-                    cv.imshow(f"BlackJAI Server Feed - Mode: {self.view_mode}", image)
-                    cv.waitKey(1)
-            elif self.view_mode == "process":
-                while True:
-                    # Receive image from publisher and convert to numpy array
-                    msg, frame = receiver.receive(timeout=4)
-                    image = np.array(cv.imdecode(np.frombuffer(frame, dtype='uint8'), -1))
-
-                    # Detect image using Roboflow
-                    # image, json_data = detect_card_type_roboflow(image, self.rf_model)
-
-                    # Detect image using YOLO
-                    image, json_data = detect_card_type_yolo(image, self.yolo_model)
-
-                    # Update engine
-                    payload = engine.update(json_data)
-
-                    # Send payload to ip 192.168.1.9 port 5005 using UDP
-                    # encode payload
-                    payload = str(payload).replace("'", '"').encode('utf-8')
-                    self.socket.sendto(payload, ("192.168.50.9", BLACKJAI_CONNECT_PORT))
-
-                    # Display image
-                    cv.imshow(f"BlackJAI Server Feed - Mode: {self.view_mode}", image)
-                    cv.waitKey(1)
-            elif self.view_mode == "picture":
-                # Receive image from publisher and convert to numpy array
-                msg, frame = receiver.receive(timeout=4)
-                image = cv.imdecode(np.frombuffer(frame, dtype='uint8'), -1)
-                print(image)
-                # Get datetime
-                now = datetime.datetime.now()
-                # save image to disk with name as datetime
-                print("saving")
-                cv.imshow(f"BlackJAI Server Feed - Mode: {self.view_mode}", image)
-                cv.waitKey(0)
-                success = cv.imwrite(f"{os.getcwd()}/blackjai_server/data/pictures/{now.strftime('%Y_%m_%d__%H_%M_%S')}.jpg", image)
-                print(success)
-            elif self.view_mode == "timed_video":
-                # Receive image from publisher and convert to numpy array
-                msg, frame = receiver.receive(timeout=4)
-                image = cv.imdecode(np.frombuffer(frame, dtype='uint8'), -1)
-                # Get size of image
-                height, width, layers = image.shape
-                # Set timer using datetime
-                start_time = datetime.datetime.now()
-                # Create video writer
-                result = cv.VideoWriter(f"./BlackJAI/dev/blackjai-server/blackjai_server/data/videos/{start_time.strftime('%Y_%m_%d__%H_%M_%S')}.avi",
-                                        cv.VideoWriter_fourcc(*'MJPG'), 10, (width, height))
-                while True:
-                    # Receive image from publisher and convert to numpy array
-                    msg, frame = receiver.receive(timeout=4)
-                    image = cv.imdecode(np.frombuffer(frame, dtype='uint8'), -1)
-                    # Write image to video
-                    result.write(image)
-                    # Display image
-                    # if it has been 10 seconds, break
-                    if (datetime.datetime.now() - start_time).seconds >= 20:
-                        break
-                    cv.imshow(f"BlackJAI Server Feed - Mode: {self.view_mode}", image)
-                    cv.waitKey(100)
-                # Release video
-                result.release()
-
-        except (KeyboardInterrupt, SystemExit):
+            metrics_server = self._start_metrics_server([self.metrics])
+            engine = self._create_engine() if any(mode in ("process", "pipeline") for mode in modes) else None
+            if modes == ["pipeline"]:
+                self._run_pipeline(receiver, engine, metrics_server)
+            else:
+                core = ServerCore(FrameSource(receiver, timeout=4, metrics=self.metrics))
+                for mode in modes:
+                    if mode == "process" and INFERENCE_WORKERS > 0:
+                        self._add_process_pool_tasks(core, engine)
+                        continue
+                    core.add_task(mode, functools.partial(getattr(self, self.MODE_TASKS[mode]), core, engine))
+                if STATS_LOG_INTERVAL > 0 or metrics_server is not None:
+                    core.add_task("stats", functools.partial(self._stats_task, core, receiver), background=True,
+                                  subscribe=False)
+                asyncio.run(core.run())
+        except KeyboardInterrupt:
             print('Exit due to keyboard interrupt')
         except Exception as ex:
             print('Python error with no Exception handler:')
             print('Traceback error:', ex)
             traceback.print_exc()
         finally:
+            if core is not None:
+                core.close()
+            if self.inference_pool is not None:
+                self.inference_pool.close()
+            if metrics_server is not None:
+                metrics_server.stop()
             receiver.close()
-            sys.exit()
+            self.egress.stop()
+            self._close_display()
+
+    def _close_display(self):
+        if self.display is not None:
+            self.display.close()
+
+    # Creates an engine for the table rules in conf.py. The bankroll plan is built once and shared by every engine.
+    def _create_engine(self) -> BlackJAIEngine:
+        layout = TableLayout.load(TABLE_LAYOUT_PATH) if TABLE_LAYOUT_PATH is not None else None
+        rules = RuleSet(num_decks=NUM_DECKS, dealer_hits_soft_17=DEALER_HITS_SOFT_17, double_after_split=DOUBLE_AFTER_SPLIT,
+                        surrender=SURRENDER)
+        bankroll_plan = self.bankroll_plan
+        if (BANKROLL is not None and bankroll_plan is None):
+            bankroll_plan = BankrollPlan.build(rules, BANKROLL, MIN_BET, MAX_BET, KELLY_FRACTION, BET_RAMP,
+                                               penetration=simulation_penetration(PENETRATION),
+                                               deviations=STRATEGY_DEVIATIONS, num_shoes=BANKROLL_SIMULATION_SHOES,
+                                               cache_dir=BANKROLL_CACHE_DIR)
+            print(bankroll_plan)
+            self.bankroll_plan = bankroll_plan
+        return BlackJAIEngine(frame_size=(1920, 1080), num_players=NUM_PLAYERS, buffer_size=50, layout=layout,
+                              num_decks=NUM_DECKS, penetration=PENETRATION, rules=rules,
+                              deviations=STRATEGY_DEVIATIONS, strategy_cache_dir=STRATEGY_CACHE_DIR,
+                              composition_ev=COMPOSITION_EV, ev_cache_size=EV_CACHE_SIZE,
+                              bankroll_plan=bankroll_plan)
+
+    # Mode name -> method running the mode as a task of the ServerCore. Each method takes (core, engine, frames)
+    # where frames is the task's FrameSubscription. Add a mode by adding an async method here.
+    MODE_TASKS = {
+        "view": "_view_task",
+        "detect": "_detect_task",
+        "process": "_process_task",
+        "preview": "_preview_task",
+        "picture": "_picture_task",
+        "timed_video": "_record_task",
+        "record": "_record_task",
+    }
+
+    # Only displays images received from the publisher
+    async def _view_task(self, core, engine, frames):
+        while True:
+            msg, frame, meta = await frames.get()
+            image = await core.run_io(self._decode_full, frame)
+            self._display(image, mode="view")
+
+    # Detects cards and displays the annotated images
+    async def _detect_task(self, core, engine, frames):
+        while True:
+            msg, frame, meta = await frames.get()
+            image, detections = await core.run_inference(self._decode_and_detect, frame, None)
+            self._display(image, mode="detect")
+
+    # Detects cards, updates the engine and sends the payload to the egress targets
+    async def _process_task(self, core, engine, frames):
+        while True:
+            msg, frame, meta = await frames.get()
+            trace = self._create_trace(meta)
+            image, detections = await core.run_inference(self._decode_and_detect, frame, trace)
+            payload = await core.run_engine(self._update_engine, engine, self.metrics, detections, trace)
+            self._send_payload(payload)
+            self._display(image, mode="process")
+
+    # Process mode with INFERENCE_WORKERS > 0. One task decodes frames and hands them to the worker processes,
+    # up to one frame per worker at once, while a second task updates the engine with the detections in frame order.
+    def _add_process_pool_tasks(self, core, engine):
+        pool = self._start_inference_pool()
+        in_flight = asyncio.Queue(maxsize=pool.num_workers)
+
+        async def detect_task(frames):
+            while True:
+                msg, frame, meta = await frames.get()
+                trace = self._create_trace(meta)
+                image, scale = await core.run_io(self._decode_with_scale, self.decoder, self.metrics, frame, trace)
+                # waits while every worker is busy, the frame subscription keeps only the newest frame meanwhile
+                await in_flight.put((asyncio.ensure_future(self._timed_detect(core, pool, self.decoder, self.metrics, image, scale, trace)), trace))
+
+        async def engine_task(frames):
+            while True:
+                detection, trace = await in_flight.get()
+                image, detections = await detection
+                payload = await core.run_engine(self._update_engine, engine, self.metrics, detections, trace)
+                self._send_payload(payload)
+                self._display(image, mode="process")
+
+        core.add_task("process", detect_task)
+        core.add_task("process_engine", engine_task, subscribe=False)
+
+    def _start_inference_pool(self) -> InferencePool:
+        if self.inference_pool is None:
+            self.inference_pool = InferencePool(INFERENCE_WORKERS, DETECTOR_BACKEND, DETECTOR_MODEL_PATH, conf=DETECTOR_CONFIDENCE,
+                                                num_slots=INFERENCE_SLOTS, annotate=not self.headless)
+            self.inference_pool.start()
+            print("Started " + str(INFERENCE_WORKERS) + " inference workers")
+        return self.inference_pool
+
+    # Writes every PREVIEW_EVERY_N-th received frame (every RAW_PREVIEW_EVERY_N-th if the preview is disabled)
+    # to latest_raw.jpg, without detection
+    async def _preview_task(self, core, engine, frames):
+        sink = PreviewSink(every_n=PREVIEW_EVERY_N if PREVIEW_EVERY_N > 0 else self.RAW_PREVIEW_EVERY_N, directory=PREVIEW_DIR,
+                           file_name="latest_raw.jpg")
+        while True:
+            msg, frame, meta = await frames.get()
+            if sink.tick():
+                image = await core.run_io(self._decode_full, frame)
+                await core.run_io(sink.write, image)
+
+    # Saves one frame to blackjai_server/data/pictures
+    async def _picture_task(self, core, engine, frames):
+        msg, frame, meta = await frames.get()
+        image = await core.run_io(self._decode_full, frame)
+        now = datetime.datetime.now()
+        directory = f"{os.getcwd()}/blackjai_server/data/pictures"
+        os.makedirs(directory, exist_ok=True)
+        path = f"{directory}/{now.strftime('%Y_%m_%d__%H_%M_%S')}.jpg"
+        success = await core.run_io(cv.imwrite, path, image)
+        print("Saved " + path if success else "Error: could not save " + path)
+        # keep the window open until a key is pressed when only taking the picture
+        self._display(image, delay=0 if self.view_mode == "picture" else 1, mode="picture")
+        if self.view_mode == "picture" and self.display is not None:
+            await core.run_io(self.display.wait_idle)
+
+    # Records RECORD_SECONDS of the stream to a video in blackjai_server/data/videos
+    async def _record_task(self, core, engine, frames):
+        start_time = datetime.datetime.now()
+        directory = f"{os.getcwd()}/blackjai_server/data/videos"
+        os.makedirs(directory, exist_ok=True)
+        writer = None
+        try:
+            while (datetime.datetime.now() - start_time).total_seconds() < RECORD_SECONDS:
+                msg, frame, meta = await frames.get()
+                image = await core.run_io(self._decode_full, frame)
+                if writer is None:
+                    height, width = image.shape[:2]
+                    writer = cv.VideoWriter(f"{directory}/{start_time.strftime('%Y_%m_%d__%H_%M_%S')}.avi",
+                                            cv.VideoWriter_fourcc(*'MJPG'), RECORD_FPS, (width, height))
+                await core.run_io(writer.write, image)
+                # keep to the frame rate of the video
+                await asyncio.sleep(1 / RECORD_FPS)
+        finally:
+            if writer is not None:
+                writer.release()
+
+    # Logs the stream, task, egress and metrics stats every STATS_LOG_INTERVAL seconds,
+    # or only updates the frame counters of the metrics endpoint if the log is disabled
+    async def _stats_task(self, core, receiver, frames):
+        while True:
+            await asyncio.sleep(STATS_LOG_INTERVAL if STATS_LOG_INTERVAL > 0 else 1)
+            self._update_frame_counters(self.metrics, receiver)
+            if STATS_LOG_INTERVAL <= 0:
+                continue
+            print("Stream:", receiver.get_stats())
+            print(core)
+            print(self.egress)
+            if self.inference_pool is not None:
+                print(self.inference_pool)
+            print(self.metrics)
+
+    # Serves every table in TABLES from this process: each table has its own receiver, engine and egress target,
+    # and one detector batches the newest frame of each table into a single inference call
+    def _run_tables(self):
+        core = ServerCore()
+        receivers, hubs, table_metrics = [], [], []
+        metrics_server = None
+        try:
+            # the tables share the worker processes if there are any, otherwise a batching detector in this process
+            if INFERENCE_WORKERS > 0:
+                detector = self._start_inference_pool()
+            else:
+                detector = DetectionBatcher(core, self.yolo_model, max_batch_size=max(len(TABLES), 1), max_wait=TABLE_BATCH_WAIT,
+                                            annotate=not self.headless)
+            for table_id, capture_ip, capture_port, connect_ip, connect_port in TABLES:
+                receiver = VideoStreamSubscriber(capture_ip, capture_port)
+                receivers.append(receiver)
+                metrics = Metrics(table_id)
+                table_metrics.append(metrics)
+                egress = EgressHub([UdpTarget(connect_ip, connect_port, PAYLOAD_FORMAT, 0, NUM_DECKS, PAYLOAD_KEYFRAME_INTERVAL)],
+                                   metrics=metrics, keyframe_period=PAYLOAD_KEYFRAME_PERIOD)
+                egress.start()
+                hubs.append(egress)
+                decoder = FrameDecoder(scale=DECODE_SCALE, target_size=DECODE_TARGET_SIZE, pool_size=DECODE_POOL_SIZE)
+                preview = PreviewSink(every_n=PREVIEW_EVERY_N, directory=PREVIEW_DIR, file_name=f"latest_{table_id}.jpg")
+                source = core.add_source(FrameSource(receiver, timeout=4, keep_waiting=True, metrics=metrics))
+                core.add_task(table_id, functools.partial(self._table_task, core, detector, self._create_engine(), egress, decoder,
+                                                          metrics, preview, table_id), source=source)
+            metrics_server = self._start_metrics_server(table_metrics)
+            if STATS_LOG_INTERVAL > 0 or metrics_server is not None:
+                core.add_task("stats", functools.partial(self._tables_stats_task, core, detector, receivers, hubs, table_metrics),
+                              background=True, subscribe=False)
+            print("Serving tables: " + ", ".join(str(table[0]) for table in TABLES))
+            asyncio.run(core.run())
+        except KeyboardInterrupt:
+            print('Exit due to keyboard interrupt')
+        except Exception as ex:
+            print('Python error with no Exception handler:')
+            print('Traceback error:', ex)
+            traceback.print_exc()
+        finally:
+            core.close()
+            if self.inference_pool is not None:
+                self.inference_pool.close()
+            if metrics_server is not None:
+                metrics_server.stop()
+            for receiver in receivers:
+                receiver.close()
+            for egress in hubs:
+                egress.stop()
+
+    # Detects cards with the shared detector and updates the engine of one table
+    async def _table_task(self, core, detector, engine, egress, decoder, metrics, preview, table_id, frames):
+        while True:
+            msg, frame, meta = await frames.get()
+            trace = self._create_trace(meta)
+            # the decoder keeps the coordinate scale of its last image, so decode and read it together
+            image, scale = await core.run_io(self._decode_with_scale, decoder, metrics, frame, trace)
+            image, detections = await self._timed_detect(core, detector, decoder, metrics, image, scale, trace, preview)
+            payload = await core.run_engine(self._update_engine, engine, metrics, detections, trace)
+            egress.publish(payload)
+            self._display(image, mode=table_id)
+
+    # Logs the stream, detector and egress stats of every table every STATS_LOG_INTERVAL seconds
+    async def _tables_stats_task(self, core, detector, receivers, hubs, table_metrics, frames):
+        while True:
+            await asyncio.sleep(STATS_LOG_INTERVAL if STATS_LOG_INTERVAL > 0 else 1)
+            for receiver, metrics in zip(receivers, table_metrics):
+                self._update_frame_counters(metrics, receiver)
+            if STATS_LOG_INTERVAL <= 0:
+                continue
+            for table, receiver, egress, metrics in zip(TABLES, receivers, hubs, table_metrics):
+                print(str(table[0]) + " stream:", receiver.get_stats())
+                print(str(table[0]) + " " + str(egress))
+                print(metrics)
+            print(core)
+            print(detector)
+
+    # Decode, inference, engine and egress each run in their own worker linked by bounded queues,
+    # so the frame rate is set by the slowest stage alone and stale frames are dropped before it.
+    # metrics_server is the endpoint started by start(), or None, and is stopped there.
+    def _run_pipeline(self, receiver, engine, metrics_server=None):
+        # the stages pass the frame's FrameTrace (or None) along with the frame
+        def decode_stage(received):
+            frame, trace = received
+            start = time.perf_counter()
+            image = self.decoder.decode(frame)
+            self.metrics.record_since("decode", start)
+            if trace is not None:
+                trace.mark("decode")
+            # the decoder may decode the next frame before this one reaches inference, so pass its scale along
+            return image, self.decoder.get_coord_scale(), trace
+
+        def inference_stage(decoded):
+            image, scale, trace = decoded
+            start = time.perf_counter()
+            try:
+                annotated_image, detections = self._detect(image, scale, trace)
+            finally:
+                self.decoder.release(image)
+            self.metrics.record_since("inference", start)
+            return annotated_image, detections, trace
+
+        # decoded frames dropped in front of the inference stage give their buffer back to the decoder's pool
+        def release_decoded(decoded):
+            self.decoder.release(decoded[0])
+
+        def engine_stage(detection):
+            image, detections, trace = detection
+            return image, self._update_engine(engine, self.metrics, detections, trace)
+
+        def egress_stage(update):
+            image, payload = update
+            self._send_payload(payload)
+            return image
+
+        pipeline = BlackJAIPipeline([("decode", decode_stage), ("inference", inference_stage, release_decoded),
+                                     ("engine", engine_stage), ("egress", egress_stage)],
+                                    queue_size=PIPELINE_QUEUE_SIZE, policy=PIPELINE_OVERFLOW_POLICY)
+        pipeline.start()
+        last_log = time.monotonic()
+        try:
+            while True:
+                # Receive image from publisher and hand it to the decode stage
+                start = time.perf_counter()
+                msg, frame, meta = receiver.receive(timeout=4)
+                self.metrics.record_since("receive", start)
+                pipeline.put((frame, self._create_trace(meta)))
+
+                # Display the newest annotated image, if any
+                image = pipeline.get_output()
+                if image is not None:
+                    self._display(image)
+
+                if STATS_LOG_INTERVAL > 0 and (time.monotonic() - last_log) >= STATS_LOG_INTERVAL:
+                    self._update_frame_counters(self.metrics, receiver)
+                    print("Stream:", receiver.get_stats())
+                    print(pipeline)
+                    print(self.egress)
+                    print(self.metrics)
+                    last_log = time.monotonic()
+                elif metrics_server is not None:
+                    self._update_frame_counters(self.metrics, receiver)
+        finally:
+            pipeline.stop()
+
+    # Decodes the frame at full resolution
+    def _decode_full(self, frame):
+        return cv.imdecode(np.frombuffer(frame, dtype='uint8'), -1)
+
+    # Returns a FrameTrace for the frame if TRACE_FRAMES is set, None otherwise
+    def _create_trace(self, meta):
+        return FrameTrace(meta.seq, meta.recv_time) if TRACE_FRAMES else None
+
+    # Decodes the frame with the decoder and returns it with its coordinate scale
+    def _decode_with_scale(self, decoder, metrics, frame, trace=None):
+        start = time.perf_counter()
+        image = decoder.decode(frame)
+        metrics.record_since("decode", start)
+        if trace is not None:
+            trace.mark("decode")
+        return image, decoder.get_coord_scale()
+
+    # Decodes the frame for the detector and detects cards, run on the inference executor
+    def _decode_and_detect(self, frame, trace=None):
+        start = time.perf_counter()
+        image = self.decoder.decode(frame)
+        start = self.metrics.record_since("decode", start)
+        if trace is not None:
+            trace.mark("decode")
+        try:
+            detection = self._detect(image, self.decoder.get_coord_scale(), trace)
+        finally:
+            self.decoder.release(image)
+        self.metrics.record_since("inference", start)
+        return detection
+
+    # Detects cards with a shared detector (DetectionBatcher or InferencePool), recording the time until the
+    # detections are back as the inference stage. The frame is counted for the preview sink (self.preview by default)
+    # and written to it, on the io executor, if it is due. The image is given back to the decoder that decoded it
+    # once the detector is done with it.
+    async def _timed_detect(self, core, detector, decoder, metrics, image, scale, trace=None, preview=None):
+        preview = preview if preview is not None else self.preview
+        previewed, annotate = self._start_preview(preview)
+        start = time.perf_counter()
+        try:
+            annotated_image, detections = await detector.detect(image, scale, trace, annotate=annotate)
+        finally:
+            decoder.release(image)
+        metrics.record_since("inference", start)
+        if previewed:
+            await core.run_io(preview.write, annotated_image)
+        return annotated_image, detections
+
+    # Updates the engine, recording its latency, the processed frames and the phase transitions
+    def _update_engine(self, engine, metrics, detections, trace=None):
+        phase = engine.state.get_phase()
+        start = time.perf_counter()
+        payload = engine.update(detections, trace)
+        metrics.record_since("engine", start)
+        metrics.increment("frames_processed")
+        if engine.state.get_phase() != phase:
+            metrics.increment("phase_" + engine.state.get_phase())
+        return payload
+
+    # Copies the receiver's frame totals into the metrics counters
+    def _update_frame_counters(self, metrics, receiver):
+        metrics.set_counter("frames_received", receiver.num_received)
+        metrics.set_counter("frames_dropped", receiver.num_dropped)
+
+    # Starts the metrics endpoint on METRICS_PORT, if enabled
+    def _start_metrics_server(self, metrics: list[Metrics]):
+        if METRICS_PORT <= 0:
+            return None
+        metrics_server = MetricsServer(metrics, METRICS_PORT)
+        metrics_server.start()
+        return metrics_server
+
+    # Detect cards using YOLO. scale maps the image coordinates to the full resolution frame (see FrameDecoder).
+    # The annotated image is only rendered when it will be displayed or previewed.
+    def _detect(self, image, scale, trace=None):
+        if self.yolo_model is None:
+            self.yolo_model = create_detector_backend(DETECTOR_BACKEND, DETECTOR_MODEL_PATH, conf=DETECTOR_CONFIDENCE)
+        previewed, annotate = self._start_preview(self.preview)
+        image, detections = detect_card_type_yolo(image, self.yolo_model, scale, annotate=annotate, trace=trace)
+        if previewed:
+            self.preview.write(image)
+        return image, detections
+
+    # Counts a frame for the preview sink. Returns (previewed, annotate): whether the frame's annotated image goes to
+    # the preview, and whether the detector has to annotate it (the frame is displayed or previewed).
+    def _start_preview(self, preview):
+        previewed = preview.tick()
+        return previewed, (not self.headless) or previewed
+
+    # Display the image in a window of the mode unless running headless. Only hands the image to the display thread.
+    def _display(self, image, delay=1, mode=None):
+        if self.display is None or image is None:
+            return
+        self.display.show(f"BlackJAI Server Feed - Mode: {mode if mode is not None else self.view_mode}", image, delay)
+
+    # Hand the engine payload to the egress thread, which encodes and sends it to the BlackJAI Connect phone and other targets
+    def _send_payload(self, payload):
+        self.egress.publish(payload)
 
 
 """
@@ -145,29 +533,90 @@ class VideoStreamSubscriber:
         self.hostname = hostname
         self.port = port
         self._stop = False
+        self._lock = threading.Lock()
+        self._data = None
         self._data_ready = threading.Event()
+        # sequence number of the newest frame received and of the last frame handed out by receive()
+        self._seq = 0
+        self._last_read_seq = 0
+        # running totals of frames received from the publisher, handed out, and replaced before being read
+        self.num_received = 0
+        self.num_read = 0
+        self.num_dropped = 0
+        self._stats_time = time.monotonic()
+        self._stats_received = 0
+        self._stats_read = 0
         self._thread = threading.Thread(target=self._run, args=())
         self._thread.daemon = True
         self._thread.start()
 
+    # Returns the newest frame as (msg, jpg_buffer, FrameMeta). Frames that arrived since the
+    # previous call and were replaced before being read are counted as dropped.
     def receive(self, timeout=15.0):
         flag = self._data_ready.wait(timeout=timeout)
         if not flag:
             raise TimeoutError("Error: Timeout while reading from subscriber tcp://{}:{}".format(self.hostname, self.port))
-        self._data_ready.clear()
-        return self._data
+        with self._lock:
+            self._data_ready.clear()
+            msg, frame, seq, recv_time = self._data
+            num_dropped = seq - self._last_read_seq - 1
+            self._last_read_seq = seq
+            self.num_read += 1
+            self.num_dropped += num_dropped
+        return msg, frame, FrameMeta(seq, recv_time, num_dropped)
+
+    # Returns frame totals along with the offered (received) and effective (read) frame rates
+    # measured since the previous call
+    def get_stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._stats_time, 1e-9)
+            stats = {
+                "received": self.num_received,
+                "read": self.num_read,
+                "dropped": self.num_dropped,
+                "offered_fps": round((self.num_received - self._stats_received) / elapsed, 2),
+                "effective_fps": round((self.num_read - self._stats_read) / elapsed, 2),
+            }
+            self._stats_time = now
+            self._stats_received = self.num_received
+            self._stats_read = self.num_read
+        return stats
 
     def _run(self):
         receiver = imagezmq.ImageHub("tcp://{}:{}".format(self.hostname, self.port), REQ_REP=False)
         while not self._stop:
-            self._data = receiver.recv_jpg()
-            self._data_ready.set()
+            msg, frame = receiver.recv_jpg()
+            recv_time = time.time()
+            with self._lock:
+                self._seq += 1
+                self.num_received += 1
+                self._data = (msg, frame, self._seq, recv_time)
+                self._data_ready.set()
         receiver.close()
 
     def close(self):
         self._stop = True
 
 
-# Simulating heavy processing load
-def limit_to_2_fps():
-    sleep(0.5)
+"""
+FrameMeta:
+Metadata attached to each frame by the VideoStreamSubscriber.
+seq is a monotonically increasing frame number, recv_time the wall clock arrival time in seconds,
+and num_dropped the number of frames replaced since the previous frame was read.
+"""
+class FrameMeta:
+    def __init__(self, seq: int, recv_time: float, num_dropped: int):
+        self.seq = seq
+        self.recv_time = recv_time
+        self.num_dropped = num_dropped
+
+    # Returns the number of seconds since the frame arrived
+    def get_age(self) -> float:
+        return time.time() - self.recv_time
+
+    def __str__(self):
+        return "(seq " + str(self.seq) + " recv_time " + str(self.recv_time) + " dropped " + str(self.num_dropped) + ")"
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+
+from blackjai_server.engine.strategy import RuleSet, STRATEGY_VERSION, TC_MIN, TC_MAX, NUM_TC_BUCKETS
+from blackjai_server.simulation.simulator import Simulator, simulate
+
+"""
+Bankroll management: Kelly bets per true count, expected hourly win and risk of ruin for a bet ramp.
+The expensive part, the EV and variance of a round per true count bucket, comes from a flat bet simulation
+and is cached on disk keyed by the configuration. The bets are compiled into a table indexed by the true count bucket.
+"""
+
+# Bump when the simulation or the cached statistics change to invalidate cached results
+BANKROLL_VERSION = 1
+# Penetration simulated for a table dealt to the end of the shoe
+MAX_SIMULATION_PENETRATION = 0.75
+
+
+# Returns the penetration to simulate for the table's penetration. A table dealing until the shoe runs out (1.0)
+# is simulated at MAX_SIMULATION_PENETRATION, as the simulator needs room for a round after the cut card.
+def simulation_penetration(penetration: float) -> float:
+    return min(penetration, MAX_SIMULATION_PENETRATION) if (penetration >= 1.0) else penetration
+
+
+# Returns (frequency, ev, second moment) of a round per true count bucket (TC_MIN to TC_MAX) for a flat bet of one unit.
+# Loads them from cache_dir if they were simulated for the same configuration before.
+def count_bucket_stats(rules: RuleSet, penetration=0.75, count_system="hi_lo", deviations=True, num_shoes=20000, seed=0,
+                       num_workers: int = None, cache_dir: str = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    path = None
+    if (cache_dir is not None):
+        key = (f"bankroll_v{BANKROLL_VERSION}_s{STRATEGY_VERSION}_{rules.get_key()}_{count_system}_p{penetration}_"
+               f"{'dev' if deviations else 'basic'}_{num_shoes}_{seed}")
+        path = os.path.join(cache_dir, key + ".npz")
+        if (os.path.exists(path)):
+            stats = np.load(path)
+            return stats["frequency"], stats["ev"], stats["second_moment"]
+    simulator = Simulator(rules, deviations=deviations, penetration=penetration, count_system=count_system)
+    result = simulate(simulator, num_shoes, num_workers, seed)
+    rounds = np.maximum(result.bucket_rounds, 1)
+    frequency = result.bucket_rounds / max(result.num_rounds, 1)
+    ev = result.bucket_win / rounds
+    second_moment = result.bucket_sq_win / rounds
+    if (path is not None):
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path, frequency=frequency, ev=ev, second_moment=second_moment)
+    return frequency, ev, second_moment
+
+
+"""
+BankrollPlan:
+The bets and their outcome for a bankroll, given the per true count bucket statistics from count_bucket_stats().
+The Kelly bet of a bucket is kelly_fraction * bankroll * ev / variance, rounded down to bet_unit and kept between
+min_bet and max_bet (min_bet where the EV is negative), and never lower than the bet of a lower true count.
+If bet_ramp (units of min_bet per bucket) is given it is played instead of the Kelly bets.
+Risk of ruin is the probability of losing the bankroll playing forever, exp(-2 * ev * bankroll / variance).
+"""
+class BankrollPlan:
+    def __init__(self, stats: tuple[np.ndarray, np.ndarray, np.ndarray], bankroll: float, min_bet=5, max_bet: float = None,
+                 kelly_fraction=0.5, bet_ramp=None, bet_unit: float = None, rounds_per_hour=100, count_system="hi_lo"):
+        self.frequency, self.ev, self.second_moment = stats
+        self.bankroll = bankroll
+        self.min_bet = min_bet
+        self.max_bet = max_bet if (max_bet is not None) else bankroll
+        self.kelly_fraction = kelly_fraction
+        self.bet_unit = bet_unit if (bet_unit is not None) else min_bet
+        self.rounds_per_hour = rounds_per_hour
+        # the counting system whose true count selects the bet
+        self.count_system = count_system
+
+        variance = np.maximum(self.second_moment - self.ev**2, 1e-12)
+        kelly = kelly_fraction * bankroll * np.maximum(self.ev, 0) / variance
+        kelly = np.floor(kelly / self.bet_unit) * self.bet_unit
+        self.kelly_bets = np.maximum.accumulate(np.clip(kelly, min_bet, self.max_bet))
+        if (bet_ramp is not None and len(bet_ramp) != NUM_TC_BUCKETS):
+            raise ValueError(f"BankrollPlan bet_ramp needs one bet per true count from {TC_MIN} to {TC_MAX} "
+                             f"({NUM_TC_BUCKETS} bets), got {len(bet_ramp)}")
+        self.bets = self.kelly_bets if (bet_ramp is None) else np.asarray(bet_ramp, dtype=np.float64) * min_bet
+
+        # per round outcome of the bets, mixing the buckets by how often they occur
+        self.ev_per_round = float((self.frequency * self.bets * self.ev).sum())
+        self.variance_per_round = float((self.frequency * self.bets**2 * self.second_moment).sum()) - self.ev_per_round**2
+        self.hourly_win = self.ev_per_round * rounds_per_hour
+        self.hourly_std = float(np.sqrt(max(self.variance_per_round, 0) * rounds_per_hour))
+        if (self.ev_per_round <= 0):
+            self.risk_of_ruin = 1.0
+        else:
+            self.risk_of_ruin = float(np.exp(-2 * self.ev_per_round * bankroll / self.variance_per_round))
+
+    # Simulates (or loads from cache_dir) the bucket statistics for the configuration and returns the plan
+    @classmethod
+    def build(cls, rules: RuleSet, bankroll: float, min_bet=5, max_bet: float = None, kelly_fraction=0.5, bet_ramp=None,
+              bet_unit: float = None, rounds_per_hour=100, penetration=0.75, count_system="hi_lo", deviations=True,
+              num_shoes=20000, seed=0, num_workers: int = None, cache_dir: str = None):
+        stats = count_bucket_stats(rules, penetration, count_system, deviations, num_shoes, seed, num_workers, cache_dir)
+        return cls(stats, bankroll, min_bet, max_bet, kelly_fraction, bet_ramp, bet_unit, rounds_per_hour, count_system)
+
+    # Returns the bet for the true count
+    def get_bet(self, true_count: float) -> float:
+        bucket = min(max(int(np.floor(true_count)), TC_MIN), TC_MAX) - TC_MIN
+        return float(self.bets[bucket])
+
+    def serialize(self) -> dict:
+        return {
+            "bets": {str(true_count): float(bet) for true_count, bet in zip(range(TC_MIN, TC_MAX + 1), self.bets)},
+            "hourly_win": round(self.hourly_win, 2),
+            "hourly_std": round(self.hourly_std, 2),
+            "risk_of_ruin": round(self.risk_of_ruin, 4),
+        }
+
+    def __str__(self):
+        lines = [f"Bankroll {self.bankroll}, bets {self.min_bet}-{self.max_bet}: hourly win {self.hourly_win:+.2f} "
+                 f"(std {self.hourly_std:.2f}), risk of ruin {100 * self.risk_of_ruin:.2f}%",
+                 "TC    freq      EV     bet"]
+        for bucket in np.flatnonzero(self.frequency):
+            lines.append(f"{bucket + TC_MIN:+3d} {100 * self.frequency[bucket]:6.2f}% {100 * self.ev[bucket]:+6.2f}% {self.bets[bucket]:7.0f}")
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,345 @@
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from blackjai_server.engine.models import CARD_TYPES, CARD_BLACKJACK_VALUES, COUNT_SYSTEM_INITIAL_COUNTS, build_count_weights
+from blackjai_server.engine.models import BasicStrategy
+from blackjai_server.engine.strategy import RuleSet, compile_strategy, ACTION_INDEX, HARD, SOFT, PAIR, TC_MIN, TC_MAX, NUM_TC_BUCKETS
+
+"""
+Offline Monte Carlo blackjack simulator.
+A batch of shoes is shuffled as one (num_shoes, num_cards) array of card IDs and all shoes are dealt in lockstep,
+one round at a time, with every step of a round (drawing, strategy lookup, dealer play, settling) vectorized across
+the shoes. One player plays against the dealer with the compiled strategy table (including count deviations) and
+the true count of a counting system, betting bet_ramp[true count bucket] units. Split hands are not resplit.
+Batches are sharded across a process pool, each shard with its own deterministic seed.
+"""
+
+NUM_CARDS_PER_DECK = len(CARD_TYPES)
+# Most cards one round can use. A hand still drawing is soft 18 or less (at most 8 aces) or hard 16 or less, so it
+# holds at most 8 small cards, one card to a hard 12 or more, 4 aces and its last card: 14 cards, 28 for a split.
+# The dealer draws while soft 17 or less: 7 + 1 + 4 + 1 = 13 cards.
+MAX_ROUND_CARDS = 2 * 14 + 13
+# cards from a fresh deck appended to every shoe, so a round started before the cut card cannot run out of cards
+RESERVE_CARDS = MAX_ROUND_CARDS
+# hands at the table (player and dealer), used for the shuffle point like CountingSystems.is_shuffle_due()
+NUM_HANDS = 2
+
+CARD_VALUES = np.array(CARD_BLACKJACK_VALUES, dtype=np.int64)
+
+
+# Returns a boolean array over the strategy action indices that is true for the given actions
+def _action_mask(*actions) -> np.ndarray:
+    mask = np.zeros(len(ACTION_INDEX), dtype=bool)
+    for action in actions:
+        mask[ACTION_INDEX[action]] = True
+    return mask
+
+
+IS_SPLIT = _action_mask(BasicStrategy.P_, BasicStrategy.PH, BasicStrategy.PD)
+IS_SURRENDER = _action_mask(BasicStrategy.RH, BasicStrategy.RS)
+IS_DOUBLE = _action_mask(BasicStrategy.DH, BasicStrategy.DS)
+# hit, once doubling or surrendering is no longer allowed
+IS_HIT = _action_mask(BasicStrategy.H_, BasicStrategy.DH, BasicStrategy.RH, BasicStrategy.PH)
+
+
+# Adds the card values to the hands, counting aces as 1 where 11 would bust
+def _add_cards(total: np.ndarray, aces: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    total = total + values
+    aces = aces + (values == 11)
+    for i in range(2):
+        soft_bust = (total > 21) & (aces > 0)
+        total = np.where(soft_bust, total - 10, total)
+        aces = np.where(soft_bust, aces - 1, aces)
+    return total, aces
+
+
+"""
+SimulationResult:
+Totals of a simulation that can be merged across batches and workers. Wins are in units of the base bet.
+"""
+class SimulationResult:
+    def __init__(self):
+        self.num_rounds = 0
+        self.sum_win = 0.0
+        self.sum_sq_win = 0.0
+        self.sum_bet = 0.0
+        self.elapsed = 0.0
+        # per true count bucket (TC_MIN to TC_MAX)
+        self.bucket_rounds = np.zeros(NUM_TC_BUCKETS, dtype=np.int64)
+        self.bucket_win = np.zeros(NUM_TC_BUCKETS)
+        self.bucket_sq_win = np.zeros(NUM_TC_BUCKETS)
+        self.bucket_bet = np.zeros(NUM_TC_BUCKETS)
+        self.bucket_wins = np.zeros(NUM_TC_BUCKETS, dtype=np.int64)
+        self.bucket_losses = np.zeros(NUM_TC_BUCKETS, dtype=np.int64)
+
+    def add_rounds(self, bucket: np.ndarray, win: np.ndarray, bet: np.ndarray):
+        self.num_rounds += len(win)
+        self.sum_win += float(win.sum())
+        self.sum_sq_win += float((win * win).sum())
+        self.sum_bet += float(bet.sum())
+        self.bucket_rounds += np.bincount(bucket, minlength=NUM_TC_BUCKETS)
+        self.bucket_win += np.bincount(bucket, weights=win, minlength=NUM_TC_BUCKETS)
+        self.bucket_sq_win += np.bincount(bucket, weights=win * win, minlength=NUM_TC_BUCKETS)
+        self.bucket_bet += np.bincount(bucket, weights=bet, minlength=NUM_TC_BUCKETS)
+        self.bucket_wins += np.bincount(bucket[win > 0], minlength=NUM_TC_BUCKETS)
+        self.bucket_losses += np.bincount(bucket[win < 0], minlength=NUM_TC_BUCKETS)
+
+    def merge(self, other):
+        self.num_rounds += other.num_rounds
+        self.sum_win += other.sum_win
+        self.sum_sq_win += other.sum_sq_win
+        self.sum_bet += other.sum_bet
+        self.elapsed = max(self.elapsed, other.elapsed)
+        self.bucket_rounds += other.bucket_rounds
+        self.bucket_win += other.bucket_win
+        self.bucket_sq_win += other.bucket_sq_win
+        self.bucket_bet += other.bucket_bet
+        self.bucket_wins += other.bucket_wins
+        self.bucket_losses += other.bucket_losses
+        return self
+
+    # average win per round
+    def get_ev(self) -> float:
+        return self.sum_win / max(self.num_rounds, 1)
+
+    # average win per unit bet
+    def get_ev_per_bet(self) -> float:
+        return self.sum_win / max(self.sum_bet, 1e-12)
+
+    # variance of the win per round
+    def get_variance(self) -> float:
+        ev = self.get_ev()
+        return self.sum_sq_win / max(self.num_rounds, 1) - ev * ev
+
+    # standard error of the average win per round
+    def get_std_error(self) -> float:
+        return float(np.sqrt(self.get_variance() / max(self.num_rounds, 1)))
+
+    def get_hands_per_sec(self) -> float:
+        return self.num_rounds / self.elapsed if self.elapsed > 0 else 0.0
+
+    # returns a list of (true count, rounds, ev per unit bet, win rate, loss rate) for the buckets that were played
+    def get_bucket_stats(self) -> list[tuple[int, int, float, float, float]]:
+        stats = []
+        for bucket in np.flatnonzero(self.bucket_rounds):
+            rounds = int(self.bucket_rounds[bucket])
+            stats.append((int(bucket) + TC_MIN, rounds, float(self.bucket_win[bucket] / self.bucket_bet[bucket]),
+                          float(self.bucket_wins[bucket] / rounds), float(self.bucket_losses[bucket] / rounds)))
+        return stats
+
+    def __str__(self):
+        lines = [f"{self.num_rounds} rounds in {self.elapsed:.1f}s ({self.get_hands_per_sec():.0f} hands/sec)",
+                 f"EV {100 * self.get_ev_per_bet():+.3f}% per unit bet, {self.get_ev():+.4f} +- {self.get_std_error():.4f} per round, "
+                 f"variance {self.get_variance():.3f}",
+                 "TC      rounds      EV     win    loss"]
+        for true_count, rounds, ev, win_rate, loss_rate in self.get_bucket_stats():
+            lines.append(f"{true_count:+3d} {rounds:10d} {100 * ev:+6.2f}% {100 * win_rate:5.1f}% {100 * loss_rate:5.1f}%")
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+"""
+Simulator:
+Plays batches of shoes for a rule set. bet_ramp is the bet in units per true count bucket (TC_MIN to TC_MAX),
+flat betting if None. The shoe is shuffled once the cut card (penetration) is reached.
+"""
+class Simulator:
+    def __init__(self, rules: RuleSet = None, deviations=True, penetration=0.75, count_system="hi_lo", bet_ramp=None):
+        self.rules = rules if (rules is not None) else RuleSet()
+        self.deviations = deviations
+        self.penetration = penetration
+        self.count_system = count_system
+        self.table = compile_strategy(self.rules, deviations)
+        self.weights = build_count_weights([count_system])[0]
+        initial_count = COUNT_SYSTEM_INITIAL_COUNTS.get(count_system)
+        self.initial_count = initial_count(self.rules.num_decks) if (initial_count is not None) else 0
+        self.bet_ramp = np.ones(NUM_TC_BUCKETS) if (bet_ramp is None) else np.asarray(bet_ramp, dtype=np.float64)
+        self.num_cards = NUM_CARDS_PER_DECK * self.rules.num_decks
+        self.cut_card = min(self.penetration * self.num_cards, self.num_cards - 4 * NUM_HANDS)
+
+    # Returns (num_shoes, num_cards + RESERVE_CARDS) shuffled card IDs
+    def shuffle_shoes(self, rng: np.random.Generator, num_shoes: int) -> np.ndarray:
+        cards = np.tile(np.arange(NUM_CARDS_PER_DECK, dtype=np.int64), (num_shoes, self.rules.num_decks))
+        reserve = np.tile(np.arange(NUM_CARDS_PER_DECK, dtype=np.int64), (num_shoes, 1))
+        return np.concatenate([rng.permuted(cards, axis=1), rng.permuted(reserve, axis=1)[:, :RESERVE_CARDS]], axis=1)
+
+    # Plays every shoe of the batch to the cut card and adds the rounds to result
+    def run_batch(self, rng: np.random.Generator, num_shoes: int, result: SimulationResult = None) -> SimulationResult:
+        result = result if (result is not None) else SimulationResult()
+        start = time.perf_counter()
+        shoes = self.shuffle_shoes(rng, num_shoes)
+        pos = np.zeros(num_shoes, dtype=np.int64)
+        running_count = np.full(num_shoes, float(self.initial_count))
+        rows = np.arange(num_shoes)
+        while (len(rows) > 0):
+            self._play_round(shoes, pos, running_count, rows, result)
+            rows = rows[pos[rows] < self.cut_card]
+        result.elapsed += time.perf_counter() - start
+        return result
+
+    # Draws the next card of the shoes in rows, counting it unless count is False. Returns the card values.
+    def _draw(self, shoes, pos, running_count, rows, count=True) -> np.ndarray:
+        cards = shoes[rows, pos[rows]]
+        pos[rows] += 1
+        if (count):
+            running_count[rows] += self.weights[cards]
+        return CARD_VALUES[cards]
+
+    # Returns the strategy action indices for the hands
+    def _lookup(self, hand_class, total, upcard, bucket) -> np.ndarray:
+        return self.table[hand_class, np.minimum(total, 21), upcard - 2, bucket]
+
+    def _play_round(self, shoes, pos, running_count, rows, result: SimulationResult):
+        n = len(rows)
+        decks_remaining = np.maximum(self.num_cards - pos[rows], 1) / NUM_CARDS_PER_DECK
+        true_count = running_count[rows] / decks_remaining
+        bucket = np.clip(np.floor(true_count).astype(np.int64), TC_MIN, TC_MAX) - TC_MIN
+        bet = self.bet_ramp[bucket]
+
+        first = self._draw(shoes, pos, running_count, rows)
+        upcard = self._draw(shoes, pos, running_count, rows)
+        second = self._draw(shoes, pos, running_count, rows)
+        # the hole card is counted once the dealer turns it over
+        hole_cards = shoes[rows, pos[rows]]
+        hole = self._draw(shoes, pos, running_count, rows, count=False)
+        zeros = np.zeros(n, dtype=np.int64)
+        dealer_total, dealer_aces = _add_cards(*_add_cards(zeros, zeros, upcard), hole)
+        player_total, player_aces = _add_cards(*_add_cards(zeros, zeros, first), second)
+
+        # hands (n, 2): slot 1 is only used by split hands
+        total = np.stack([player_total, zeros], axis=1)
+        aces = np.stack([player_aces, zeros], axis=1)
+        mult = np.ones((n, 2))
+        num_cards = np.full((n, 2), 2)
+        exists = np.zeros((n, 2), dtype=bool)
+        exists[:, 0] = True
+        playing = np.zeros((n, 2), dtype=bool)
+        surrendered = np.zeros(n, dtype=bool)
+        split = np.zeros(n, dtype=bool)
+
+        # naturals, the dealer peeks for blackjack
+        dealer_bj = dealer_total == 21
+        player_bj = player_total == 21
+        settled = dealer_bj | player_bj
+        win = np.where(player_bj & ~dealer_bj, 1.5, np.where(dealer_bj & ~player_bj, -1.0, 0.0))
+
+        # first decision, on the two dealt cards
+        live = np.flatnonzero(~settled)
+        pair = first[live] == second[live]
+        hand_class = np.where(pair, PAIR, np.where(player_aces[live] > 0, SOFT, HARD))
+        hand_index = np.where(pair, first[live], player_total[live])
+        action = self.table[hand_class, hand_index, upcard[live] - 2, bucket[live]]
+
+        surrender_rows = live[IS_SURRENDER[action]]
+        surrendered[surrender_rows] = True
+        double_rows = live[IS_DOUBLE[action]]
+        mult[double_rows, 0] = 2
+        num_cards[double_rows, 0] += 1
+        value = self._draw(shoes, pos, running_count, rows[double_rows])
+        total[double_rows, 0], aces[double_rows, 0] = _add_cards(total[double_rows, 0], aces[double_rows, 0], value)
+        hit_rows = live[action == ACTION_INDEX[BasicStrategy.H_]]
+        value = self._draw(shoes, pos, running_count, rows[hit_rows])
+        total[hit_rows, 0], aces[hit_rows, 0] = _add_cards(total[hit_rows, 0], aces[hit_rows, 0], value)
+        num_cards[hit_rows, 0] += 1
+        playing[hit_rows, 0] = total[hit_rows, 0] < 21
+
+        split_rows = live[IS_SPLIT[action]]
+        if (len(split_rows) > 0):
+            split[split_rows] = True
+            exists[split_rows, 1] = True
+            split_aces = first[split_rows] == 11
+            for slot, card in ((0, first), (1, second)):
+                total[split_rows, slot], aces[split_rows, slot] = _add_cards(zeros[split_rows], zeros[split_rows], card[split_rows])
+                value = self._draw(shoes, pos, running_count, rows[split_rows])
+                total[split_rows, slot], aces[split_rows, slot] = _add_cards(total[split_rows, slot], aces[split_rows, slot], value)
+                # split aces get one card each
+                playing[split_rows, slot] = ~split_aces & (total[split_rows, slot] < 21)
+
+        # hit until the strategy stands, busted or 21. Split hands may double on their first two cards if the rules allow it.
+        for slot in range(2):
+            active = np.flatnonzero(playing[:, slot])
+            while (len(active) > 0):
+                hand_class = np.where(aces[active, slot] > 0, SOFT, HARD)
+                action = self._lookup(hand_class, total[active, slot], upcard[active], bucket[active])
+                can_double = split[active] & (num_cards[active, slot] == 2) & self.rules.double_after_split
+                double = IS_DOUBLE[action] & can_double
+                mult[active[double], slot] = 2
+                hit_rows = active[IS_HIT[action] | double]
+                value = self._draw(shoes, pos, running_count, rows[hit_rows])
+                total[hit_rows, slot], aces[hit_rows, slot] = _add_cards(total[hit_rows, slot], aces[hit_rows, slot], value)
+                num_cards[hit_rows, slot] += 1
+                playing[active, slot] = False
+                playing[hit_rows, slot] = (total[hit_rows, slot] < 21) & (mult[hit_rows, slot] == 1)
+                active = np.flatnonzero(playing[:, slot])
+
+        # the dealer plays if any hand is still standing
+        standing = (exists & (total <= 21)).any(axis=1) & ~settled & ~surrendered
+        running_count[rows] += self.weights[hole_cards]
+        active = np.flatnonzero(standing)
+        while (len(active) > 0):
+            soft_17 = (dealer_total[active] == 17) & (dealer_aces[active] > 0) & self.rules.dealer_hits_soft_17
+            hit_rows = active[(dealer_total[active] < 17) | soft_17]
+            value = self._draw(shoes, pos, running_count, rows[hit_rows])
+            dealer_total[hit_rows], dealer_aces[hit_rows] = _add_cards(dealer_total[hit_rows], dealer_aces[hit_rows], value)
+            active = hit_rows
+
+        # settle
+        dealer_bust = dealer_total > 21
+        hand_win = np.where(total > 21, -1.0, np.where(dealer_bust[:, None] | (total > dealer_total[:, None]), 1.0,
+                                                       np.where(total < dealer_total[:, None], -1.0, 0.0)))
+        hand_win = (hand_win * mult * exists).sum(axis=1)
+        win = np.where(settled, win, np.where(surrendered, -0.5, hand_win))
+        result.add_rounds(bucket, win * bet, bet)
+
+
+# Plays num_shoes shoes in batches of batch_size with the generator seeded by seed (a SeedSequence)
+def _run_shard(simulator: Simulator, seed: np.random.SeedSequence, num_shoes: int, batch_size: int) -> SimulationResult:
+    rng = np.random.default_rng(seed)
+    result = SimulationResult()
+    for start in range(0, num_shoes, batch_size):
+        simulator.run_batch(rng, min(batch_size, num_shoes - start), result)
+    return result
+
+
+# Plays num_shoes shoes split into num_workers shards, each run in its own process with a seed spawned from seed,
+# so a simulation is reproducible for the same seed and number of workers. Returns the merged SimulationResult.
+def simulate(simulator: Simulator, num_shoes: int, num_workers: int = None, seed=0, batch_size=2048) -> SimulationResult:
+    num_workers = num_workers if (num_workers is not None) else (os.cpu_count() or 1)
+    num_workers = max(min(num_workers, num_shoes), 1)
+    seeds = np.random.SeedSequence(seed).spawn(num_workers)
+    shard_sizes = [num_shoes // num_workers + (i < num_shoes % num_workers) for i in range(num_workers)]
+    start = time.perf_counter()
+    if (num_workers == 1):
+        results = [_run_shard(simulator, seeds[0], shard_sizes[0], batch_size)]
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            results = list(executor.map(_run_shard, [simulator] * num_workers, seeds, shard_sizes, [batch_size] * num_workers))
+    result = SimulationResult()
+    for shard_result in results:
+        result.merge(shard_result)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+# Simulates the same shuffles (same seed) under two rule sets. Returns (result_a, result_b).
+def compare_rules(rules_a: RuleSet, rules_b: RuleSet, num_shoes: int, num_workers: int = None, seed=0, **kwargs) -> tuple[SimulationResult, SimulationResult]:
+    result_a = simulate(Simulator(rules_a, **kwargs), num_shoes, num_workers, seed)
+    result_b = simulate(Simulator(rules_b, **kwargs), num_shoes, num_workers, seed)
+    return result_a, result_b
+
+
+if __name__ == "__main__":
+    # simulate the table rules in conf.py: python -m blackjai_server.simulation.simulator [num_shoes] [num_workers]
+    from conf import NUM_DECKS, PENETRATION, DEALER_HITS_SOFT_17, DOUBLE_AFTER_SPLIT, SURRENDER, STRATEGY_DEVIATIONS
+    from blackjai_server.simulation.bankroll import simulation_penetration
+    num_shoes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    rules = RuleSet(num_decks=NUM_DECKS, dealer_hits_soft_17=DEALER_HITS_SOFT_17, double_after_split=DOUBLE_AFTER_SPLIT, surrender=SURRENDER)
+    penetration = simulation_penetration(PENETRATION)
+    print(f"Simulating {num_shoes} shoes of {rules} at {100 * penetration:.0f}% penetration")
+    print(simulate(Simulator(rules, deviations=STRATEGY_DEVIATIONS, penetration=penetration), num_shoes, num_workers))
@@ -2,11 +2,118 @@
 
 # View Mode: view - Only Displays images received from publisher
 # View Mode: process - Processes images received from publisher
+# View Mode: pipeline - Processes images with decode, inference, engine and egress each in their own worker
+# View Mode: detect - Displays detections, preview - Writes raw frames to PREVIEW_DIR/latest_raw.jpg,
+#            picture - Saves one frame, record (or timed_video) - Records RECORD_SECONDS of video
+# View Mode: tables - Processes every table in TABLES in this process with one shared, batched detector
+# Modes other than pipeline and tables can be combined with commas to run on the same stream, e.g. "process,record,preview"
 VIEW_MODE = "process"
 
+# Headless: never render annotated images or open display windows (for servers without a display)
+HEADLESS = False
+# Write every Nth annotated frame to PREVIEW_DIR/latest.jpg as a low rate preview (0 disables)
+PREVIEW_EVERY_N = 0
+# Directory for preview images (None uses blackjai_server/data/previews)
+PREVIEW_DIR = None
+# Length and frame rate of videos recorded in record mode
+RECORD_SECONDS = 20
+RECORD_FPS = 10
+
 BLACKJAI_CAPTURE_IP = "192.168.50.100"
 BLACKJAI_CAPTURE_PORT = 5555
 
 # IP of the phone running the Blackjai Connect program
 BLACKJAI_CONNECT_IP = "192.168.50.9"
 BLACKJAI_CONNECT_PORT = 5001
+# Wire format of the payloads sent to Blackjai Connect: "json" or "binary" (compact keyframes and deltas)
+PAYLOAD_FORMAT = "json"
+# Binary format: send a full keyframe every N messages. A ZMQ subscriber that joins is sent a keyframe of the last
+# payload right away (with the next payload if PAYLOAD_KEYFRAME_PERIOD is 0). A UDP client that joins late only gets
+# one at the next interval, after PAYLOAD_KEYFRAME_PERIOD or when its target is reconnected.
+PAYLOAD_KEYFRAME_INTERVAL = 30
+# Seconds after which the last payload is sent again as a keyframe when no new state was sent (0 disables)
+PAYLOAD_KEYFRAME_PERIOD = 1.0
+# UDP payload destinations, the phone by default: (ip, port, format, max messages per second or 0 for no limit)
+EGRESS_UDP_TARGETS = [(BLACKJAI_CONNECT_IP, BLACKJAI_CONNECT_PORT, PAYLOAD_FORMAT, 0)]
+# Address to publish payloads on with a ZMQ PUB socket for any number of subscribers (e.g. "tcp://*:5600", None disables)
+EGRESS_ZMQ_ADDRESS = None
+EGRESS_ZMQ_FORMAT = "json"
+EGRESS_ZMQ_MAX_RATE = 0
+# Tables served in tables mode as (table id, capture ip, capture port, connect ip, connect port).
+# Each table has its own engine and sends its payloads in PAYLOAD_FORMAT to its own connect address.
+TABLES = [
+    ("table_1", BLACKJAI_CAPTURE_IP, BLACKJAI_CAPTURE_PORT, BLACKJAI_CONNECT_IP, BLACKJAI_CONNECT_PORT),
+]
+# Tables mode: seconds the detector waits for the other tables' frames before running a batch
+TABLE_BATCH_WAIT = 0.005
+
+# Pipeline mode: number of items each stage queue holds before the overflow policy applies
+PIPELINE_QUEUE_SIZE = 2
+# Pipeline mode overflow policy: drop_oldest, latest_wins or block
+PIPELINE_OVERFLOW_POLICY = "drop_oldest"
+# Seconds between stream frame rate / pipeline queue depth log lines (0 disables)
+STATS_LOG_INTERVAL = 5
+# Port of the local metrics endpoint serving per stage latency percentiles and frame counters as JSON
+# at http://127.0.0.1:<port>/metrics (0 disables)
+METRICS_PORT = 0
+# Add a "trace" to each payload with the frame's sequence number and the wall clock times it was received,
+# decoded, detected and processed by the engine, to measure latency per stage at the client
+TRACE_FRAMES = False
+
+# Decode frames for detection at 1/DECODE_SCALE resolution (1, 2, 4 or 8)
+DECODE_SCALE = 1
+# Resize decoded frames to this (width, height) before detection, e.g. the detector input size (None keeps decoded size)
+DECODE_TARGET_SIZE = None
+# Number of preallocated frame buffers used when resizing decoded frames. A buffer is reused once its frame has been
+# detected, and the pool grows (with a warning) if more frames are in flight, e.g. INFERENCE_WORKERS + 2
+DECODE_POOL_SIZE = 8
+
+# Card detector backend: ultralytics, onnx or onnx_int8 (onnx backends require onnxruntime)
+# The ultralytics backend also runs TorchScript (*.torchscript) and OpenVINO (*_openvino_model) exports
+DETECTOR_BACKEND = "ultralytics"
+# Model for the detector backend (None uses blackjai_server/ml_models/best_m_31eps_all.pt / .onnx / .int8.onnx)
+DETECTOR_MODEL_PATH = None
+# Minimum confidence for a detection
+DETECTOR_CONFIDENCE = 0.5
+# Number of inference worker processes for process and tables modes (0 detects in this process). Each worker loads
+# its own copy of the model and reads decoded frames from shared memory.
+INFERENCE_WORKERS = 0
+# Shared memory frame slots for the inference workers (0 uses two per worker)
+INFERENCE_SLOTS = 0
+
+# Number of players at the table when no table layout file is given
+NUM_PLAYERS = 2
+# JSON file with the seat zones of the table (see blackjai_server/engine/layout.py), None uses the default layout:
+# dealer on the top half of the frame, player seats splitting the bottom half with player 0 on the right
+TABLE_LAYOUT_PATH = None
+
+# Number of decks in the shoe
+NUM_DECKS = 1
+# Fraction of the shoe dealt before the cut card (1.0 deals until another round could run out of cards)
+PENETRATION = 1.0
+
+# Table rules the strategy is compiled for. Supported: 1 deck or 2+ deck charts (16 vs 9 surrender from 4 decks),
+# H17 or S17, DAS or no DAS, late surrender or none (run blackjai_server/engine/strategy.py to check the chart cells)
+DEALER_HITS_SOFT_17 = True
+DOUBLE_AFTER_SPLIT = True
+SURRENDER = True
+# Apply Hi-Lo index deviations (Illustrious 18 and Fab 4) to the strategy
+STRATEGY_DEVIATIONS = True
+# Directory to cache compiled strategy tables in (None compiles at every start)
+STRATEGY_CACHE_DIR = None
+# Add composition dependent expected values of each action to the payload (computed from the exact cards left in the shoe)
+COMPOSITION_EV = False
+# Maximum number of memoized dealer distributions and hand expected values kept by the EV engine
+EV_CACHE_SIZE = 4096
+
+# Bankroll to recommend bets for (None disables the recommended bet in the payload)
+BANKROLL = None
+MIN_BET = 5
+MAX_BET = 100
+# Fraction of the Kelly bet to bet
+KELLY_FRACTION = 0.5
+# Bet ramp in units of MIN_BET per true count from -6 to 6 (None bets the Kelly bets)
+BET_RAMP = None
+# Number of shoes simulated to estimate the EV per true count, and the directory to cache the results in
+BANKROLL_SIMULATION_SHOES = 20000
+BANKROLL_CACHE_DIR = "blackjai_server/data/cache"
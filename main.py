@@ -10,7 +10,7 @@ def main():
         vm = sys.argv[1]
     else:
         vm = VIEW_MODE
-    server = BlackJAIServer(hostname=BLACKJAI_CAPTURE_IP, port=BLACKJAI_CAPTURE_PORT, view_mode=vm)
+    server = BlackJAIServer(hostname=BLACKJAI_CAPTURE_IP, port=BLACKJAI_CAPTURE_PORT, view_mode=vm, headless=HEADLESS)
     server.start()
 
 
@@ -0,0 +1,36 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+
+from blackjai_server.engine.engine import BlackJAIEngine
+from blackjai_server.engine.state import DEAL_PHASE, TURN_PHASE
+from blackjai_server.engine.strategy import NUM_TC_BUCKETS
+from blackjai_server.simulation.bankroll import BankrollPlan
+
+
+def _prediction(card, x, y):
+    return {"class": card, "x": x, "y": y, "width": 40, "height": 40, "confidence": 0.9}
+
+
+# Two player hands at the bottom of the frame and the dealer's up card at the top
+DEAL = [_prediction("7S", 900, 600), _prediction("8S", 950, 610), _prediction("AH", 300, 600),
+        _prediction("3D", 350, 620), _prediction("8C", 600, 200)]
+
+
+# Every payload carries the recommended bet, including the frame that starts the turn phase and the turn frames
+def test_recommended_bet_in_every_phase():
+    stats = (np.full(NUM_TC_BUCKETS, 1 / NUM_TC_BUCKETS), np.zeros(NUM_TC_BUCKETS), np.ones(NUM_TC_BUCKETS))
+    plan = BankrollPlan(stats, bankroll=1000, min_bet=10, bet_ramp=[1] * NUM_TC_BUCKETS)
+    engine = BlackJAIEngine(frame_size=(1280, 720), buffer_size=5, bankroll_plan=plan)
+    phases = []
+    for i in range(20):
+        payload = engine.update({"predictions": DEAL})
+        phases.append(engine.state.get_phase())
+        assert payload["recommended_bet"] == 10
+    assert DEAL_PHASE in phases
+    assert phases[-1] == TURN_PHASE
+
+
+if __name__ == "__main__":
+    test_recommended_bet_in_every_phase()
@@ -0,0 +1,48 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+
+from blackjai_server.engine.ev import EVEngine, STAND
+from blackjai_server.engine.models import Card
+from blackjai_server.engine.strategy import RuleSet
+
+# Composition index order: values 2-9, ten valued cards, aces
+
+
+# Dealer 10 up against a shoe of three 7s, one 8 and two tens (the peek rules out an ace under the 10):
+# the dealer draws once and finishes on 17 (3/6), 18 (1/6) or 20 (2/6)
+def test_stand_ev_against_ten():
+    engine = EVEngine(RuleSet(num_decks=1))
+    composition = [0, 0, 0, 0, 0, 3, 1, 0, 2, 0]
+    dist = engine.dealer_distribution(8, composition)
+    assert dist == pytest.approx([3 / 6, 1 / 6, 0, 2 / 6, 0, 0])
+    # 19 beats 17 and 18 and loses to 20
+    assert engine.hand_evs([Card("10H"), Card("9S")], Card("KD"), composition)[STAND] == pytest.approx(4 / 6 - 2 / 6)
+    # 18 beats 17, pushes 18 and loses to 20
+    assert engine.hand_evs([Card("10H"), Card("8S")], Card("KD"), composition)[STAND] == pytest.approx(3 / 6 - 2 / 6)
+
+
+# Dealer ace up against a shoe of two 6s and two 7s (the peek rules out a ten under the ace).
+# A 7 makes soft 18. A 6 makes soft 17, where S17 stands and H17 draws on: 6 then 7 finishes on 20,
+# 7 then 6 or 7 finishes on 20 or 21.
+def test_stand_ev_soft_17_rules():
+    composition = [0, 0, 0, 0, 2, 2, 0, 0, 0, 0]
+    hand = [Card("10H"), Card("8S")]
+    s17 = EVEngine(RuleSet(num_decks=1, dealer_hits_soft_17=False))
+    assert s17.dealer_distribution(9, composition) == pytest.approx([1 / 2, 1 / 2, 0, 0, 0, 0])
+    assert s17.hand_evs(hand, Card("AD"), composition)[STAND] == pytest.approx(1 / 2)
+    h17 = EVEngine(RuleSet(num_decks=1, dealer_hits_soft_17=True))
+    assert h17.dealer_distribution(9, composition) == pytest.approx([0, 1 / 2, 0, 1 / 3, 1 / 6, 0])
+    assert h17.hand_evs(hand, Card("AD"), composition)[STAND] == pytest.approx(-1 / 2)
+
+
+def test_blackjack_pays_3_to_2():
+    engine = EVEngine(RuleSet(num_decks=1))
+    assert engine.hand_evs([Card("AH"), Card("KS")], Card("9D"), [4] * 8 + [16, 4])[STAND] == 1.5
+
+
+if __name__ == "__main__":
+    test_stand_ev_against_ten()
+    test_stand_ev_soft_17_rules()
+    test_blackjack_pays_3_to_2()
@@ -0,0 +1,63 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+
+from blackjai_server.engine.strategy import RuleSet
+from blackjai_server.simulation.simulator import Simulator, SimulationResult, simulate
+
+# Published house edge of basic strategy for 6 decks, dealer hits soft 17, double after split, no surrender
+# (resplits allowed, which this simulator does not play, worth a few hundredths of a percent)
+PUBLISHED_EV_6D_H17_DAS = -0.0064
+# 60000 shoes are about 2.6 million rounds, a standard error of about 0.07%
+EV_TOLERANCE = 0.003
+
+
+def _assert_same_result(a: SimulationResult, b: SimulationResult):
+    assert a.num_rounds == b.num_rounds
+    assert a.sum_win == pytest.approx(b.sum_win)
+    assert a.sum_sq_win == pytest.approx(b.sum_sq_win)
+    assert a.sum_bet == pytest.approx(b.sum_bet)
+    assert np.array_equal(a.bucket_rounds, b.bucket_rounds)
+    assert np.allclose(a.bucket_win, b.bucket_win)
+    assert np.allclose(a.bucket_sq_win, b.bucket_sq_win)
+    assert np.allclose(a.bucket_bet, b.bucket_bet)
+    assert np.array_equal(a.bucket_wins, b.bucket_wins)
+    assert np.array_equal(a.bucket_losses, b.bucket_losses)
+
+
+# The same seed and number of workers play the same shuffles
+def test_simulate_is_reproducible():
+    simulator = Simulator(RuleSet(num_decks=6))
+    for num_workers in (1, 2):
+        _assert_same_result(simulate(simulator, 200, num_workers, seed=7, batch_size=64),
+                            simulate(simulator, 200, num_workers, seed=7, batch_size=64))
+    assert simulate(simulator, 200, 1, seed=7).sum_win != simulate(simulator, 200, 1, seed=8).sum_win
+
+
+# Merging the results of two batches gives the result of playing both batches into one result
+def test_merge_matches_one_result():
+    simulator = Simulator(RuleSet(num_decks=2))
+    rng = np.random.default_rng(3)
+    first = simulator.run_batch(rng, 100)
+    second = simulator.run_batch(rng, 100)
+    rng = np.random.default_rng(3)
+    combined = SimulationResult()
+    simulator.run_batch(rng, 100, combined)
+    simulator.run_batch(rng, 100, combined)
+    _assert_same_result(first.merge(second), combined)
+
+
+# Flat betting basic strategy (no count deviations) lands on the published house edge
+def test_basic_strategy_ev():
+    rules = RuleSet(num_decks=6, dealer_hits_soft_17=True, double_after_split=True, surrender=False)
+    result = simulate(Simulator(rules, deviations=False), 60000, num_workers=1, seed=0)
+    assert result.sum_bet == result.num_rounds
+    assert result.get_ev_per_bet() == pytest.approx(PUBLISHED_EV_6D_H17_DAS, abs=EV_TOLERANCE)
+
+
+if __name__ == "__main__":
+    test_simulate_is_reproducible()
+    test_merge_matches_one_result()
+    test_basic_strategy_ev()
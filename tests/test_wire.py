@@ -0,0 +1,75 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from blackjai_server.egress.wire import BinaryPayloadEncoder, BinaryPayloadDecoder, KEYFRAME, DELTA
+from blackjai_server.engine.models import COUNT_SYSTEMS
+from blackjai_server.engine.state import DEAL_PHASE, TURN_PHASE
+
+
+def _payload(version, phase, deck_dict, players, dealer, count=0.0, actions=None, bet=None):
+    count_systems = {"count_" + system: count for system in COUNT_SYSTEMS}
+    count_systems["deck_dict"] = deck_dict
+    payload = {"phase": phase, "players": [{"hands": hands, "minimum_bet": 5} for hands in players],
+               "dealer": {"hands": dealer, "minimum_bet": 0}, "count_systems": count_systems, "version": version}
+    if (actions is not None):
+        payload["actions"] = actions
+    if (bet is not None):
+        payload["recommended_bet"] = bet
+    return payload
+
+
+def _assert_decoded(decoded, payload):
+    assert decoded["version"] == payload["version"]
+    assert decoded["phase"] == payload["phase"]
+    assert [player["hands"] for player in decoded["players"]] == [player["hands"] for player in payload["players"]]
+    assert decoded["dealer"]["hands"] == payload["dealer"]["hands"]
+    assert decoded["count_systems"] == payload["count_systems"]
+    assert decoded.get("actions") == payload.get("actions")
+    assert decoded.get("recommended_bet") == payload.get("recommended_bet")
+
+
+# A game played over keyframes and deltas decodes back to every payload
+def test_binary_round_trip():
+    payloads = [
+        _payload(1, DEAL_PHASE, {}, [[], []], []),
+        _payload(2, TURN_PHASE, {"7S": 1, "8S": 1, "AH": 1, "3D": 1, "8C": 1}, [[["7S", "8S"]], [["AH", "3D"]]], [["8C"]],
+                 count=0.5, actions=[["H"], ["DH"]], bet=10),
+        # same state, new actions and bet
+        _payload(2, TURN_PHASE, {"7S": 1, "8S": 1, "AH": 1, "3D": 1, "8C": 1}, [[["7S", "8S"]], [["AH", "3D"]]], [["8C"]],
+                 count=0.5, actions=[["S"], ["DH"]], bet=20),
+        # nothing changed
+        _payload(2, TURN_PHASE, {"7S": 1, "8S": 1, "AH": 1, "3D": 1, "8C": 1}, [[["7S", "8S"]], [["AH", "3D"]]], [["8C"]],
+                 count=0.5, actions=[["S"], ["DH"]], bet=20),
+        # a card seen a second time and a split
+        _payload(3, TURN_PHASE, {"7S": 2, "8S": 1, "AH": 1, "3D": 1, "8C": 1, "KD": 1}, [[["7S", "8S", "7S"]], [["AH"], ["3D"]]],
+                 [["8C", "KD"]], count=-1.5, actions=[["S"], ["H", "H"]], bet=20),
+        # the shoe was reset, cards leave the seen cards
+        _payload(4, DEAL_PHASE, {}, [[], []], [], bet=10),
+    ]
+    encoder = BinaryPayloadEncoder(num_decks=2, keyframe_interval=30)
+    decoder = BinaryPayloadDecoder()
+    message_types = []
+    for payload in payloads:
+        message = encoder.encode(payload)
+        message_types.append(message[3])
+        _assert_decoded(decoder.decode(message), payload)
+    assert message_types == [KEYFRAME, KEYFRAME, DELTA, DELTA, DELTA, KEYFRAME]
+
+
+# A lost delta stops decoding until the next keyframe
+def test_lost_delta_waits_for_keyframe():
+    encoder = BinaryPayloadEncoder(num_decks=1, keyframe_interval=2)
+    decoder = BinaryPayloadDecoder()
+    payloads = [_payload(i, TURN_PHASE, {"2C": 1}, [[["2C"]]], [], count=float(i)) for i in range(5)]
+    messages = [encoder.encode(payload) for payload in payloads]
+    _assert_decoded(decoder.decode(messages[0]), payloads[0])
+    assert decoder.decode(messages[2]) is None
+    assert messages[3][3] == KEYFRAME
+    _assert_decoded(decoder.decode(messages[3]), payloads[3])
+    _assert_decoded(decoder.decode(messages[4]), payloads[4])
+
+
+if __name__ == "__main__":
+    test_binary_round_trip()
+    test_lost_delta_waits_for_keyframe()